@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+import time
+import uuid
+import tracemalloc
+import tempfile
+
+import tornado.options
+
+import theas
+
+__author__ = 'DavidRueter'
+"""
+ Theas web application server benchmarks.
+
+ Description : Measures the cost of creating Theas pages and rendering templates.  Does not need SQL.
+ Home:  https://github.com/davidrueter/Theas
+
+ Usage : python TheasBench.py [--bench=sessions|templates] [--bench_iterations=1000] [--bench_sessions=10000]
+
+ Benchmarks (selected with --bench):
+    sessions    Creates --bench_sessions Theas pages (as ThSession does for each session), once with a jinja
+                environment per page (as before pages shared the jinja environment) and once with the shared
+                environment, and reports the time taken and the memory used for each.
+
+    templates   Renders a sample template --bench_iterations times, once compiling the template on each render
+                (a cold template cache, as before templates were cached), once loading the compiled template from
+                a template bytecode cache in a temporary folder on each render (as after a restart), and once from
+                theas.template_cache (warm), and reports the average render time for each.
+"""
+
+
+def bench_log(*args):
+    print(' '.join(str(this_arg) for this_arg in args))
+
+
+class BenchSession:
+    # The parts of ThSession that theas.Theas and its filters use
+    def __init__(self):
+        self.session_token = str(uuid.uuid4())
+        self.current_resource = None
+        self.current_xsrf_form_html = ''
+        self.resource_versions = {}
+
+    def log(self, category, *args):
+        pass
+
+
+def bench_sessions(session_count):
+    results = {}
+
+    for this_mode in ('per-session', 'shared'):
+        this_pages = []
+
+        tracemalloc.start()
+        start_time = time.perf_counter()
+
+        for i in range(session_count):
+            if this_mode == 'per-session':
+                this_page = theas.Theas(theas_session=BenchSession(),
+                                        jinja_environment=theas.create_jinja_environment())
+            else:
+                this_page = theas.Theas(theas_session=BenchSession())
+            this_pages.append(this_page)
+
+        elapsed = time.perf_counter() - start_time
+        this_memory, this_peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[this_mode] = (elapsed, this_memory)
+
+        bench_log('sessions {:<12}  sessions: {}  total: {:.3f} s  avg: {:.3f} ms  memory: {:,} bytes  '
+                  'per session: {:,} bytes'.format(this_mode, session_count, elapsed,
+                                                   elapsed * 1000 / session_count, this_memory,
+                                                   this_memory // session_count))
+
+        this_pages = None
+
+    return results
+
+
+BENCH_TEMPLATE = '''<html>
+<head><title>{{ data._Theas.theasParams.th_title|default("Theas") }}</title></head>
+<body>
+<form method="post">
+{% for i in range(20) %}
+    <div class="row{{ loop.index % 2 }}">
+        <label for="field{{ i }}">Field {{ i }}</label>
+        <input type="text" name="field{{ i }}" value="{{ i * 10 }}" />
+        {% if i is even %}<span>even</span>{% else %}<span>odd</span>{% endif %}
+    </div>
+{% endfor %}
+</form>
+</body>
+</html>
+'''
+
+
+def bench_templates(iterations):
+    results = {}
+
+    this_page = theas.Theas(theas_session=BenchSession())
+    this_data = {'_Theas': {'theasParams': {}}}
+
+    for this_mode in ('cold', 'restart', 'warm'):
+        theas.template_cache.invalidate(invalidate_all=True)
+        theas.template_cache.hits = 0
+        theas.template_cache.misses = 0
+
+        with tempfile.TemporaryDirectory() as this_dir:
+            if this_mode == 'restart':
+                theas.set_template_bytecode_cache(this_dir)
+                # Store the compiled template, as a previous process would have
+                this_page.render(BENCH_TEMPLATE, data=this_data, template_key=('bench', 1))
+
+            start_time = time.perf_counter()
+
+            for i in range(iterations):
+                if this_mode != 'warm':
+                    theas.template_cache.invalidate(invalidate_all=True)
+                this_page.render(BENCH_TEMPLATE, data=this_data, template_key=('bench', 1))
+
+            elapsed = time.perf_counter() - start_time
+
+            theas.set_template_bytecode_cache(None)
+
+        results[this_mode] = elapsed
+
+        bench_log('templates {:<7}  renders: {}  total: {:.3f} s  avg: {:.3f} ms  {}'.format(
+            this_mode, iterations, elapsed, elapsed * 1000 / iterations, theas.template_cache.stats_str()))
+
+    return results
+
+
+def run():
+    bench_options = tornado.options.options
+
+    bench_options.define("bench", default='sessions', help="Benchmark to run:  sessions or templates", type=str)
+    bench_options.define("bench_iterations", default=1000, help="Number of calls to make in each benchmark",
+                         type=int)
+    bench_options.define("bench_sessions", default=10000,
+                         help="Number of sessions to create in the sessions benchmark", type=int)
+
+    bench_options.parse_command_line()
+
+    if bench_options.bench == 'sessions':
+        bench_sessions(bench_options.bench_sessions)
+        return
+
+    if bench_options.bench == 'templates':
+        bench_templates(bench_options.bench_iterations)
+        return
+
+    tornado.options.print_help()
+
+
+if __name__ == "__main__":
+    run()
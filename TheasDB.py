@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+import re
+import json
+import time
+import threading
+import abc
+
+try:
+    from pymssql import _mssql
+except ImportError:
+    # Only the fake driver can be used
+    _mssql = None
+
+__author__ = 'DavidRueter'
+"""
+ Theas web application server database driver layer.
+
+ Description : TheasServer talks to SQL through a driver, selected by the sql_driver option:
+
+    mssql   Uses pymssql's _mssql module to talk to a real Microsoft SQL Server.  (The default.)
+    fake    An in-process stand-in that returns canned resultsets (with configurable latency) from a script,
+            so that TheasServer can be run and profiled without a SQL server.  See ThFakeDriver.
+
+ A driver's connect() returns a connection object that behaves like an _mssql.MSSQLConnection, as far as
+ TheasServer is concerned:  connected, query_timeout, tds_version, execute_query, execute_non_query, execute_scalar,
+ iteration over the rows of the current resultset, nextresult, cancel, close and init_procedure.  The mssql driver
+ returns the _mssql connection itself, so it adds no overhead.
+
+ Parameter types for ThStoredProc.bind are exported here (SQLCHAR, SQLVARCHAR, etc.) so that they are available
+ no matter which driver is in use.
+"""
+
+if _mssql is not None:
+    SQLBIT = _mssql.SQLBIT
+    SQLCHAR = _mssql.SQLCHAR
+    SQLDATETIME = _mssql.SQLDATETIME
+    SQLFLT4 = _mssql.SQLFLT4
+    SQLFLT8 = _mssql.SQLFLT8
+    SQLINT1 = _mssql.SQLINT1
+    SQLINT2 = _mssql.SQLINT2
+    SQLINT4 = _mssql.SQLINT4
+    SQLINT8 = _mssql.SQLINT8
+    SQLUUID = _mssql.SQLUUID
+    SQLVARBINARY = _mssql.SQLVARBINARY
+    SQLVARCHAR = _mssql.SQLVARCHAR
+else:
+    # Same values as FreeTDS's sybdb.h
+    SQLBIT = 50
+    SQLCHAR = 47
+    SQLDATETIME = 61
+    SQLFLT4 = 59
+    SQLFLT8 = 62
+    SQLINT1 = 48
+    SQLINT2 = 52
+    SQLINT4 = 56
+    SQLINT8 = 127
+    SQLUUID = 36
+    SQLVARBINARY = 37
+    SQLVARCHAR = 39
+
+
+class ThDBDriver(abc.ABC):
+    """Class ThDBDriver is the base class for TheasServer database drivers.
+
+    A driver creates connections (see connect) and handles any library-wide settings.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def connect(self, server=None, port=None, user=None, password=None, database=None, appname=None):
+        pass
+
+    def set_max_connections(self, max_connections):
+        pass
+
+    def set_min_error_severity(self, min_error_severity):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class ThMSSQLDriver(ThDBDriver):
+    """Class ThMSSQLDriver connects to Microsoft SQL Server using pymssql's _mssql module."""
+
+    name = 'mssql'
+
+    def __init__(self):
+        if _mssql is None:
+            raise ImportError('The mssql SQL driver requires pymssql, which is not installed.')
+
+    def connect(self, server=None, port=None, user=None, password=None, database=None, appname=None):
+        return _mssql.connect(
+            server=server,
+            port=port,
+            user=user,
+            password=password,
+            database=database,
+            appname=appname
+        )
+
+    def set_max_connections(self, max_connections):
+        _mssql.set_max_connections(max_connections)
+
+    def set_min_error_severity(self, min_error_severity):
+        _mssql.min_error_severity = min_error_severity
+
+    def shutdown(self):
+        # Clean up _mssql resources
+        # _mssql.exit_mssql()
+        pass
+
+
+# -------------------------------------------------
+# Fake driver
+# -------------------------------------------------
+class ThFakeSQLError(Exception):
+    """Exception raised by ThFakeConnection when a response scripts an error.
+
+    Like the _mssql exceptions, the message is available as bytes in .text (which is what format_error expects).
+    """
+
+    def __init__(self, message, procname=None):
+        super().__init__(message)
+        self.text = message.encode('utf-8')
+        if procname is not None:
+            self.procname = procname.encode('utf-8')
+
+
+class ThFakeResponse:
+    """Class ThFakeResponse is one scripted response of ThFakeScript.
+
+    match is a regular expression (case insensitive) that is searched for in the SQL text of each query.
+
+    resultsets is a list of resultsets.  Each resultset may be a list of row dictionaries, or a dictionary with
+    "columns" (a list of column names) and "rows" (a list of lists of values).  resultsets may instead be a
+    callable that is given the SQL text and returns the list of resultsets.
+
+    latency_ms is the time to sleep before returning the response (None to use the script's latency).
+
+    If error is set, a ThFakeSQLError with that message is raised instead of returning resultsets.
+    """
+
+    def __init__(self, match, resultsets=None, latency_ms=None, error=None):
+        self.match = match
+        self.regex = re.compile(match, re.IGNORECASE)
+        self.latency_ms = latency_ms
+        self.error = error
+        self.hits = 0
+
+        if callable(resultsets):
+            self.resultsets = resultsets
+        else:
+            self.resultsets = [ThFakeResponse.normalize_resultset(this_resultset)
+                               for this_resultset in (resultsets or [])]
+
+    @staticmethod
+    def normalize_resultset(resultset):
+        # Convert a resultset to (columns, rows), where rows is a list of lists of values
+        if isinstance(resultset, dict):
+            return list(resultset.get('columns', [])), [list(this_row) for this_row in resultset.get('rows', [])]
+
+        columns = []
+        for this_row in resultset:
+            for this_col in this_row:
+                if this_col not in columns:
+                    columns.append(this_col)
+
+        return columns, [[this_row.get(this_col) for this_col in columns] for this_row in resultset]
+
+    def get_resultsets(self, sql):
+        if callable(self.resultsets):
+            return [ThFakeResponse.normalize_resultset(this_resultset) for this_resultset in self.resultsets(sql)]
+        return self.resultsets
+
+
+class ThFakeScript:
+    """Class ThFakeScript holds the responses that ThFakeConnection returns.
+
+    Responses are checked in the order they were added, and the first one that matches the SQL text is used.
+    A query that matches no response returns no resultsets.
+
+    A script can be built in Python with add_response, or loaded from a JSON file with load, in the form:
+
+        {
+            "latency_ms": 2,
+            "responses": [
+                {"match": "theas\\.spgetSysWebResources", "latency_ms": 10,
+                 "resultsets": [[{"ResourceCode": "login", "Content": "<html>...</html>", "IsPublic": 1}]]},
+                {"match": "theas\\.spdoAuthenticateUser", "error": "Invalid password"}
+            ]
+        }
+    """
+
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.responses = []
+        self.unmatched = 0
+        self._lock = threading.Lock()
+
+    def add_response(self, match, resultsets=None, latency_ms=None, error=None):
+        this_response = ThFakeResponse(match, resultsets=resultsets, latency_ms=latency_ms, error=error)
+        with self._lock:
+            self.responses.append(this_response)
+        return this_response
+
+    def clear(self):
+        with self._lock:
+            self.responses = []
+            self.unmatched = 0
+
+    def load(self, filename):
+        with open(filename, 'r', encoding='utf-8') as f:
+            this_script = json.load(f)
+
+        self.latency_ms = this_script.get('latency_ms', self.latency_ms)
+
+        for this_response in this_script.get('responses', []):
+            self.add_response(this_response['match'],
+                              resultsets=this_response.get('resultsets'),
+                              latency_ms=this_response.get('latency_ms'),
+                              error=this_response.get('error'))
+
+    def find_response(self, sql):
+        for this_response in self.responses:
+            if this_response.regex.search(sql):
+                this_response.hits += 1
+                return this_response
+
+        self.unmatched += 1
+        return None
+
+    def stats_str(self):
+        return 'Fake SQL responses: ' + ', '.join(
+            '{}={}'.format(this_response.match, this_response.hits) for this_response in self.responses) + \
+               '  Unmatched: {}'.format(self.unmatched)
+
+
+class ThFakeStoredProcedure:
+    """Class ThFakeStoredProcedure stands in for _mssql.MSSQLStoredProcedure (see ThStoredProc)."""
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.parameters = {}
+
+    def bind(self, value, dbtype, param_name=None, output=False, null=False, max_length=-1):
+        self.parameters[param_name] = None if null else value
+
+    def execute(self):
+        self.connection.execute_query('EXEC ' + self.name)
+
+
+class ThFakeConnection:
+    """Class ThFakeConnection stands in for _mssql.MSSQLConnection, returning responses from a ThFakeScript.
+
+    Rows are returned as dictionaries keyed by both column index and column name, the same as _mssql.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.connected = True
+        self.query_timeout = 0
+        self.tds_version = 'fake'
+        self._resultsets = []
+        self._resultset_index = 0
+        self._row_index = 0
+
+    def _run(self, sql):
+        if not self.connected:
+            raise ThFakeSQLError('Not connected to any server')
+
+        this_response = self.script.find_response(sql)
+
+        this_latency_ms = self.script.latency_ms
+        if this_response is not None and this_response.latency_ms is not None:
+            this_latency_ms = this_response.latency_ms
+
+        if this_latency_ms:
+            time.sleep(this_latency_ms / 1000)
+
+        self._resultsets = []
+        self._resultset_index = 0
+        self._row_index = 0
+
+        if this_response is not None:
+            if this_response.error:
+                raise ThFakeSQLError(this_response.error)
+
+            self._resultsets = this_response.get_resultsets(sql)
+
+    def execute_query(self, sql, params=None):
+        self._run(sql)
+
+    def execute_non_query(self, sql, params=None):
+        self._run(sql)
+        self.cancel()
+
+    def execute_scalar(self, sql, params=None):
+        self._run(sql)
+        this_result = None
+        for this_row in self:
+            this_result = this_row[0]
+            break
+        self.cancel()
+        return this_result
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._resultset_index >= len(self._resultsets):
+            raise StopIteration
+
+        columns, rows = self._resultsets[self._resultset_index]
+        if self._row_index >= len(rows):
+            raise StopIteration
+
+        this_values = rows[self._row_index]
+        self._row_index += 1
+
+        # Build a new dictionary for each row, as _mssql does
+        this_row = {}
+        for i, this_col in enumerate(columns):
+            this_row[i] = this_values[i]
+            this_row[this_col] = this_values[i]
+
+        return this_row
+
+    def nextresult(self):
+        self._resultset_index += 1
+        self._row_index = 0
+        if self._resultset_index < len(self._resultsets):
+            return 1
+        return None
+
+    def cancel(self):
+        self._resultsets = []
+        self._resultset_index = 0
+        self._row_index = 0
+
+    def close(self):
+        self.cancel()
+        self.connected = False
+
+    def init_procedure(self, name):
+        return ThFakeStoredProcedure(self, name)
+
+
+class ThFakeDriver(ThDBDriver):
+    """Class ThFakeDriver is an in-process stand-in for SQL Server, used for load testing and profiling.
+
+    All connections share a single ThFakeScript (see script), which may be loaded from the file given by the
+    sql_fake_script option.
+    """
+
+    name = 'fake'
+
+    def __init__(self, script_filename=None, latency_ms=0):
+        self.script = ThFakeScript(latency_ms=latency_ms)
+        if script_filename:
+            self.script.load(script_filename)
+
+    def connect(self, server=None, port=None, user=None, password=None, database=None, appname=None):
+        return ThFakeConnection(self.script)
+
+
+DRIVERS = {
+    ThMSSQLDriver.name: ThMSSQLDriver,
+    ThFakeDriver.name: ThFakeDriver
+}
+
+
+def get_driver(name, **kwargs):
+    # Create the driver with the given name (see DRIVERS)
+    if name not in DRIVERS:
+        raise ValueError('Unknown SQL driver "{}".  Must be one of: {}'.format(name, ', '.join(DRIVERS)))
+    return DRIVERS[name](**kwargs)
@@ -11,24 +11,45 @@ import uuid
 import binascii
 import traceback
 import string
+import re
+import copy
+import weakref
+import itertools
+import multiprocessing
+import pickle
 import json
+import collections
+import gzip
+import mmap
+import struct
+import hashlib
+import email.utils
 
 
 import tornado.httpserver
 import tornado.websocket
 import tornado.ioloop
 import tornado.web
+import tornado.iostream
+import tornado.concurrent
 import tornado.options
 
 
 
 from multiprocessing import Lock
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from tornado.concurrent import run_on_executor
 
 import theas
 
-from pymssql import _mssql
+import TheasDB
+
+try:
+    import brotli
+except ImportError:
+    # Resources will be precompressed with gzip only
+    brotli = None
 
 import logging
 
@@ -110,6 +131,8 @@ LOGIN_AUTO_USER_TOKEN = None
 DEFAULT_RESOURCE_CODE = None
 
 FULL_SQL_IS_OK_CHECK = False
+SQL_IDLE_CHECK_SECONDS = 60  # With FULL_SQL_IS_OK_CHECK, only test SQL connections idle for longer than this (or after an error), 0 to test before every call
+SQL_VALIDATE_POLL_SECONDS = 0  # Seconds to sleep in between checks of idle SQL connections in background thread, 0 to disable
 
 USE_WORKER_THREADS = False
 MAX_WORKERS = 30
@@ -126,6 +149,32 @@ COOKIE_SECRET = 'tF7nGhE6nIcPMTvGPHlbAk5NIoCOrKnlHIfPQyej6Ay='
 
 MAX_CACHE_ITEM_SIZE = 1024 * 1024 * 100      # Only cache SysWebResources that are less than 100 Meg in size
 MAX_CACHE_SIZE = 1024 * 1024 * 1024 * 2      # Use a maximum of 2 GB of cache
+TEMPLATE_CACHE_SIZE = 500  # Maximum number of compiled jinja templates to keep, 0 to compile templates each time they are rendered
+TEMPLATE_BYTECODE_CACHE_DIR = ''  # Folder (in settings_path, unless a full path) to store compiled jinja templates in across restarts, blank to disable
+TEMPLATE_BYTECODE_CACHE_SIZE = 64 * 1024 * 1024  # Maximum total size (in bytes) of the files in TEMPLATE_BYTECODE_CACHE_DIR, 0 for no limit
+COMPRESS_MIN_SIZE = 1024  # Only precompress cached resources of at least this many bytes, 0 to disable precompression
+COMPRESS_GZIP_LEVEL = 6  # gzip level for precompression (levels above 6 cost much more time for little gain)
+COMPRESS_BROTLI_QUALITY = 5  # brotli quality for precompression (qualities above 5-6 are very slow)
+REVISION_POLL_SECONDS = 0  # Seconds between background checks for changed resource revisions, 0 to disable
+CACHE_WARMUP = 'none'  # Load all public resources and templates at startup:  none, wait (before serving requests) or background
+CACHE_WARMUP_CONNECTIONS = 1  # Number of SQL connections to use in parallel for CACHE_WARMUP
+THEAS_PARAMS_DELTA = False  # Bind only changed controls to @TheasParams of stored procedures that have a @TheasParamsDelta parameter
+RENDER_PROCESSES = 0  # Number of worker processes to render templates in (to use more than one CPU core), 0 to render in the server process
+STREAM_RENDER = False  # Send rendered templates in chunks of STREAM_CHUNK_SIZE as they are rendered, rather than rendering the whole page first (resources can also opt in with StreamRender)
+RENDER_STREAM_ERROR_HTML = '<div class="theas-render-error">Sorry, an error occurred while rendering the rest of this page.</div>'  # added to the partial page if a streamed render fails
+STREAM_CHUNK_SIZE = 1024 * 256  # Send resources and attachments larger than this in chunks of this many bytes, flushing after each
+CACHE_SNAPSHOT_FILE = ''  # File (in settings_path, unless a full path) to save cached resources to at shutdown and load them from at startup, blank to disable
+
+SQL_POOL_SIZE = 0  # Maximum number of pooled SQL connections shared by all sessions, 0 for a dedicated connection per session
+SQL_POOL_WAIT_SECONDS = 30  # Seconds to wait for a pooled SQL connection to become available
+
+RESULT_CACHE_MAX_SIZE = 1024 * 1024 * 100  # Use a maximum of 100 MB to cache API stored procedure results (see ThCachedResults)
+
+PARAM_CACHE_SECONDS = 300  # Seconds to cache stored procedure parameter names (from sputilGetParamNames), 0 to disable
+
+CACHE_INIT_SESSION = False  # Run the statements from theas.spgetInitSession once, then replay them on new connections
+
+COMPACT_ROWS = False  # Store resultset rows passed to templates as ThRow objects instead of _mssql row dictionaries
 
 # NOTE:
 # 1) This is the maximum number of threads per thread pool, not for the whole application.  In practice each
@@ -142,6 +191,12 @@ MAX_CACHE_SIZE = 1024 * 1024 * 1024 * 2      # Use a maximum of 2 GB of cache
 
 G_sessions = None  # Global list of sessions
 G_cached_resources = None  # Global list of cached resources
+G_cached_params = None  # Global list of cached stored procedure parameters
+G_cached_results = None  # Global list of cached API stored procedure results
+G_sql_pool = None  # Global pool of SQL connections (if SQL_POOL_SIZE is set)
+G_sql_driver = None  # Global SQL driver (see TheasDB)
+G_render_pool = None  # Global pool of template rendering processes (if RENDER_PROCESSES is set)
+G_init_session_sql = None  # Cached list of SQL statements returned by theas.spgetInitSession (if CACHE_INIT_SESSION)
 G_program_options = None
 G_server_is_running = False
 G_break_handler = None
@@ -350,6 +405,11 @@ class TheasServerSQLError(TheasServerError):
         return repr(self.value)
 
 
+class ThSQLPoolExhaustedError(TheasServerSQLError):
+    # Raised by ThSQLPool.acquire when no pooled connection became available in time
+    pass
+
+
 def StopServer():
     global G_server_is_running
 
@@ -398,6 +458,607 @@ def do_periodic_callback():
         # tornado.ioloop.IOLoop.instance().add_callback(tornado.ioloop.IOLoop.instance().stop)
 
 
+def open_sql_conn():
+    # Open a new SQL connection using the configured connection settings and SQL driver
+    sql_conn = G_sql_driver.connect(
+        server=G_program_options.sql_server,
+        port=G_program_options.sql_port,
+        user=G_program_options.sql_user,
+        password=G_program_options.sql_password,
+        database=G_program_options.sql_database,
+        appname=G_program_options.sql_appname
+    )
+    sql_conn.query_timeout = G_program_options.sql_timeout
+    return sql_conn
+
+
+def build_sql_batch(statements):
+    # Combine several SQL statements into a single batch, so that they can be executed in one round trip
+    this_batch = ''
+
+    for this_statement in statements:
+        if this_statement:
+            this_statement = this_statement.strip()
+            if this_statement:
+                this_batch += this_statement
+                if not this_statement.endswith(';'):
+                    this_batch += ';'
+                this_batch += '\n'
+
+    return this_batch
+
+
+def get_row_size(row):
+    # Approximate number of bytes held by a row from _mssql (or a ThRow).  Each value in an _mssql row is stored
+    # under both its column index and its column name, so count the values under the names only.
+    if isinstance(row, ThRow):
+        return sys.getsizeof(row) + sys.getsizeof(row.values_tuple) + sum(sys.getsizeof(v) for v in row.values_tuple)
+    return sys.getsizeof(row) + sum(sys.getsizeof(v) for k, v in row.items() if isinstance(k, str))
+
+
+# -------------------------------------------------
+# Compact rows
+# -------------------------------------------------
+class ThRowColumns:
+    """Class ThRowColumns is the column index shared by all of the ThRow objects of a single resultset.
+
+    names is a tuple of the column names (in the order the values are stored in each ThRow), and positions maps
+    each column name to its position.
+    """
+
+    # Columns of a General resultset that get_data itself looks at.  These are always kept, even when the
+    # resultset specifies a list of columns.
+    CONTROL_COLUMNS = ('TheasParams', 'ErrorMessage', 'Cookies', 'RedirectTo', 'DoHistoryGoBack', 'Filename',
+                       'HTTPHeaders')
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.positions = {this_name: i for i, this_name in enumerate(self.names)}
+
+    @classmethod
+    def from_row(cls, row, columns=None):
+        # Build the column index from the first row of a resultset.  If columns is provided, only those
+        # columns (plus any CONTROL_COLUMNS) are kept.
+        row_names = [this_key for this_key in row.keys() if isinstance(this_key, str)]
+
+        if columns:
+            keep_names = set(this_col.strip() for this_col in columns) | set(cls.CONTROL_COLUMNS)
+            row_names = [this_name for this_name in row_names if this_name in keep_names]
+
+        return cls(row_names)
+
+    def make_row(self, row):
+        return ThRow(self, tuple(row[this_name] for this_name in self.names))
+
+
+class ThRow:
+    """Class ThRow is a compact, read-only replacement for the row dictionaries returned by _mssql.
+
+    _mssql returns each row as a dictionary keyed by both column index and column name.  A ThRow instead stores
+    the values in a tuple and shares a single ThRowColumns index with all the other rows of the resultset, which
+    takes a fraction of the memory when a resultset has many rows.
+
+    Values may be accessed by name or by position (row['Col'], row[0]) and by attribute (row.Col), so Jinja
+    templates work the same as with a dictionary.  ThRow also supports in, get, keys, values and items.
+
+    Used by ThHandler.get_data when COMPACT_ROWS is set.
+    """
+
+    __slots__ = ('columns', 'values_tuple')
+
+    def __init__(self, columns, values_tuple):
+        self.columns = columns
+        self.values_tuple = values_tuple
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self.values_tuple[key]
+        return self.values_tuple[self.columns.positions[key]]
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, i.e. for column names
+        if name in ThRow.__slots__:
+            raise AttributeError(name)
+        try:
+            return self.values_tuple[self.columns.positions[name]]
+        except (KeyError, AttributeError):
+            raise AttributeError(name)
+
+    def __contains__(self, key):
+        return key in self.columns.positions
+
+    def __iter__(self):
+        return iter(self.columns.names)
+
+    def __len__(self):
+        return len(self.values_tuple)
+
+    def __repr__(self):
+        return 'ThRow({})'.format(dict(self.items()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, IndexError):
+            return default
+
+    def keys(self):
+        return self.columns.names
+
+    def values(self):
+        return self.values_tuple
+
+    def items(self):
+        return zip(self.columns.names, self.values_tuple)
+
+    def as_dict(self):
+        return dict(self.items())
+
+
+# -------------------------------------------------
+# Global SQL connection pool
+# -------------------------------------------------
+class ThPooledConn:
+    """Class ThPooledConn wraps a single SQL connection that belongs to ThSQLPool.
+
+    A pooled connection remembers the session context that has been established on it, so that a session that
+    borrows the connection knows what (if anything) needs to be replayed:  init_done indicates that the
+    statements returned by theas.spgetInitSession have been executed, and user_token and session_token are the
+    tokens of the user and session that were last authenticated on this connection (None if no user context has
+    been established).
+    """
+
+    def __init__(self, sql_conn):
+        self.sql_conn = sql_conn
+        self.init_done = False
+        self.user_token = None
+        self.session_token = None
+        self.date_last_used = time.time()
+
+
+class ThSQLPool:
+    """Class ThSQLPool manages a thread-safe, bounded pool of SQL connections (see ThPooledConn).
+
+    When SQL_POOL_SIZE is non-zero, a ThSession no longer owns a dedicated SQL connection.  Instead it borrows
+    a connection from the pool the first time it needs SQL during a request (see ThSession.init_session), and
+    returns it when the request is finished (see ThSession.finished).  The number of connections therefore
+    scales with the number of requests in flight rather than with the number of sessions.
+
+    When a connection is borrowed, the pool prefers an idle connection that already has the session's user
+    context (the same user and session tokens), then a connection with no user context.  Otherwise the session replays its context on whatever
+    connection it is given.
+
+    When all connections are in use, acquire waits (up to SQL_POOL_WAIT_SECONDS) for one to be released.  On the
+    IOLoop thread waiting would stop the connections in use from ever being released, so there acquire fails at
+    once.  Requests borrow their connection with acquire_async instead (see ThHandler.wait_for_session), which
+    waits without blocking the IOLoop.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.__idle = []
+        self.__conn_count = 0
+        self.__condition = threading.Condition()
+        self.__async_waiters = []  # (IOLoop, Future) of acquire_async callers waiting for a connection
+
+    def __len__(self):
+        return self.__conn_count
+
+    @staticmethod
+    def log(category, *args, severity=10000):
+        if LOGGING_LEVEL == 1 or 0 > severity >= LOGGING_LEVEL:
+            print(datetime.datetime.now(), 'ThSQLPool [{}]'.format(category), *args)
+
+    def acquire(self, user_token=None, session_token=None):
+        this_pooled_conn = None
+        discard_conn = None
+        give_up_at = time.time() + SQL_POOL_WAIT_SECONDS
+
+        if tornado.ioloop.IOLoop.current(instance=False) is not None:
+            # Don't block the IOLoop
+            give_up_at = 0
+
+        with self.__condition:
+            while this_pooled_conn is None:
+                # drop connections that have gone bad while idle
+                for this_idle in [c for c in self.__idle if not c.sql_conn.connected]:
+                    self.__idle.remove(this_idle)
+                    self.__conn_count -= 1
+
+                # 1) a connection that already has this user's (and session's) context
+                # 2) a connection with no user context
+                # 3) any connection, if the caller will replay its own user context anyway
+                for this_idle in reversed(self.__idle):
+                    if this_idle.user_token == user_token and \
+                            (user_token is None or this_idle.session_token == session_token):
+                        this_pooled_conn = this_idle
+                        break
+
+                if this_pooled_conn is None:
+                    for this_idle in reversed(self.__idle):
+                        if this_idle.user_token is None:
+                            this_pooled_conn = this_idle
+                            break
+
+                if this_pooled_conn is None and user_token is not None and self.__idle:
+                    this_pooled_conn = self.__idle[-1]
+
+                if this_pooled_conn is not None:
+                    self.__idle.remove(this_pooled_conn)
+
+                elif self.__conn_count < self.max_size or self.__idle:
+                    if self.__conn_count >= self.max_size:
+                        # Only connections belonging to other users are idle, and we have nothing to replay
+                        # over them.  Give up one of them to make room for a clean connection.
+                        discard_conn = self.__idle.pop(0)
+                        self.__conn_count -= 1
+
+                    # reserve a slot for the connection we are about to open
+                    self.__conn_count += 1
+                    break
+
+                else:
+                    remaining = give_up_at - time.time()
+                    if remaining <= 0:
+                        raise ThSQLPoolExhaustedError(
+                            'No SQL connection available:  all {} pooled connections are in use.'.format(
+                                self.max_size))
+                    self.__condition.wait(remaining)
+
+        if discard_conn is not None:
+            self.close_conn(discard_conn)
+
+        if this_pooled_conn is None:
+            # open the new connection outside of the lock
+            self.log('Pool', 'Creating new SQL connection.  Pooled connections:', self.__conn_count)
+            try:
+                this_pooled_conn = ThPooledConn(open_sql_conn())
+            except Exception:
+                with self.__condition:
+                    self.__conn_count -= 1
+                    self.notify()
+                raise
+
+        # Note:  date_last_used is left as it was, so that the borrower can tell how long the connection was idle
+        return this_pooled_conn
+
+    @tornado.gen.coroutine
+    def acquire_async(self, user_token=None, session_token=None):
+        # Same as acquire, for callers on the IOLoop thread:  waits (up to SQL_POOL_WAIT_SECONDS) for a connection
+        # to be released without blocking the IOLoop
+        give_up_at = time.time() + SQL_POOL_WAIT_SECONDS
+
+        while True:
+            this_future = tornado.concurrent.Future()
+            this_waiter = (tornado.ioloop.IOLoop.current(), this_future)
+            with self.__condition:
+                # Register before trying, so that a release in between is not missed
+                self.__async_waiters.append(this_waiter)
+
+            try:
+                return self.acquire(user_token=user_token, session_token=session_token)
+            except ThSQLPoolExhaustedError:
+                remaining = give_up_at - time.time()
+                if remaining <= 0:
+                    raise
+
+                try:
+                    yield tornado.gen.with_timeout(datetime.timedelta(seconds=remaining), this_future)
+                except tornado.gen.TimeoutError:
+                    pass
+            finally:
+                with self.__condition:
+                    if this_waiter in self.__async_waiters:
+                        self.__async_waiters.remove(this_waiter)
+
+    def notify(self):
+        # Wake a thread waiting in acquire, and all acquire_async callers (which will retry).  Caller holds
+        # self.__condition.
+        self.__condition.notify()
+
+        this_waiters = self.__async_waiters
+        self.__async_waiters = []
+        for this_io_loop, this_future in this_waiters:
+            this_io_loop.add_callback(ThResourceLoad.resolve_future, this_future)
+
+    def release(self, pooled_conn, discard=False):
+        if pooled_conn is None:
+            return
+
+        if discard or not pooled_conn.sql_conn.connected:
+            self.close_conn(pooled_conn)
+            with self.__condition:
+                self.__conn_count -= 1
+                self.notify()
+        else:
+            pooled_conn.date_last_used = time.time()
+            with self.__condition:
+                self.__idle.append(pooled_conn)
+                self.notify()
+
+    def close_conn(self, pooled_conn):
+        try:
+            if pooled_conn.sql_conn.connected:
+                pooled_conn.sql_conn.close()
+        except Exception as e:
+            self.log('Pool', 'Exception closing SQL connection', e)
+
+    def validate_idle(self, idle_seconds):
+        # Test idle connections that have not been used for more than idle_seconds, discarding any that fail.
+        # Connections are taken out of the idle list while they are being tested, so that they cannot be
+        # borrowed in the meantime.
+        now = time.time()
+
+        with self.__condition:
+            checking = [c for c in self.__idle if now - c.date_last_used > idle_seconds]
+            for this_conn in checking:
+                self.__idle.remove(this_conn)
+
+        bad_count = 0
+        for this_conn in checking:
+            is_ok = False
+            try:
+                if this_conn.sql_conn.connected:
+                    this_conn.sql_conn.execute_non_query('SELECT 1 AS IsOK')
+                    is_ok = True
+            except Exception as e:
+                self.log('Pool', 'Idle SQL connection failed validation', e)
+
+            if not is_ok:
+                bad_count += 1
+
+            self.release(this_conn, discard=not is_ok)
+
+        return len(checking), bad_count
+
+    def close_all(self):
+        with self.__condition:
+            idle = self.__idle
+            self.__idle = []
+            self.__conn_count -= len(idle)
+
+        for this_idle in idle:
+            self.close_conn(this_idle)
+
+
+# -------------------------------------------------
+# Global cached stored procedure parameters
+# -------------------------------------------------
+class ThCachedParams:
+    """Class ThCachedParams is to manage a thread-safe global dictionary of stored procedure parameter lists, as
+    returned by theas.sputilGetParamNames.
+
+    Without this cache, every call to ThStoredProc.refresh_parameter_list() costs an extra round trip to SQL
+    before the real procedure is executed.  Entries expire after PARAM_CACHE_SECONDS, and may be purged
+    explicitly (see ThHandler_PurgeCache).  Hit and miss counters are kept for logging.
+    """
+    _mutex = Lock()
+
+    def lock(self):
+        self._mutex.acquire()
+
+    def unlock(self):
+        self._mutex.release()
+
+    def __init__(self):
+        self.__params = {}
+        self.hits = 0
+        self.misses = 0
+
+    def len(self):
+        return len(self.__params)
+
+    @staticmethod
+    def _key(stored_proc_name):
+        # SQL Server object names are not case sensitive
+        return stored_proc_name.strip().lower()
+
+    def get_params(self, stored_proc_name):
+        this_params = None
+
+        self.lock()
+        try:
+            this_entry = self.__params.get(self._key(stored_proc_name))
+
+            if this_entry is not None and time.time() - this_entry['date_loaded'] < PARAM_CACHE_SECONDS:
+                this_params = this_entry['params']
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.unlock()
+
+        return this_params
+
+    def add_params(self, stored_proc_name, params):
+        if PARAM_CACHE_SECONDS:
+            self.lock()
+            try:
+                self.__params[self._key(stored_proc_name)] = {'params': params, 'date_loaded': time.time()}
+            finally:
+                self.unlock()
+
+    def delete_params(self, stored_proc_name=None, delete_all=False):
+        result = False
+
+        self.lock()
+        try:
+            if delete_all:
+                result = len(self.__params) > 0
+                self.__params.clear()
+            elif stored_proc_name is not None and self._key(stored_proc_name) in self.__params:
+                del self.__params[self._key(stored_proc_name)]
+                result = True
+        finally:
+            self.unlock()
+
+        return result
+
+    def stats_str(self):
+        return 'Cached stored procedure parameter lists: {}  Hits: {}  Misses: {}'.format(
+            len(self.__params), self.hits, self.misses)
+
+
+# -------------------------------------------------
+# Global cached stored procedure results
+# -------------------------------------------------
+class ThCachedResults:
+    """Class ThCachedResults is to manage a thread-safe global dictionary of cached resultsets returned by
+    APIStoredProc and APIAsyncStoredProc stored procedures.
+
+    Caching is enabled per resource by the ResultCacheSeconds column returned by theas.spgetSysWebResources (see
+    ThResource.result_cache_seconds), and should only be used for read-only procedures whose results depend
+    on nothing but their parameters.  Entries are keyed by resource code, stored procedure name and the values of
+    all bound parameters (including @TheasParams), plus the user token unless ResultCachePerUser is 0.  Parameters
+    that do not affect the results but change on every request (such as @Cookies or @HTTPHeaders) make every
+    request a miss:  a resource can list them in a ResultCacheIgnoreParams column (comma separated) to leave them
+    out of the key.  Entries expire after ResultCacheSeconds, and the least recently used entries are evicted to
+    keep the total size of the cached rows under RESULT_CACHE_MAX_SIZE.
+
+    Cached rows are shared by all requests that hit the same entry, and must not be modified.
+    """
+    _mutex = Lock()
+
+    def lock(self):
+        self._mutex.acquire()
+
+    def unlock(self):
+        self._mutex.release()
+
+    def __init__(self):
+        self.__results = collections.OrderedDict()  # in least recently used order
+        self.cache_bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    def len(self):
+        return len(self.__results)
+
+    @staticmethod
+    def make_key(resource, proc, user_token=None):
+        this_ignored = resource.result_cache_ignore_params
+        this_params = tuple(sorted(
+            (this_name, None if this_value is None else str(this_value))
+            for this_name, this_value in proc.parameters.items()
+            if this_name not in this_ignored))
+
+        return (resource.resource_code, proc.stored_proc_name.strip().lower(), this_params,
+                user_token if resource.result_cache_per_user else None)
+
+    def get_results(self, key):
+        this_resultsets = None
+
+        self.lock()
+        try:
+            this_entry = self.__results.get(key)
+
+            if this_entry is not None and this_entry['date_expires'] < time.time():
+                self._remove(key)
+                this_entry = None
+
+            if this_entry is not None:
+                self.__results.move_to_end(key)
+                this_resultsets = this_entry['resultsets']
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.unlock()
+
+        return this_resultsets
+
+    def add_results(self, key, resultsets, cache_seconds):
+        this_size = sum(get_row_size(row) for this_resultset in resultsets for row in this_resultset)
+
+        if this_size > RESULT_CACHE_MAX_SIZE:
+            return
+
+        self.lock()
+        try:
+            if key in self.__results:
+                self._remove(key)
+
+            while self.__results and self.cache_bytes_used + this_size > RESULT_CACHE_MAX_SIZE:
+                # evict least recently used
+                self._remove(next(iter(self.__results)))
+
+            self.__results[key] = {'resultsets': resultsets, 'size': this_size,
+                                   'date_expires': time.time() + cache_seconds}
+            self.cache_bytes_used += this_size
+        finally:
+            self.unlock()
+
+    def _remove(self, key):
+        # Caller must hold the lock
+        this_entry = self.__results.pop(key)
+        self.cache_bytes_used -= this_entry['size']
+
+    def delete_results(self, resource_code=None, delete_all=False):
+        result = False
+
+        self.lock()
+        try:
+            if delete_all:
+                result = len(self.__results) > 0
+                self.__results.clear()
+                self.cache_bytes_used = 0
+            elif resource_code is not None:
+                for this_key in [k for k in self.__results if k[0] == resource_code]:
+                    self._remove(this_key)
+                    result = True
+        finally:
+            self.unlock()
+
+        return result
+
+    def stats_str(self):
+        return 'Cached stored procedure results: {}  Bytes: {:,}  Hits: {}  Misses: {}'.format(
+            len(self.__results), self.cache_bytes_used, self.hits, self.misses)
+
+
+class ThResultsetReader:
+    """Class ThResultsetReader reads the resultsets returned by a stored procedure, either from the SQL connection
+    or (when the results were cached by ThCachedResults) from a list of cached resultsets.
+
+    Iterate over the reader to get the rows of the current resultset, and call nextresult() to move to the next
+    resultset, as with an _mssql connection.  If record is set, rows passed to keep() are added to recorded (a list
+    of lists of rows, one list per resultset) so that they can be added to ThCachedResults afterwards.
+    """
+
+    def __init__(self, sql_conn=None, cached_resultsets=None, record=False):
+        self.sql_conn = sql_conn
+        self.cached_resultsets = cached_resultsets
+        self.resultset_index = 0
+        self.recorded = [[]] if record and cached_resultsets is None else None
+
+    @property
+    def from_cache(self):
+        return self.cached_resultsets is not None
+
+    def __iter__(self):
+        if self.cached_resultsets is not None:
+            if self.resultset_index < len(self.cached_resultsets):
+                return iter(self.cached_resultsets[self.resultset_index])
+            return iter(())
+        return iter(self.sql_conn)
+
+    def keep(self, row):
+        # Record a row of the current resultset (if recording)
+        if self.recorded is not None:
+            self.recorded[-1].append(row)
+
+    def nextresult(self):
+        self.resultset_index += 1
+
+        if self.cached_resultsets is not None:
+            return self.resultset_index < len(self.cached_resultsets)
+
+        result = self.sql_conn.nextresult()
+        if result and self.recorded is not None:
+            self.recorded.append([])
+        return result
+
+
 class ThStoredProc:
     """#Class ThStoredProc is a helper class that wraps _mssql.MSSQLStoredProcedure.
 
@@ -416,14 +1077,12 @@ class ThStoredProc:
         if not FULL_SQL_IS_OK_CHECK:
             return True
         else:
-            self.th_session.log('StoredProc', 'Checking is_ok:', self.stored_proc_name)
             result = self._storedproc is not None and self.connection is not None and self.connection.connected
 
-            if result and FULL_SQL_IS_OK_CHECK:
-                try:
-                    self.connection.execute_non_query('SELECT 1 AS IsOK')
-                except:
-                    result = False
+            if result and self.th_session.sql_conn_needs_check():
+                # Only pay for the extra round trip if the connection has been idle for a while, or after an error
+                self.th_session.log('StoredProc', 'Checking is_ok:', self.stored_proc_name)
+                result = self.th_session.check_sql_conn()
 
             if not result:
                 self.th_session.logged_in = False
@@ -468,6 +1127,17 @@ class ThStoredProc:
 
         if self.parameter_list is not None:
             self.parameter_list = {}
+
+        if self.stored_proc_name is not None and G_cached_params is not None:
+            # Parameter names rarely change, so avoid the extra round trip to SQL if we can
+            cached_params = G_cached_params.get_params(self.stored_proc_name)
+            if cached_params is not None:
+                if self.th_session is not None:
+                    self.th_session.log('StoredProc', 'Parameter list served from cache:', self.stored_proc_name)
+                # Copy, so that the cached dictionary cannot be altered by the caller
+                self.parameter_list = dict(cached_params)
+                return
+
         if self.stored_proc_name is not None and self.th_session is not None and self.th_session.sql_conn is not None and self.th_session.sql_conn.connected:
             try:
                 self.th_session.sql_conn.execute_query(
@@ -479,6 +1149,9 @@ class ThStoredProc:
                     self.parameter_list[row['ParameterName']] = this_param_info
                     # self.parameter_list.append(row['ParameterName'])
 
+                if G_cached_params is not None:
+                    G_cached_params.add_params(self.stored_proc_name, dict(self.parameter_list))
+
             except Exception as e:
                 self.th_session.log('Sessions', '***Error accessing SQL connection', e)
                 self.th_session.sql_conn = None
@@ -489,11 +1162,56 @@ class ThStoredProc:
                 # self.th_session.log('Sessions', '***Cannot automatically log in after failed SQL connection', e.message)
                 raise
 
+    @staticmethod
+    def build_exec_sql(stored_proc_name, parameters):
+        # Build a literal EXEC myproc @Param1='abc', @Param2='def' string.
+        this_sql = 'EXEC ' + stored_proc_name
+
+        # NOTE:  We don't want a SQL injection risk.  (We'd prefer to let the _mssql library
+        # execute the stored procedure and be responsible for escaping parameter values.)
+        # But given the limitations mentioned in execute(), this is not an option at this time.
+        # We must build our own string that performs the EXEC myproc @Param1='abc'.
+        # Our parameter values are already split into separate dictionary items
+        # in parameters.  Now we need to turn each parameter into a string like
+        # @Param1='abc' and concatenate these together.
+        # As long as any single quotes embedded in the parameter values are replaced with
+        # 2 single quotes, and that there are no single quotes at all in parameter names,
+        # we should be safe.
+
+        this_params_str = ''
+
+        for this_name, this_value in parameters.items():
+            if isinstance(this_name, str) and this_name.startswith('@'):
+                # Strip out single quotes from parameter name.  (Shouldn't be any, but we don't
+                # want someone to try to use this as a SQL injection vector.)
+                this_params_str += ' ' + this_name.replace('\'', '') + '='
+
+                # Replace each single quote with two single quotes.  If param value is None
+                # output NULL (with no quotes)
+                this_params_str += '\'' + str(this_value).replace('\'', '\'\'') + '\''\
+                    if this_value is not None else 'NULL'
+
+                this_params_str += ','
+
+        if this_params_str.endswith(','):
+            this_params_str = this_params_str[:-1]
+
+        # Note that we could instead have built the string as '@Param1=%s, @Param2=%s, @Param3=%s'
+        # Then theoretically we could then pass in list(self.parameters.values())
+        # This way _mssql could do the quoting of param values for us, and dwe wouldn't need
+        # to concatenate all the values.  But null values would be a problem
+        # self.th_session.sql_conn.execute_query(
+        #   this_sql + '@Param1=%s, @Param2=%s', list(self.parameters.values()))
+        # (And _mssql substitutes the values into the SQL text on the client anyway, so the server would
+        # still see a different batch for every distinct value.)
+
+        return this_sql + ' ' + this_params_str
+
     def execute(self, fetch_rows=True):
         self.th_session.comments = 'ThStoredProc.execute'
         self.th_session.log('StoredProc', 'Executing:', self.stored_proc_name)
 
-        _mssql.min_error_severity = 1
+        G_sql_driver.set_min_error_severity(1)
         this_result = False
 
         if self.is_ok:
@@ -509,51 +1227,17 @@ class ThStoredProc:
 
                 # this_result = self._storedproc.execute(*args, **kwargs)
 
-                this_sql = 'EXEC ' + self.stored_proc_name
-
-                # NOTE:  We don't want a SQL injection risk.  (We'd prefer to let the _mssql library
-                # execute the stored procedure and be responsible for escaping parameter values.)
-                # But given the limitations mentioned above, this is not an option at this time.
-                # We must build our own string that performs the EXEC myproc @Param1='abc'.
-                # Our parameter values are already split into separate dictionary items
-                # in self.parameters.  Now we need to turn each parameter into a string like
-                # @Param1='abc' and concatenate these together.
-                # As long as any single quotes embedded in the parameter values are replaced with
-                # 2 single quotes, and that there are no single quotes at all in parameter names,
-                # we should be safe.
+                this_sql = ThStoredProc.build_exec_sql(self.stored_proc_name, self.parameters)
 
-                this_params_str = ''
-
-                for this_name, this_value in self.parameters.items():
-                    if isinstance(this_name, str) and this_name.startswith('@'):
-                        # Strip out single quotes from parameter name.  (Shouldn't be any, but we don't
-                        # want someone to try to use this as a SQL injection vector.)
-                        this_params_str += ' ' + this_name.replace('\'', '') + '='
-
-                        # Replace each single quote with two single quotes.  If param value is None
-                        # output NULL (with no quotes)
-                        this_params_str += '\'' + str(this_value).replace('\'', '\'\'') + '\''\
-                            if this_value is not None else 'NULL'
-
-                        this_params_str += ','
-
-                if this_params_str.endswith(','):
-                    this_params_str = this_params_str[:-1]
-
-                # Note that we could instead have built the string as '@Param1=%s, @Param2=%s, @Param3=%s'
-                # Then theoretically we could then pass in list(self.parameters.values())
-                # This way _mssql could do the quoting of param values for us, and dwe wouldn't need
-                # to concatenate all the values.  But null values would be a problem
-                # self.th_session.sql_conn.execute_query(
-                #   this_sql + '@Param1=%s, @Param2=%s', list(self.parameters.values()))
-
-                self.th_session.sql_conn.execute_query(this_sql + ' ' + this_params_str)
+                self.th_session.sql_conn.execute_query(this_sql)
 
                 if fetch_rows:
                     self.resultset = [row for row in self.th_session.sql_conn]
                 self.th_session.do_on_sql_done(self)
                 this_result = True
             except Exception as e:
+                # Make sure the connection is tested before it is used again
+                self.th_session.sql_conn_suspect = True
                 if LOGGING_LEVEL:
                     print(e)
                 raise e
@@ -570,7 +1254,7 @@ class ThStoredProc:
         if self._storedproc is not None:
             if value is None:
                 null = True
-            elif dbtype in (_mssql.SQLCHAR, _mssql.SQLVARCHAR, _mssql.SQLUUID):
+            elif dbtype in (TheasDB.SQLCHAR, TheasDB.SQLVARCHAR, TheasDB.SQLUUID):
                 value = str(value)
 
             this_result = self._storedproc.bind(value, dbtype, param_name=param_name, output=output, null=null,
@@ -607,6 +1291,7 @@ class ThResource:
     """
 
     def __init__(self):
+        self._snapshot_data = None  # (mmap, start, end, is_text) of data in a cache snapshot that has not been read yet
         self.resource_code = ''
         self.filename = ''
         self.filetype = ''
@@ -624,17 +1309,141 @@ class ThResource:
         self.on_before = None
         self.on_after = None
         self.revision = None
+        self.result_cache_seconds = 0  # cache resultsets of api_stored_proc / api_async_stored_proc (see ThCachedResults)
+        self.result_cache_per_user = True
+        self.result_cache_ignore_params = frozenset()  # parameter names left out of the result cache key
+        self.stream_render = False  # send the rendered template in chunks as it is rendered (see STREAM_RENDER)
+        self.cache_size = 0  # bytes counted against MAX_CACHE_SIZE while in ThCachedResources
+        self.hit_count = 0  # number of times served from ThCachedResources
+        self.compressed = {}  # compressed copies of data, by content encoding (i.e. 'gzip', 'br')
+        self.etag = None  # strong ETag of data, set by ThCachedResources (see set_validators)
+        self.content_length = None  # length in bytes of data as sent (i.e. UTF-8 encoded), set by ThCachedResources
+        self.include_source = None  # data before $thInclude_ static blocks were substituted, if it has any
+        self.includes = frozenset()  # names (i.e. thInclude_MyBlock) of the static blocks included in data
+        self.last_modified = None  # naive UTC datetime sent as Last-Modified, set by ThCachedResources
+
+    # Held while data is copied out of a cache snapshot, so that ThCachedResources.close_snapshot cannot close the
+    # snapshot part way through
+    _snapshot_lock = threading.Lock()
+
+    @property
+    def data(self):
+        if self._snapshot_data is not None:
+            # Copy the data out of the memory-mapped cache snapshot (see ThCachedResources.load_snapshot) the
+            # first time it is needed
+            with ThResource._snapshot_lock:
+                self.read_snapshot_data()
+        return self._data
+
+    def read_snapshot_data(self):
+        # Copy data out of the cache snapshot, if it has not been yet.  Caller must hold _snapshot_lock.
+        if self._snapshot_data is not None:
+            this_map, this_start, this_end, this_is_text = self._snapshot_data
+            this_bytes = this_map[this_start:this_end]
+            self._data = str(this_bytes, 'utf-8') if this_is_text else this_bytes
+            self._snapshot_data = None
+
+    @data.setter
+    def data(self, new_data):
+        self._snapshot_data = None
+        self._data = new_data
+
+    @property
+    def data_is_bytes(self):
+        # Whether data is bytes (rather than str), without copying it out of the cache snapshot
+        if self._snapshot_data is not None:
+            return not self._snapshot_data[3]
+        return isinstance(self._data, bytes)
+
+    def get_etag(self, encoding=None):
+        # A strong ETag must be different for each content encoding of the same data
+        if self.etag is None or encoding is None:
+            return self.etag
+        return '{}-{}"'.format(self.etag[:-1], encoding)
+
+    @property
+    def template_key(self):
+        # Key of this resource's compiled template in theas.template_cache.  The ETag (a hash of data, see
+        # ThCachedResources.set_validators) is part of the key, because data can change without a new revision
+        # (e.g. when a static block it includes changes), and a template compiled from the old data may be put in
+        # the cache after it was invalidated.  Without a revision or ETag, the template is keyed by a hash of data.
+        if self.revision is None or self.etag is None:
+            return None
+        return self.resource_code, self.revision, self.etag
+
+    @property
+    def content_type(self):
+        # The Content-Type that ThHandler.get sends for this resource
+        if self.filename:
+            if self.filetype:
+                return self.filetype
+            return theas.Theas.mimetype_for_extension(self.filename)
+        return theas.Theas.mimetype_for_extension(self.resource_code)
 
     def __del__(self):
         self.data = None
 
 
+class ThResourceLoad:
+    """Class ThResourceLoad represents a load of a resource from the database that is in progress.
+
+    Concurrent requests for the same resource wait for this load to finish (see ThCachedResources.load_resource_once
+    and load_resource_once_async) instead of each calling theas.spgetSysWebResources.  Executor threads wait on done.
+    Requests on the IOLoop thread must not block, so they yield a Future from wait_future instead.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.resource = None
+        self.__waiters = []  # (IOLoop, Future) of each waiting IOLoop caller
+        self.__lock = threading.Lock()
+
+    def wait_future(self):
+        # Returns a Future (of the current IOLoop) that is resolved when the load is done
+        this_future = tornado.concurrent.Future()
+
+        with self.__lock:
+            if not self.done.is_set():
+                self.__waiters.append((tornado.ioloop.IOLoop.current(), this_future))
+                return this_future
+
+        this_future.set_result(None)
+        return this_future
+
+    def finish(self, resource):
+        # Called by the loader (on any thread) when the load is done
+        self.resource = resource
+
+        with self.__lock:
+            self.done.set()
+            this_waiters = self.__waiters
+            self.__waiters = []
+
+        # Futures are not thread-safe:  resolve each on its own IOLoop
+        for this_io_loop, this_future in this_waiters:
+            this_io_loop.add_callback(ThResourceLoad.resolve_future, this_future)
+
+    @staticmethod
+    def resolve_future(future):
+        if not future.done():
+            future.set_result(None)
+
+
 class ThCachedResources:
     """Class ThCachedResources is to manage a thread-safe global dictionary for storage of cached web resources
     (see ThResource).
 
     It provides a mutex, and methods for locking and unlocking the global dictionary, as well as methods for
     loading resources, retrieving resources, and deleting resources (i.e. purging cached resources).
+
+    The cache is limited to MAX_CACHE_SIZE bytes.  When adding a resource would exceed this, the least recently
+    used resources are evicted (and will be loaded from the database again the next time they are requested).
+    Resources loaded from files (i.e. Theas.js) cannot be re-loaded on demand, so they are pinned and never
+    evicted.
+
+    Only one load of a given resource from the database is done at a time.  Other requests for the same resource
+    wait for that load to finish, so that purging a popular resource does not result in a flood of identical
+    calls to theas.spgetSysWebResources.
     """
     _mutex = Lock()
 
@@ -645,11 +1454,20 @@ class ThCachedResources:
         self._mutex.release()
 
     def __init__(self):
-        self.__resources = {}
+        self.__resources = collections.OrderedDict()  # in least recently used order
+        self.__pinned = set()
+        self.__loading = {}  # ThResourceLoad of each resource that is being loaded, by resource code
+        self.__include_dependents = {}  # codes of the cached resources that include each static block, by name
+        self.__snapshot_map = None  # memory-mapped cache snapshot that resources were restored from (see load_snapshot)
+        self.__snapshot_resources = weakref.WeakSet()  # resources whose data may still be in __snapshot_map
         self.__static_blocks_dict = {}
         self.__resource_versions_dict = {}
         self.default_path = G_program_options.settings_path
         self.cache_bytes_used = 0
+        self.evictions = 0
+        self.coalesced_loads = 0  # number of requests that waited for another request's load of the same resource
+        self.revision_evictions = 0  # number of resources evicted by refresh_revisions
+        self.background_thread_running = False
 
     def __del__(self):
         self.lock()
@@ -658,8 +1476,8 @@ class ThCachedResources:
             for resource_code in self.__resources:
 
                 this_resource = self.__resources[resource_code]
-                if this_resource.data is not None:
-                    self.cache_bytes_used = self.cache_bytes_used - len(this_resource.data)
+                if this_resource is not None:
+                    self.cache_bytes_used = self.cache_bytes_used - this_resource.cache_size
                 this_resource = None
 
                 self.__resources[resource_code] = None
@@ -703,18 +1521,262 @@ class ThCachedResources:
     def len(self):
         return len(self.__resources)
 
-    def add_resource(self, resource_code, resource_dict):
+    @staticmethod
+    def get_data_size(data):
+        # Number of bytes used by resource data.  For str this is the size of the Python object (which depends on
+        # the widest character in the string), not the length.
+        if data is None:
+            return 0
+        elif isinstance(data, (bytes, bytearray)):
+            return len(data)
+        return sys.getsizeof(data)
+
+    @staticmethod
+    def compress_resource(resource):
+        # Store compressed copies of a resource that is sent to the browser as-is (i.e. is not rendered), so that
+        # ThHandler.get can send whichever one the browser accepts without compressing on every request.
+        resource.compressed = {}
+
+        if not COMPRESS_MIN_SIZE or resource.data is None or resource.render_jinja_template or \
+                resource.api_stored_proc or resource.is_static:
+            return
+
+        this_content_type = resource.content_type.split(';')[0].strip().lower()
+        if not (this_content_type.startswith('text/') or this_content_type.endswith(('+xml', '+json')) or
+                this_content_type in ('application/javascript', 'application/x-javascript', 'application/json',
+                                      'application/xml')):
+            # images, fonts, archives, etc. are already compressed
+            return
+
+        this_data = resource.data
+        if isinstance(this_data, str):
+            this_data = this_data.encode('utf-8')
+
+        if len(this_data) < COMPRESS_MIN_SIZE:
+            return
+
+        this_compressed = gzip.compress(this_data, compresslevel=COMPRESS_GZIP_LEVEL)
+        if len(this_compressed) < len(this_data):
+            resource.compressed['gzip'] = this_compressed
+
+        if brotli is not None:
+            this_compressed = brotli.compress(this_data, quality=COMPRESS_BROTLI_QUALITY)
+            if len(this_compressed) < len(this_data):
+                resource.compressed['br'] = this_compressed
+
+    @staticmethod
+    def set_validators(resource):
+        # Set the ETag (a hash of the content) and Last-Modified date of a resource, so that ThHandler can answer
+        # conditional requests (If-None-Match / If-Modified-Since) with 304 Not Modified.
+        resource.etag = None
+        resource.last_modified = None
+        resource.content_length = None
+
+        if resource.data is None or not resource.exists:
+            return
+
+        this_data = resource.data
+        if isinstance(this_data, str):
+            this_data = this_data.encode('utf-8')
+
+        resource.content_length = len(this_data)
+        resource.etag = '"{}"'.format(hashlib.sha1(this_data).hexdigest())
+
+        if isinstance(resource.date_updated, datetime.datetime):
+            # DateUpdated is in the local time of the SQL server (assumed to be the same as ours) unless it carries
+            # a time zone.  Convert it to naive UTC.
+            this_last_modified = resource.date_updated.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        else:
+            # DateUpdated was not provided:  use the time the resource was cached
+            this_last_modified = datetime.datetime.utcnow()
+
+        # HTTP dates have a resolution of one second
+        resource.last_modified = this_last_modified.replace(microsecond=0)
+
+    def add_resource(self, resource_code, resource_dict, pinned=False, data_size=None):
+        # data_size is given for resources loaded from a cache snapshot, which have already been compressed and
+        # hashed (and whose data has not been read from the snapshot yet)
+        if data_size is None:
+            this_size = self.get_data_size(resource_dict.data)
+        else:
+            this_size = data_size
+
+        if this_size < MAX_CACHE_ITEM_SIZE:
+            if data_size is None:
+                # Compress and hash before taking the lock.  This is done once each time a resource (revision) is
+                # cached.
+                self.compress_resource(resource_dict)
+                self.set_validators(resource_dict)
+            this_size += sum(len(v) for v in resource_dict.compressed.values())
+            if resource_dict.include_source is not None:
+                this_size += self.get_data_size(resource_dict.include_source)
 
-        if resource_dict.data is None or\
-                (len(resource_dict.data) < MAX_CACHE_ITEM_SIZE and self.cache_bytes_used < MAX_CACHE_SIZE):
             self.lock()
             try:
-                self.__resources[resource_code] = resource_dict
-                if resource_dict.data is not None:
-                    self.cache_bytes_used = self.cache_bytes_used + len(resource_dict.data)
+                if resource_code in self.__resources:
+                    self._remove(resource_code)
+
+                if self.cache_bytes_used + this_size > MAX_CACHE_SIZE:
+                    # Evict least recently used resources until the new one fits
+                    for this_code in [c for c in self.__resources if c not in self.__pinned]:
+                        self._remove(this_code)
+                        self.evictions += 1
+                        if self.cache_bytes_used + this_size <= MAX_CACHE_SIZE:
+                            break
+
+                if pinned or self.cache_bytes_used + this_size <= MAX_CACHE_SIZE:
+                    resource_dict.cache_size = this_size
+                    self.__resources[resource_code] = resource_dict
+                    self.cache_bytes_used = self.cache_bytes_used + this_size
+                    if pinned:
+                        self.__pinned.add(resource_code)
+                    for this_name in resource_dict.includes:
+                        self.__include_dependents.setdefault(this_name, set()).add(resource_code)
             finally:
                 self.unlock()
 
+    def _remove(self, resource_code):
+        # Caller must hold the lock
+        this_resource = self.__resources.pop(resource_code)
+        self.__pinned.discard(resource_code)
+        theas.template_cache.invalidate(resource_code)
+        if this_resource is not None:
+            self.cache_bytes_used = self.cache_bytes_used - this_resource.cache_size
+            for this_name in this_resource.includes:
+                this_dependents = self.__include_dependents.get(this_name)
+                if this_dependents is not None:
+                    this_dependents.discard(resource_code)
+                    if not this_dependents:
+                        del self.__include_dependents[this_name]
+
+    INCLUDE_PATTERN = re.compile(r'\$\{?(thInclude_[_a-zA-Z0-9]+)')
+
+    @staticmethod
+    def find_includes(buf):
+        # Returns the names of the static blocks included in buf (i.e. thInclude_MyResourceCode)
+        return frozenset(ThCachedResources.INCLUDE_PATTERN.findall(buf))
+
+    def resolve_includes(self, resource):
+        # Returns resource.include_source with the static blocks it includes substituted
+        this_static_blocks = self.static_blocks_dict
+        return string.Template(resource.include_source).safe_substitute(
+            dict((this_name, this_static_blocks[this_name])
+                 for this_name in resource.includes if this_name in this_static_blocks))
+
+    def update_static_blocks(self, new_static_blocks):
+        # Replace the static blocks, and substitute the changed blocks into the cached resources that include them
+        # (using the include dependency index, see add_resource).  No other resources are touched.
+        # Returns the number of resources that were updated.
+        old_static_blocks = self.static_blocks_dict
+        if not isinstance(old_static_blocks, dict):
+            old_static_blocks = {}
+
+        ThCachedResources.static_blocks_dict = new_static_blocks
+
+        changed_names = [this_name for this_name in set(old_static_blocks) | set(new_static_blocks)
+                         if old_static_blocks.get(this_name) != new_static_blocks.get(this_name)]
+
+        self.lock()
+        try:
+            this_dependents = set()
+            for this_name in changed_names:
+                this_dependents.update(self.__include_dependents.get(this_name, ()))
+            this_resources = [self.__resources[this_code] for this_code in this_dependents
+                              if this_code in self.__resources]
+        finally:
+            self.unlock()
+
+        for this_resource in this_resources:
+            # Cache a copy, so that requests that are using the old resource are not affected
+            this_new_resource = copy.copy(this_resource)
+            this_new_resource.data = self.resolve_includes(this_resource)
+            this_new_resource.hit_count = 0
+            self.add_resource(this_new_resource.resource_code, this_new_resource)
+
+        if this_resources:
+            ThSession.cls_log('Resource', 'Static blocks changed:  updated resources that include them',
+                              ', '.join(this_resource.resource_code for this_resource in this_resources))
+
+        return len(this_resources)
+
+    @staticmethod
+    def new_loader_session():
+        # Create a sessionless ThSession for loading resources, authenticated as the AUTO user (i.e. public) if
+        # LOGIN_AUTO_USER_TOKEN is configured.
+        th_session = ThSession(None, sessionless=True)
+        if LOGIN_AUTO_USER_TOKEN and not th_session.logged_in and not th_session.autologged_in:
+            th_session.log('Auth', 'Authenticating as AUTO user (i.e. public)')
+            try:
+                th_session.authenticate(user_token=LOGIN_AUTO_USER_TOKEN)
+            except:
+                th_session.autologged_in = False
+
+            if not th_session.autologged_in:
+                th_session.log('Auth',
+                               'Error: Authentication as AUTO user (i.e. public) FAILED for loading resources.  Is your config file wrong?')
+                th_session.log('Auth', 'Bad AUTO user token: {}'.format(LOGIN_AUTO_USER_TOKEN))
+        return th_session
+
+    @staticmethod
+    def resource_from_row(row, all_static_blocks=False):
+        # Build a ThResource from a row returned by theas.spgetSysWebResources
+        buf = row['ResourceText']
+        if not buf:
+            buf = row['ResourceData']
+            if buf:
+                buf = bytes(buf)
+
+        this_resource = ThResource()
+
+        if isinstance(buf, str) and not all_static_blocks and '$thInclude_' in buf:
+            # Perform replacement of includes.  Template may include string like:
+            # $thInclude_MyResourceCode
+            # This will be replaced with the static block resource having a ResourceCode=MyResourceCode
+            # The original is kept so that the includes can be replaced again when a static block changes.
+            this_resource.include_source = buf
+            this_resource.includes = ThCachedResources.find_includes(buf)
+            buf = G_cached_resources.resolve_includes(this_resource)
+
+        this_resource.resource_code = row['ResourceCode']
+        this_resource.filename = row['Filename']
+        if 'Filetype' in row:
+            this_resource.filetype = row['Filetype']
+        if 'DateUpdated' in row:
+            this_resource.date_updated = row['DateUpdated']
+        this_resource.data = buf
+        this_resource.api_stored_proc = row['APIStoredProc']
+        this_resource.api_async_stored_proc = row['APIAsyncStoredProc']
+        this_resource.api_stored_proc_resultset_str = row['ResourceResultsets']
+        this_resource.is_public = row['IsPublic']
+        this_resource.is_static = row['IsStaticBlock']
+        this_resource.requires_authentication = row['RequiresAuthentication']
+        this_resource.render_jinja_template = row['RenderJinjaTemplate']
+        this_resource.skip_xsrf = row['SkipXSRF']
+
+        if 'OnBefore' in row:
+            this_resource.on_before = row['OnBefore']
+
+        if 'OnAfter' in row:
+            this_resource.on_after = row['OnAfter']
+
+        if 'Revision' in row:
+            this_resource.revision = row['Revision']
+
+        if 'ResultCacheSeconds' in row and row['ResultCacheSeconds']:
+            this_resource.result_cache_seconds = int(row['ResultCacheSeconds'])
+
+        if 'ResultCachePerUser' in row and row['ResultCachePerUser'] is not None:
+            this_resource.result_cache_per_user = bool(row['ResultCachePerUser'])
+
+        if 'ResultCacheIgnoreParams' in row and row['ResultCacheIgnoreParams']:
+            this_resource.result_cache_ignore_params = frozenset(
+                this_name.strip() for this_name in row['ResultCacheIgnoreParams'].split(',') if this_name.strip())
+
+        if 'StreamRender' in row:
+            this_resource.stream_render = bool(row['StreamRender'])
+
+        return this_resource
+
     def load_resource(self, resource_code, th_session, all_static_blocks=False, sessionless=False, from_filename=None,
                       is_public=False, is_static=False, get_default_resource=False):
         this_resource = None
@@ -743,7 +1805,7 @@ class ThCachedResources:
                 this_resource.requires_authentication = False
                 this_resource.revision = THEAS_VERSION_INT  # use Theas version
 
-                self.add_resource(resource_code, this_resource)
+                self.add_resource(resource_code, this_resource, pinned=True)
 
             else:
                 raise TheasServerError(
@@ -755,18 +1817,7 @@ class ThCachedResources:
                 if not sessionless:
                     assert th_session is not None, 'ThCachedResources: load_resource called without a valid session'
                 else:
-                    th_session = ThSession(None, sessionless=True)
-                    if LOGIN_AUTO_USER_TOKEN and not th_session.logged_in and not th_session.autologged_in:
-                        th_session.log('Auth', 'Authenticating as AUTO user (i.e. public)')
-                        try:
-                            th_session.authenticate(user_token=LOGIN_AUTO_USER_TOKEN)
-                        except:
-                            th_session.autologged_in = False
-
-                        if not th_session.autologged_in:
-                            th_session.log('Auth',
-                                     'Error: Authentication as AUTO user (i.e. public) FAILED for loading all_static_blocks.  Is your config file wrong?')
-                            th_session.log('Auth', 'Bad AUTO user token: {}'.format(LOGIN_AUTO_USER_TOKEN))
+                    th_session = self.new_loader_session()
                     resource_code = None
 
             if all_static_blocks:
@@ -791,11 +1842,11 @@ class ThCachedResources:
                 # unnecessary overhead.
                 # this_proc.refresh_parameter_list()
 
-                this_proc.bind(resource_code, _mssql.SQLCHAR, '@ResourceCode', null=(resource_code is None))
-                this_proc.bind(str(int(all_static_blocks)), _mssql.SQLCHAR, '@AllStaticBlocks')
+                this_proc.bind(resource_code, TheasDB.SQLCHAR, '@ResourceCode', null=(resource_code is None))
+                this_proc.bind(str(int(all_static_blocks)), TheasDB.SQLCHAR, '@AllStaticBlocks')
 
                 # if '@GetDefaultResource' in this_proc.parameter_list:
-                this_proc.bind(str(int(get_default_resource)), _mssql.SQLCHAR, '@GetDefaultResource')
+                this_proc.bind(str(int(get_default_resource)), TheasDB.SQLCHAR, '@GetDefaultResource')
 
                 proc_result = this_proc.execute(fetch_rows=False)
                 assert proc_result, 'ThCachedResources.load_resource received error result from call to theas.spgetSysWebResources in the SQL database.'
@@ -807,45 +1858,8 @@ class ThCachedResources:
                 if this_proc.th_session.sql_conn is not None:
                     for row in this_proc.th_session.sql_conn:
                         row_count += 1
-                        buf = row['ResourceText']
-                        if not buf:
-                            buf = row['ResourceData']
-                            if buf:
-                                buf = bytes(buf)
-
-                        elif not all_static_blocks and buf and '$thInclude_' in buf:
-                            # Perform replacement of includes.  Template may include string like:
-                            # $thInclude_MyResourceCode
-                            # This will be replaced with the static block resource having a ResourceCode=MyResourceCode
-                            tmp = string.Template(buf)
-                            buf = tmp.safe_substitute(G_cached_resources.static_blocks_dict)
-
-                        this_resource = ThResource()
-
-                        this_resource.resource_code = row['ResourceCode']
-                        this_resource.filename = row['Filename']
-                        if 'Filetype' in row:
-                            this_resource.filetype = row['Filetype']
-                        if 'DateUpdated' in row:
-                            this_resource.date_updated = row['DateUpdated']
-                        this_resource.data = buf
-                        this_resource.api_stored_proc = row['APIStoredProc']
-                        this_resource.api_async_stored_proc = row['APIAsyncStoredProc']
-                        this_resource.api_stored_proc_resultset_str = row['ResourceResultsets']
-                        this_resource.is_public = row['IsPublic']
-                        this_resource.is_static = row['IsStaticBlock']
-                        this_resource.requires_authentication = row['RequiresAuthentication']
-                        this_resource.render_jinja_template = row['RenderJinjaTemplate']
-                        this_resource.skip_xsrf = row['SkipXSRF']
-
-                        if 'OnBefore' in row:
-                            this_resource.on_before = row['OnBefore']
-
-                        if 'OnAfter' in row:
-                            this_resource.on_after = row['OnAfter']
-
-                        if 'Revision' in row:
-                            this_resource.revision = row['Revision']
+                        this_resource = self.resource_from_row(row, all_static_blocks)
+                        buf = this_resource.data
 
                         if this_resource.resource_code and not this_resource.resource_code in('~', '/', ''):
                             # added 2/11/2019:  don't want to cache default resource
@@ -864,7 +1878,7 @@ class ThCachedResources:
                     self.add_resource(resource_code, this_resource)
 
                 if all_static_blocks:
-                    ThCachedResources.static_blocks_dict = this_static_blocks_dict
+                    self.update_static_blocks(this_static_blocks_dict)
 
                     have_next_resultset = this_proc.th_session.sql_conn.nextresult()
                     if have_next_resultset:
@@ -880,6 +1894,125 @@ class ThCachedResources:
 
         return this_resource
 
+    def begin_load(self, resource_code):
+        # Returns (the cached resource, None, False) if resource_code is now cached, (None, this_load, False) if it is
+        # being loaded by another request, or (None, this_load, True) if the caller is to load it (and call end_load)
+        this_resource = None
+        this_load = None
+        is_loader = False
+
+        self.lock()
+        try:
+            # The resource may have been cached since the caller checked
+            this_resource = self.__resources.get(resource_code)
+            if this_resource is None:
+                this_load = self.__loading.get(resource_code)
+                if this_load is None:
+                    this_load = ThResourceLoad()
+                    self.__loading[resource_code] = this_load
+                    is_loader = True
+                else:
+                    self.coalesced_loads += 1
+        finally:
+            self.unlock()
+
+        return this_resource, this_load, is_loader
+
+    def end_load(self, resource_code, this_load, this_resource):
+        self.lock()
+        try:
+            self.__loading.pop(resource_code, None)
+        finally:
+            self.unlock()
+        this_load.finish(this_resource)
+
+    @staticmethod
+    def is_coalesced(resource_code, all_static_blocks, get_default_resource):
+        # The default resource depends on the session, and is not cached, so its loads are not shared
+        return not (resource_code is None or resource_code == '~' or all_static_blocks or get_default_resource)
+
+    def load_resource_once(self, resource_code, th_session, all_static_blocks=False, get_default_resource=False):
+        # Load a resource from the database, unless another request is already loading the same resource, in which
+        # case wait for that load to finish and use its result.
+        # For executor threads (and callers that cannot yield).  Waiting blocks the calling thread, so on the
+        # IOLoop thread this does not wait, but loads the resource itself.  (See load_resource_once_async)
+        if not ThCachedResources.is_coalesced(resource_code, all_static_blocks, get_default_resource):
+            return self.load_resource(resource_code, th_session, all_static_blocks,
+                                      get_default_resource=get_default_resource)
+
+        this_resource, this_load, is_loader = self.begin_load(resource_code)
+
+        if this_resource is not None:
+            return this_resource
+
+        if is_loader:
+            try:
+                this_resource = self.load_resource(resource_code, th_session, all_static_blocks,
+                                                   get_default_resource=get_default_resource)
+            finally:
+                self.end_load(resource_code, this_load, this_resource)
+
+            return this_resource
+
+        if tornado.ioloop.IOLoop.current(instance=False) is None:
+            th_session.log('Resource', 'Waiting for concurrent load of', resource_code)
+
+            if this_load.done.wait(G_program_options.sql_timeout or None) and \
+                    this_load.resource is not None and this_load.resource.exists:
+                return this_load.resource
+
+        # The other load failed, timed out, or found nothing (which may be due to that session's permissions), or
+        # we cannot wait:  load for this session
+        return self.load_resource(resource_code, th_session, all_static_blocks,
+                                  get_default_resource=get_default_resource)
+
+    @tornado.gen.coroutine
+    def load_resource_once_async(self, resource_code, th_session, all_static_blocks=False,
+                                 get_default_resource=False):
+        # Same as load_resource_once, for callers on the IOLoop thread:  the resource is loaded on an executor thread,
+        # and callers that are waiting for another request's load yield a Future rather than blocking the IOLoop.
+        if not ThCachedResources.is_coalesced(resource_code, all_static_blocks, get_default_resource):
+            this_resource = yield ThHandler.executor.submit(self.load_resource, resource_code, th_session,
+                                                            all_static_blocks,
+                                                            get_default_resource=get_default_resource)
+            return this_resource
+
+        this_resource, this_load, is_loader = self.begin_load(resource_code)
+
+        if this_resource is not None:
+            return this_resource
+
+        if is_loader:
+            try:
+                this_resource = yield ThHandler.executor.submit(self.load_resource, resource_code, th_session,
+                                                                all_static_blocks,
+                                                                get_default_resource=get_default_resource)
+            finally:
+                self.end_load(resource_code, this_load, this_resource)
+
+            return this_resource
+
+        th_session.log('Resource', 'Waiting for concurrent load of', resource_code)
+
+        try:
+            if G_program_options.sql_timeout:
+                yield tornado.gen.with_timeout(datetime.timedelta(seconds=G_program_options.sql_timeout),
+                                               this_load.wait_future())
+            else:
+                yield this_load.wait_future()
+        except tornado.gen.TimeoutError:
+            pass
+
+        if this_load.done.is_set() and this_load.resource is not None and this_load.resource.exists:
+            return this_load.resource
+
+        # The other load failed, timed out, or found nothing (which may be due to that session's permissions):
+        # load for this session
+        this_resource = yield ThHandler.executor.submit(self.load_resource, resource_code, th_session,
+                                                        all_static_blocks,
+                                                        get_default_resource=get_default_resource)
+        return this_resource
+
     def delete_resource(self, resource_code=None, delete_all=False):
         result = False
 
@@ -887,6 +2020,10 @@ class ThCachedResources:
             self.lock()
             try:
                 self.__resources.clear()
+                self.__pinned.clear()
+                self.__include_dependents.clear()
+                self.cache_bytes_used = 0
+                theas.template_cache.invalidate(invalidate_all=True)
                 result = True
             finally:
                 self.unlock()
@@ -896,9 +2033,9 @@ class ThCachedResources:
         elif resource_code is not None and resource_code in self.__resources:
             self.lock()
             try:
-                self.__resources[resource_code] = None
-                del self.__resources[resource_code]
-                result = True
+                if resource_code in self.__resources:
+                    self._remove(resource_code)
+                    result = True
             finally:
                 self.unlock()
 
@@ -906,10 +2043,37 @@ class ThCachedResources:
 
     def get_resource(self, resource_code, th_session, for_public_use=False, all_static_blocks=False,
                      none_if_not_found=True, get_default_resource=False, from_file=None):
-        global DEFAULT_RESOURCE_CODE
+        resource_code, get_default_resource = self.resolve_resource_code(resource_code, th_session,
+                                                                         get_default_resource)
 
-        this_resource = None
+        this_resource = self.get_cached_resource(resource_code, th_session)
+
+        if this_resource is None and th_session is not None:
+            # Load resource (which requires a session)
+            this_resource = self.load_resource_once(resource_code, th_session, all_static_blocks,
+                                                    get_default_resource=get_default_resource)
 
+        return self.got_resource(this_resource, resource_code, th_session, for_public_use=for_public_use)
+
+    @tornado.gen.coroutine
+    def get_resource_async(self, resource_code, th_session, for_public_use=False, all_static_blocks=False,
+                           none_if_not_found=True, get_default_resource=False):
+        # Same as get_resource, for callers on the IOLoop thread:  a resource that is not cached is loaded on an
+        # executor thread, and other requests for the same resource wait for that load without blocking the IOLoop
+        resource_code, get_default_resource = self.resolve_resource_code(resource_code, th_session,
+                                                                         get_default_resource)
+
+        this_resource = self.get_cached_resource(resource_code, th_session)
+
+        if this_resource is None and th_session is not None:
+            # Load resource (which requires a session)
+            this_resource = yield self.load_resource_once_async(resource_code, th_session, all_static_blocks,
+                                                                get_default_resource=get_default_resource)
+
+        return self.got_resource(this_resource, resource_code, th_session, for_public_use=for_public_use)
+
+    def resolve_resource_code(self, resource_code, th_session, get_default_resource):
+        # Returns the resource code to look up (and get_default_resource) for a requested resource_code
         if resource_code:
             resource_code = resource_code.strip()
         else:
@@ -922,19 +2086,32 @@ class ThCachedResources:
                 resource_code = '~'
                 get_default_resource = True
 
+        return resource_code, get_default_resource
+
+    def get_cached_resource(self, resource_code, th_session):
+        this_resource = None
+
         if resource_code is not None and resource_code in self.__resources:
             # Cached resource
-            this_resource = self.__resources[resource_code]
+            self.lock()
+            try:
+                this_resource = self.__resources.get(resource_code)
+                if this_resource is not None:
+                    self.__resources.move_to_end(resource_code)
+                    this_resource.hit_count += 1
+            finally:
+                self.unlock()
+
+        if this_resource is not None:
             if th_session is not None:
                 th_session.log('Resource', 'Serving from cache', resource_code)
             else:
                 ThSession.cls_log('Resource', 'Serving from cache', resource_code)
-        else:
-            if th_session is not None:
-                # Load resource (which requires a session)
-                this_resource = self.load_resource(resource_code, th_session, all_static_blocks,
-                                                   get_default_resource=get_default_resource)
 
+        return this_resource
+
+    def got_resource(self, this_resource, resource_code, th_session, for_public_use=False):
+        # Logs a resource that could not be loaded, and updates the session's current resource
         log_msg = None
 
         if th_session is not None and (this_resource is None or not this_resource.exists):
@@ -971,10 +2148,464 @@ class ThCachedResources:
 
         return this_resource
 
+    def stats_str(self, top_count=5):
+        self.lock()
+        try:
+            this_top = sorted(self.__resources.values(), key=lambda r: r.hit_count, reverse=True)[:top_count]
+            this_top_str = ', '.join('{}={}'.format(r.resource_code, r.hit_count) for r in this_top)
+            result = 'Cached resources: {}  Bytes: {:,}  Evictions: {}  Revision evictions: {}  Coalesced loads: {}  ' \
+                     'Most hits: {}'.format(len(self.__resources), self.cache_bytes_used, self.evictions,
+                                            self.revision_evictions, self.coalesced_loads, this_top_str)
+        finally:
+            self.unlock()
+        return result
+
     def load_global_resources(self):
         self.load_resource('Theas.js', None, from_filename=self.default_path + 'Theas.js', is_public=True)
         self.load_resource(None, None, all_static_blocks=True, sessionless=True)
 
+    def warm_up(self, connection_count=1):
+        # Load all public resources and templates listed in the map of current resource revisions
+        # (JSON_CurResourceRevisions, see load_global_resources) into the cache, using connection_count
+        # connections in parallel.  Returns the number of resources that were cached.
+        this_versions = ThCachedResources.resource_versions_dict
+        if not isinstance(this_versions, dict):
+            ThSession.cls_log('WarmUp', 'Cannot warm up the cache:  theas.spgetSysWebResources did not return '
+                                        'JSON_CurResourceRevisions')
+            return 0
+
+        start_time = time.perf_counter()
+
+        resource_codes = [this_code for this_code in this_versions
+                          if this_code and this_code not in ('~', '/') and this_code not in self.__resources]
+
+        connection_count = max(1, min(connection_count, len(resource_codes)))
+        this_batches = [resource_codes[i::connection_count] for i in range(connection_count)]
+
+        if len(this_batches) == 1:
+            loaded_counts = [self._warm_up_batch(this_batches[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(this_batches)) as this_executor:
+                loaded_counts = list(this_executor.map(self._warm_up_batch, this_batches))
+
+        loaded_count = sum(loaded_counts)
+
+        ThSession.cls_log('WarmUp', 'Cached {} of {} resources using {} SQL connection(s) in {:.3f} seconds'.format(
+            loaded_count, len(resource_codes), len(this_batches), time.perf_counter() - start_time))
+
+        return loaded_count
+
+    def _warm_up_batch(self, resource_codes):
+        # Load the given resources with a single batch of EXEC theas.spgetSysWebResources statements on one
+        # connection, streaming through the resultsets.  Only public resources and templates are cached.
+        loaded_count = 0
+
+        if not resource_codes:
+            return loaded_count
+
+        th_session = self.new_loader_session()
+
+        try:
+            th_session.init_session()
+
+            if th_session.sql_conn is None:
+                ThSession.cls_log('WarmUp', 'Cannot warm up the cache:  no SQL connection')
+                return loaded_count
+
+            this_sql = build_sql_batch(
+                ThStoredProc.build_exec_sql('theas.spgetSysWebResources', {
+                    '@ResourceCode': this_code,
+                    '@AllStaticBlocks': '0',
+                    '@GetDefaultResource': '0'})
+                for this_code in resource_codes)
+
+            th_session.sql_conn.execute_query(this_sql)
+
+            have_resultset = True
+            while have_resultset:
+                for row in th_session.sql_conn:
+                    if 'ResourceCode' not in row or 'ResourceText' not in row:
+                        # not a resultset of resources
+                        break
+
+                    this_resource = self.resource_from_row(row)
+
+                    if this_resource.resource_code and this_resource.resource_code not in ('~', '/') and \
+                            not this_resource.is_static and \
+                            (this_resource.is_public or this_resource.render_jinja_template):
+                        self.add_resource(this_resource.resource_code, this_resource)
+                        loaded_count += 1
+
+                have_resultset = th_session.sql_conn.nextresult()
+
+        except (Exception, TheasServerError) as e:
+            ThSession.cls_log('WarmUp', 'Error while warming up the cache', e)
+
+        finally:
+            th_session.close_sql_conn()
+
+        return loaded_count
+
+    SNAPSHOT_MAGIC = b'THEASCACHE1\n'
+    SNAPSHOT_ATTRIBUTES = ('resource_code', 'filename', 'filetype', 'api_stored_proc', 'api_async_stored_proc',
+                           'api_stored_proc_resultset_str', 'is_public', 'is_static', 'requires_authentication',
+                           'render_jinja_template', 'skip_xsrf', 'on_before', 'on_after', 'revision',
+                           'result_cache_seconds', 'result_cache_per_user', 'stream_render', 'etag',
+                           'content_length', 'include_source')
+
+    def save_snapshot(self, filename):
+        # Write the cached resources (data, compressed copies and metadata) and the map of resource revisions to
+        # filename, so that load_snapshot can restore them when the server is restarted.
+        # The file consists of SNAPSHOT_MAGIC, the length of the JSON index (8 bytes), the JSON index, and then
+        # the data of each resource.
+        # Only public resources that do not require authentication are saved.  Pinned resources (loaded from files)
+        # and static blocks (loaded by load_global_resources) are not saved.
+        self.lock()
+        try:
+            this_resources = [this_resource for this_code, this_resource in self.__resources.items()
+                              if this_code not in self.__pinned and this_resource.exists and
+                              this_resource.is_public and not this_resource.requires_authentication and
+                              not this_resource.is_static and this_resource.data is not None]
+        finally:
+            self.unlock()
+
+        this_blobs = []
+        this_offset = 0
+        this_entries = []
+
+        for this_resource in this_resources:
+            this_entry = dict((this_attr, getattr(this_resource, this_attr))
+                              for this_attr in ThCachedResources.SNAPSHOT_ATTRIBUTES)
+
+            for this_attr in ('date_updated', 'last_modified'):
+                this_value = getattr(this_resource, this_attr)
+                this_entry[this_attr] = this_value.isoformat() if isinstance(this_value, datetime.datetime) else None
+
+            this_entry['result_cache_ignore_params'] = sorted(this_resource.result_cache_ignore_params)
+
+            this_data = this_resource.data
+            this_is_text = isinstance(this_data, str)
+            this_entry['data_size'] = self.get_data_size(this_data)
+            if this_is_text:
+                this_data = this_data.encode('utf-8')
+
+            this_entry['data'] = [this_offset, len(this_data), this_is_text]
+            this_blobs.append(this_data)
+            this_offset += len(this_data)
+
+            this_entry['compressed'] = {}
+            for this_encoding, this_compressed in this_resource.compressed.items():
+                this_entry['compressed'][this_encoding] = [this_offset, len(this_compressed)]
+                this_blobs.append(this_compressed)
+                this_offset += len(this_compressed)
+
+            this_entries.append(this_entry)
+
+        this_revisions = ThCachedResources.resource_versions_dict
+        this_index = json.dumps({
+            'revisions': this_revisions if isinstance(this_revisions, dict) else None,
+            'resources': this_entries
+        }, default=str).encode('utf-8')
+
+        # The old snapshot cannot be replaced while it is memory-mapped (on Windows)
+        self.close_snapshot()
+
+        # Write to a new file and then replace the old one, so that a partially-written snapshot is never loaded
+        this_temp_filename = filename + '.tmp'
+        with open(this_temp_filename, 'wb') as f:
+            f.write(ThCachedResources.SNAPSHOT_MAGIC)
+            f.write(struct.pack('<Q', len(this_index)))
+            f.write(this_index)
+            for this_blob in this_blobs:
+                f.write(this_blob)
+
+        os.replace(this_temp_filename, filename)
+
+        return len(this_entries)
+
+    def load_snapshot(self, filename):
+        # Restore the cached resources saved by save_snapshot.  Only resources whose revision matches the current
+        # map of resource revisions (see load_global_resources) are restored.  Stale resources are left to be
+        # loaded from the database as usual.
+        # The file is memory-mapped, and the data of each resource is not copied out of it until it is first
+        # used, so resources that are never requested do not use any memory.  (See close_snapshot)
+        # Returns the number of resources restored.
+        this_versions = ThCachedResources.resource_versions_dict
+        if not isinstance(this_versions, dict):
+            ThSession.cls_log('Snapshot', 'Cannot use cache snapshot:  theas.spgetSysWebResources did not return '
+                                          'JSON_CurResourceRevisions')
+            return 0
+
+        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+            return 0
+
+        with open(filename, 'rb') as f:
+            this_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Note:  slicing this_map copies, so that (unlike a memoryview) no references into the map remain, and
+        # close_snapshot can always close it
+        this_header_size = len(ThCachedResources.SNAPSHOT_MAGIC) + 8
+        if this_map[:len(ThCachedResources.SNAPSHOT_MAGIC)] != ThCachedResources.SNAPSHOT_MAGIC:
+            ThSession.cls_log('Snapshot', 'Ignoring cache snapshot {}:  not a Theas cache snapshot'.format(filename))
+            this_map.close()
+            return 0
+
+        self.close_snapshot()
+        self.__snapshot_map = this_map
+
+        this_index_size = struct.unpack('<Q', this_map[len(ThCachedResources.SNAPSHOT_MAGIC):this_header_size])[0]
+        this_index = json.loads(str(this_map[this_header_size:this_header_size + this_index_size], 'utf-8'))
+        this_data_start = this_header_size + this_index_size
+
+        loaded_count = 0
+        stale_count = 0
+
+        for this_entry in this_index['resources']:
+            this_code = this_entry['resource_code']
+
+            if this_code not in this_versions or \
+                    str(this_versions[this_code].get('Revision')) != str(this_entry['revision']):
+                stale_count += 1
+                continue
+
+            if this_code in self.__resources:
+                continue
+
+            this_resource = ThResource()
+            for this_attr in ThCachedResources.SNAPSHOT_ATTRIBUTES:
+                if this_attr in this_entry:
+                    setattr(this_resource, this_attr, this_entry[this_attr])
+
+            this_resource.result_cache_ignore_params = frozenset(this_entry.get('result_cache_ignore_params', ()))
+
+            if this_entry['date_updated']:
+                this_resource.date_updated = datetime.datetime.fromisoformat(this_entry['date_updated'])
+            if this_entry['last_modified']:
+                this_resource.last_modified = datetime.datetime.fromisoformat(this_entry['last_modified'])
+
+            if this_resource.include_source is not None:
+                # Substitute the current static blocks, which may have changed since the snapshot was saved
+                this_resource.includes = ThCachedResources.find_includes(this_resource.include_source)
+                this_resource.data = self.resolve_includes(this_resource)
+                self.add_resource(this_code, this_resource)
+                loaded_count += 1
+                continue
+
+            this_offset, this_length, this_is_text = this_entry['data']
+            this_resource._snapshot_data = (
+                this_map, this_data_start + this_offset, this_data_start + this_offset + this_length, this_is_text)
+            self.__snapshot_resources.add(this_resource)
+
+            # Compressed copies are small, and are written as-is, so they are copied now
+            for this_encoding, (this_offset, this_length) in this_entry['compressed'].items():
+                this_resource.compressed[this_encoding] = \
+                    this_map[this_data_start + this_offset:this_data_start + this_offset + this_length]
+
+            self.add_resource(this_code, this_resource, data_size=this_entry['data_size'])
+            loaded_count += 1
+
+        ThSession.cls_log('Snapshot', 'Restored {} cached resources from {} ({} stale)'.format(
+            loaded_count, filename, stale_count))
+
+        return loaded_count
+
+    def close_snapshot(self):
+        # Copy the data that has not yet been read out of the memory-mapped cache snapshot (see load_snapshot), and
+        # close it, so that the file can be replaced.  This includes resources that are no longer cached but may
+        # still be in use by requests.
+        if self.__snapshot_map is None:
+            return
+
+        with ThResource._snapshot_lock:
+            for this_resource in list(self.__snapshot_resources):
+                this_resource.read_snapshot_data()
+
+            self.__snapshot_map.close()
+            self.__snapshot_map = None
+            self.__snapshot_resources = weakref.WeakSet()
+
+    def refresh_revisions(self, th_session=None):
+        # Reload the static blocks and the map of current resource revisions (JSON_CurResourceRevisions) that is
+        # used for cache busting, and evict cached resources whose revision has changed.  Evicted resources are
+        # loaded again the next time they are requested.
+        # th_session is the loader session to use (see new_loader_session).  If None, a new one is used and its
+        # connection is closed afterwards.
+        # Returns the list of resource codes that were evicted.
+        old_versions = ThCachedResources.resource_versions_dict
+
+        if th_session is None:
+            this_session = self.new_loader_session()
+            try:
+                self.load_resource(None, this_session, all_static_blocks=True)
+            finally:
+                this_session.close_sql_conn()
+        else:
+            self.load_resource(None, th_session, all_static_blocks=True)
+
+        new_versions = ThCachedResources.resource_versions_dict
+
+        if new_versions is old_versions or not isinstance(new_versions, dict):
+            # spgetSysWebResources did not return revisions
+            return []
+
+        if not isinstance(old_versions, dict):
+            old_versions = {}
+
+        changed_codes = []
+
+        self.lock()
+        try:
+            for this_code in list(self.__resources):
+                if this_code in self.__pinned:
+                    continue
+
+                this_resource = self.__resources[this_code]
+                this_new_revision = new_versions.get(this_code, {}).get('Revision')
+                this_old_revision = old_versions.get(this_code, {}).get('Revision')
+
+                if this_code in new_versions:
+                    if this_resource.revision is not None:
+                        this_changed = str(this_resource.revision) != str(this_new_revision)
+                    else:
+                        this_changed = this_code in old_versions and this_old_revision != this_new_revision
+                else:
+                    # The resource has been deleted
+                    this_changed = this_code in old_versions
+
+                if this_changed:
+                    self._remove(this_code)
+                    changed_codes.append(this_code)
+
+            self.revision_evictions += len(changed_codes)
+        finally:
+            self.unlock()
+
+        return changed_codes
+
+    def _poll_revisions(self):
+        global G_server_is_running
+
+        last_poll = datetime.datetime.now()
+
+        # One loader session is reused by every poll.  A pooled connection is returned to the pool between polls.
+        th_session = None
+
+        try:
+            while self.background_thread_running and G_server_is_running:
+                if (datetime.datetime.now() - last_poll).total_seconds() > REVISION_POLL_SECONDS:
+                    last_poll = datetime.datetime.now()
+                    try:
+                        if th_session is None:
+                            th_session = self.new_loader_session()
+
+                        changed_codes = self.refresh_revisions(th_session)
+                        if changed_codes:
+                            ThSession.cls_log('PollRevisions', 'Evicted changed resources', ', '.join(changed_codes))
+
+                        th_session.release_sql_conn()
+                    except Exception as e:
+                        ThSession.cls_log('PollRevisions', 'Error refreshing resource revisions', e)
+
+                        # Start over with a new session (and connection) next time
+                        if th_session is not None:
+                            th_session.close_sql_conn()
+                            th_session = None
+                time.sleep(3)  # sleep only for 3 seconds so the application can shutdown cleanly when needed
+        finally:
+            if th_session is not None:
+                th_session.close_sql_conn()
+
+    def start_revision_thread(self):
+        if REVISION_POLL_SECONDS:
+            self.background_thread_running = True
+            revision_thread = threading.Thread(target=self._poll_revisions, name='ThCachedResources Revisions')
+            revision_thread.start()
+
+
+class ThRenderPool:
+    """Class ThRenderPool renders templates in a pool of worker processes, so that rendering is not limited to the
+    one CPU core that the server process can use (because of the GIL).
+
+    Each worker has its own theas.template_cache (and uses the template bytecode cache, if set).  To keep requests
+    small, a worker is sent only the template key, the page state and this_data (without _session).  A
+    worker that has not yet compiled the template, or does not have the current resource versions, asks for them
+    (see theas.render_in_worker).  Template keys include a hash of the template (see ThResource.template_key), so
+    a worker never renders a stale template, and workers drop all of their templates when the server purges its
+    own (see theas.TemplateCache.generation).
+
+    Pages that cannot be rendered in a worker (see theas.Theas.can_render_in_worker), and renders whose data
+    cannot be sent to a worker, are rendered in the server process as before.
+    """
+
+    def __init__(self, process_count):
+        self.process_count = process_count
+        # spawn (rather than fork) so that workers do not inherit the server's threads and connections
+        self.executor = ProcessPoolExecutor(max_workers=process_count,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=theas.init_render_worker,
+                                            initargs=(TEMPLATE_CACHE_SIZE, TEMPLATE_BYTECODE_CACHE_DIR,
+                                                      TEMPLATE_BYTECODE_CACHE_SIZE))
+        self.renders = 0
+        self.resends = 0
+        self.local_renders = 0
+        self.__resource_versions = None
+        self.__resource_versions_stamp = 0
+
+    @tornado.gen.coroutine
+    def render(self, theas_page, template_str, data, template_key=None):
+        # Render template_str (identified by template_key, see ThResource.template_key) for theas_page in a worker.
+        # Called on the IOLoop thread.
+        this_resource_versions = ThCachedResources.resource_versions_dict
+        if not isinstance(this_resource_versions, dict):
+            this_resource_versions = {}
+        if this_resource_versions is not self.__resource_versions:
+            # ThCachedResources replaces (rather than changes) the dictionary when revisions are reloaded
+            self.__resource_versions = this_resource_versions
+            self.__resource_versions_stamp += 1
+
+        # get_data adds the session to data (for templates rendered here).  It cannot be sent to a worker, and
+        # ThHandler.use_render_pool does not use the pool for templates that refer to it.
+        this_data = {this_key: this_value for this_key, this_value in data.items() if this_key != '_session'}
+
+        # Pickle the payload here, so that data that cannot be sent to a worker is told apart from errors raised
+        # by the template in the worker (which are passed on, to be handled as usual)
+        try:
+            this_payload = pickle.dumps((this_data, theas_page.get_render_state()), protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            ThSession.cls_log('Render', 'Rendering in server process.  Cannot send data to render pool: {}'.format(e))
+            self.local_renders += 1
+            return theas_page.render(template_str, data=data, template_key=template_key)
+
+        this_result = None
+        this_generation = theas.template_cache.generation
+
+        try:
+            if template_key is not None:
+                this_result = yield self.executor.submit(
+                    theas.render_in_worker, template_key, None, this_payload, self.__resource_versions_stamp,
+                    template_generation=this_generation)
+
+            if this_result is None:
+                if template_key is not None:
+                    self.resends += 1
+                this_result = yield self.executor.submit(
+                    theas.render_in_worker, template_key, template_str, this_payload,
+                    self.__resource_versions_stamp, this_resource_versions, template_generation=this_generation)
+        except BrokenProcessPool as e:
+            ThSession.cls_log('Render', 'Rendering in server process.  Render pool is broken: {}'.format(e))
+            self.local_renders += 1
+            return theas_page.render(template_str, data=data, template_key=template_key)
+
+        buf, theas_page.control_names = this_result
+        self.renders += 1
+        return buf
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats_str(self):
+        return 'Render processes: {}  Renders: {}  Template resends: {}  Rendered locally: {}'.format(
+            self.process_count, self.renders, self.resends, self.local_renders)
 
 
 # -------------------------------------------------
@@ -1009,12 +2640,12 @@ class SBMonitor:
 
 
         if sp_listen.is_ok:
-            sp_listen.bind(self.queue_root, _mssql.SQLVARCHAR, '@SBRootName')
-            sp_listen.bind(self.auto_reply, _mssql.SQLVARCHAR, '@AutoReply')
-            sp_listen.bind(self.wait_length, _mssql.SQLVARCHAR, '@Timeout')
+            sp_listen.bind(self.queue_root, TheasDB.SQLVARCHAR, '@SBRootName')
+            sp_listen.bind(self.auto_reply, TheasDB.SQLVARCHAR, '@AutoReply')
+            sp_listen.bind(self.wait_length, TheasDB.SQLVARCHAR, '@Timeout')
 
         if sp_reply.is_ok:
-            sp_reply.bind(self.queue_root, _mssql.SQLVARCHAR, '@SBRootName')
+            sp_reply.bind(self.queue_root, TheasDB.SQLVARCHAR, '@SBRootName')
 
         result_value = sp_listen.execute()
 
@@ -1185,6 +2816,51 @@ class ThSessions:
             expire_thread = threading.Thread(target=self._poll_remove_expired, name='ThSessions Cleanup')
             expire_thread.start()
 
+    def validate_idle_sql_conns(self):
+        # Test the SQL connections of sessions (and of G_sql_pool) that have been idle for longer than
+        # SQL_IDLE_CHECK_SECONDS, so that requests do not have to.  Busy sessions are skipped.
+        self.lock()
+        try:
+            this_sessions = [this_sess for this_sess in self.__sessions.values() if this_sess is not None]
+        finally:
+            self.unlock()
+
+        checked_count = 0
+        bad_count = 0
+
+        for this_sess in this_sessions:
+            this_result = this_sess.validate_idle_sql_conn(SQL_IDLE_CHECK_SECONDS)
+            if this_result is not None:
+                checked_count += 1
+                if not this_result:
+                    bad_count += 1
+
+        if G_sql_pool is not None:
+            pool_checked_count, pool_bad_count = G_sql_pool.validate_idle(SQL_IDLE_CHECK_SECONDS)
+            checked_count += pool_checked_count
+            bad_count += pool_bad_count
+
+        return checked_count, bad_count
+
+    def _poll_validate_sql(self):
+        global G_server_is_running
+
+        last_poll = datetime.datetime.now()
+
+        while self.background_thread_running and G_server_is_running:
+            if (datetime.datetime.now() - last_poll).total_seconds() > SQL_VALIDATE_POLL_SECONDS:
+                last_poll = datetime.datetime.now()
+                checked_count, bad_count = self.validate_idle_sql_conns()
+                if checked_count:
+                    self.log('PollValidateSQL', 'Idle SQL connections checked', checked_count, 'failed', bad_count)
+            time.sleep(3)  # sleep only for 3 seconds so the application can shutdown cleanly when needed
+
+    def start_validator_thread(self):
+        if SQL_VALIDATE_POLL_SECONDS:
+            self.background_thread_running = True
+            validator_thread = threading.Thread(target=self._poll_validate_sql, name='ThSessions SQL Validator')
+            validator_thread.start()
+
 
 # -------------------------------------------------
 # ThSession
@@ -1194,7 +2870,8 @@ class ThSession:
 
      Each session has a unique session_token, and is stored in a ThSessions object.
 
-     Each session also has its own dedicated SQL connection, manages authentication (including rendering the
+     Each session also has its own dedicated SQL connection (or, if SQL_POOL_SIZE is set, borrows one from
+     G_sql_pool for the duration of each request), manages authentication (including rendering the
      login screen as needed), tracks elapsed time of individual requests, performs logging, provides locking
      to prevent multiple simultaneous requests for the same session, and provides methods for initializing
      a new session and for retrieving a session from the global ThSessions object.
@@ -1206,6 +2883,7 @@ class ThSession:
     def __init__(self, this_session_token, sessionless=False):
         self.theas_page = None
         self.sql_conn = None
+        self.pooled_conn = None  # ThPooledConn borrowed from G_sql_pool for the current request (if pooling)
 
         self.log_current_request = True
         self.current_handler = None
@@ -1224,6 +2902,7 @@ class ThSession:
 
         self.__locked_by = None
         self.__date_locked = None
+        self.__lock_mutex = threading.Lock()  # makes checking and setting __locked_by atomic
 
         self.__current_resource = None
 
@@ -1244,6 +2923,8 @@ class ThSession:
         self.date_last_sql_start = None
         self.date_last_sql_done = None
         self.date_sql_timeout = None
+        self.date_sql_validated = None  # when the SQL connection was last known to be working
+        self.sql_conn_suspect = False  # indicates an error occurred on the SQL connection
 
         self.date_request_start = None
         self.date_request_done = None
@@ -1354,8 +3035,13 @@ class ThSession:
             # will never be allowed to release the other lock on the session.
 
             if not this_give_up:
-                result = True
-                self.__locked_by = handler_guid
+                with self.__lock_mutex:
+                    # The SQL validator thread may have taken the lock in the meantime
+                    result = self.__locked_by is None or self.__locked_by == this_handler_guid
+                    if result:
+                        self.__locked_by = handler_guid
+
+            if result:
                 self.__date_locked = time.time()
                 self.request_count += 1
                 if not no_log:
@@ -1367,6 +3053,10 @@ class ThSession:
             self.theas_page = None
             del self.theas_page
 
+        if self.pooled_conn is not None:
+            # Return the borrowed connection.  (Sessionless sessions are never finished.)
+            self.release_sql_conn()
+
         if self.sql_conn is not None:
             if self.sql_conn.connected:
                 self.sql_conn.close()
@@ -1458,6 +3148,12 @@ class ThSession:
     def init_session(self, defer_sql=False, force_init=False):
         global G_program_options
         global G_sessions
+        global G_init_session_sql
+
+        if force_init or (self.sql_conn is not None and not self.sql_conn.connected):
+            if self.pooled_conn is not None:
+                # Don't return a bad connection to the pool
+                self.release_sql_conn(discard=True)
 
         if force_init:
             self.sql_conn = None
@@ -1471,18 +3167,18 @@ class ThSession:
             # Establish SQL connection, initialize
             if not defer_sql:
                 if self.sql_conn is None:
-                    self.log('SQL', 'Creating new SQL connection')
                     try:
-                        self.sql_conn = _mssql.connect(
-                            server=G_program_options.sql_server,
-                            port=G_program_options.sql_port,
-                            user=G_program_options.sql_user,
-                            password=G_program_options.sql_password,
-                            database=G_program_options.sql_database,
-                            appname=G_program_options.sql_appname
-                        )
+                        if G_sql_pool is not None:
+                            # Borrow a connection for the duration of this request.  See finished()
+                            self.log('SQL', 'Borrowing SQL connection from pool')
+                            self.use_pooled_conn(G_sql_pool.acquire(user_token=self.context_user_token,
+                                                                   session_token=self.session_token))
+                        else:
+                            self.log('SQL', 'Creating new SQL connection')
+                            self.sql_conn = open_sql_conn()
+                            self.mark_sql_conn_ok()
                         self.log('SQL', 'FreeTDS version: ' + str(self.sql_conn.tds_version))
-                    except Exception as e:
+                    except (Exception, TheasServerSQLError) as e:
                         self.log('SQL', 'Error creating new SQL connection: ' + str(e))
 
                 if self.sql_conn is not None:
@@ -1492,17 +3188,35 @@ class ThSession:
 
                     # make sure session has been initialized to handle uploaded files
                     if not self.sql_files_init_done:
-                        # Initialize theas session:  stored proc returns SQL statements we need to execute
-                        proc = ThStoredProc('theas.spgetInitSession', self)  # SOS Agri:  must be spInitSession2
-                        if proc.is_ok:
-                            if '@ServerPrefix' in proc.parameter_list:
-                                proc.bind(G_program_options.server_prefix, _mssql.SQLCHAR, '@ServerPrefix')
+                        init_sql = G_init_session_sql if CACHE_INIT_SESSION else None
+
+                        if init_sql is None:
+                            # Initialize theas session:  stored proc returns SQL statements we need to execute
+                            proc = ThStoredProc('theas.spgetInitSession', self)  # SOS Agri:  must be spInitSession2
+                            if proc.is_ok:
+                                if '@ServerPrefix' in proc.parameter_list:
+                                    proc.bind(G_program_options.server_prefix, TheasDB.SQLCHAR, '@ServerPrefix')
 
-                            result_value = proc.execute()
-                            for row in proc.resultset:
-                                self.sql_conn.execute_non_query(row['SQLToExecute'])
+                                result_value = proc.execute()
+                                init_sql = [row['SQLToExecute'] for row in proc.resultset]
+
+                                if CACHE_INIT_SESSION:
+                                    G_init_session_sql = init_sql
+                        else:
+                            self.log('SQL', 'Replaying cached statements from theas.spgetInitSession')
+
+                        if init_sql is not None:
+                            self.execute_init_sql(init_sql)
 
                             self.sql_files_init_done = True
+                            if self.pooled_conn is not None:
+                                self.pooled_conn.init_done = True
+
+                    if self.pooled_conn is not None and self.context_user_token is not None and \
+                            (self.pooled_conn.user_token != self.context_user_token or
+                             self.pooled_conn.session_token != self.session_token):
+                        # The borrowed connection does not have this session's user context
+                        self.replay_user_context()
 
                     if LOGIN_AUTO_USER_TOKEN and not self.logged_in and not self.autologged_in and self.current_handler is not None:
                         self.log('Auth', 'Authenticating as AUTO user (i.e. public)')
@@ -1518,6 +3232,27 @@ class ThSession:
 
         return self
 
+    def execute_init_sql(self, statements):
+        # Execute the statements returned by theas.spgetInitSession in one round trip.  Some statements cannot be
+        # combined into a batch (e.g. statements that must be the first in their batch), so if the batch fails
+        # execute the statements one at a time.  The batch runs in a transaction with XACT_ABORT, so that a
+        # failure part way through rolls back the statements that had run, and none of them are run twice.
+        this_batch = build_sql_batch(statements)
+        if not this_batch:
+            return
+
+        try:
+            self.sql_conn.execute_non_query(
+                'SET XACT_ABORT ON;\nBEGIN TRANSACTION;\n' + this_batch + 'COMMIT TRANSACTION;\nSET XACT_ABORT OFF;')
+        except Exception as e:
+            self.log('SQL', 'Batch of statements from theas.spgetInitSession failed, executing them one at a time', e)
+
+            self.sql_conn.execute_non_query('IF @@TRANCOUNT > 0 ROLLBACK TRANSACTION;\nSET XACT_ABORT OFF;')
+
+            for this_statement in statements:
+                if this_statement and this_statement.strip():
+                    self.sql_conn.execute_non_query(this_statement)
+
     def finished(self):
         if not self.__locked_by:
             pass
@@ -1542,17 +3277,159 @@ class ThSession:
             self.log('Session', 'Total requests for this session: ', self.request_count)
             self.log('Session', 'Finished with this request')
 
-            if self.sql_conn is None:
+            if G_sql_pool is not None and self.pooled_conn is None:
+                # Pooled connections are borrowed on demand, and this request did not need one
+                self.log('Session', 'Will time out at', self.date_expire)
+            elif self.sql_conn is None:
                 self.log('Session', 'Destroying session')
+                self.release_sql_conn(discard=True)
                 G_sessions.remove_session(self.session_token)
             else:
                 self.log('Session', 'Will time out at', self.date_expire)
+                self.release_sql_conn()
 
             self.log_current_request = True
             self.current_handler.cookies_changed = False
 
             self.release_lock(handler=self.current_handler)
 
+    @property
+    def context_user_token(self):
+        # The user token that must be authenticated on this session's SQL connection, if any
+        if self.logged_in:
+            return self.user_token
+        elif self.autologged_in:
+            return LOGIN_AUTO_USER_TOKEN
+        return None
+
+    @property
+    def sql_available(self):
+        # With pooling, a SQL connection is borrowed on demand rather than held by the session
+        return G_sql_pool is not None or self.sql_conn is not None
+
+    def mark_sql_conn_ok(self):
+        self.date_sql_validated = time.time()
+        self.sql_conn_suspect = False
+
+    def sql_conn_needs_check(self):
+        # Indicates whether the SQL connection should be tested before use:  only if it has been idle for longer
+        # than SQL_IDLE_CHECK_SECONDS, or if an error occurred the last time it was used
+        return self.sql_conn_suspect or not SQL_IDLE_CHECK_SECONDS or self.date_sql_validated is None or \
+            time.time() - self.date_sql_validated > SQL_IDLE_CHECK_SECONDS
+
+    def check_sql_conn(self):
+        # Test the SQL connection with a round trip to SQL
+        result = False
+
+        try:
+            if self.sql_conn is not None and self.sql_conn.connected:
+                self.sql_conn.execute_non_query('SELECT 1 AS IsOK')
+                self.mark_sql_conn_ok()
+                result = True
+        except Exception as e:
+            self.log('SQL', 'SQL connection failed validation', e)
+
+        return result
+
+    def validate_idle_sql_conn(self, idle_seconds):
+        # Called by the SQL validator thread (see ThSessions.validate_idle_sql_conns).  Tests this session's own
+        # SQL connection if it has been idle for longer than idle_seconds.  Returns None if the connection was
+        # not tested (including when the session is busy with a request), otherwise whether the test passed.
+        if self.pooled_conn is not None or self.sql_conn is None or self.date_sql_validated is None or \
+                time.time() - self.date_sql_validated <= idle_seconds:
+            return None
+
+        with self.__lock_mutex:
+            if self.__locked_by is not None:
+                return None
+            self.__locked_by = 'ThSessions SQL Validator'
+
+        try:
+            result = self.check_sql_conn()
+
+            if not result:
+                # Same as when ThStoredProc.is_ok fails.  A new connection will be created when needed.
+                self.log('SQL', 'Discarding idle SQL connection that failed validation')
+                try:
+                    if self.sql_conn.connected:
+                        self.sql_conn.close()
+                except Exception:
+                    pass
+                self.logged_in = False
+                self.sql_conn = None
+        finally:
+            self.__locked_by = None
+
+        return result
+
+    def use_pooled_conn(self, pooled_conn):
+        self.pooled_conn = pooled_conn
+        self.sql_conn = self.pooled_conn.sql_conn
+        self.sql_files_init_done = self.pooled_conn.init_done
+        self.date_sql_validated = self.pooled_conn.date_last_used
+        self.sql_conn_suspect = False
+
+    @tornado.gen.coroutine
+    def borrow_sql_conn_async(self):
+        # Borrow a connection from G_sql_pool for this request (if the session does not have one), waiting without
+        # blocking the IOLoop if all are in use.  (init_session would otherwise borrow it when SQL is first needed,
+        # and would fail at once if none were available.)
+        if G_sql_pool is not None and self.pooled_conn is None and self.sql_conn is None:
+            self.log('SQL', 'Borrowing SQL connection from pool')
+            try:
+                this_pooled_conn = yield G_sql_pool.acquire_async(user_token=self.context_user_token,
+                                                                  session_token=self.session_token)
+            except (Exception, TheasServerSQLError) as e:
+                self.log('SQL', 'Error borrowing SQL connection: ' + str(e))
+            else:
+                self.use_pooled_conn(this_pooled_conn)
+
+    def release_sql_conn(self, discard=False):
+        # Return a connection that was borrowed from G_sql_pool.  Does nothing if the session owns its connection.
+        if self.pooled_conn is not None:
+            if G_sql_pool is not None:
+                G_sql_pool.release(self.pooled_conn, discard=discard or self.sql_conn is None)
+            elif self.pooled_conn.sql_conn.connected:
+                # pool has already been shut down
+                self.pooled_conn.sql_conn.close()
+            self.pooled_conn = None
+            self.sql_conn = None
+            self.initialized = False
+
+    def close_sql_conn(self):
+        # Give up the session's SQL connection:  return it to G_sql_pool if it was borrowed, otherwise close it.
+        if self.pooled_conn is not None:
+            self.release_sql_conn()
+
+        if self.sql_conn is not None:
+            if self.sql_conn.connected:
+                self.sql_conn.close()
+            self.sql_conn = None
+            self.initialized = False
+
+    def replay_user_context(self):
+        # Re-establish the authenticated user on a pooled connection that was last used by someone else
+        user_token = self.context_user_token
+
+        self.log('SQL', 'Replaying user context on pooled SQL connection')
+
+        try:
+            proc = ThStoredProc('theas.spdoAuthenticateUser', self)
+            if proc.is_ok:
+                proc.bind(user_token, TheasDB.SQLVARCHAR, '@UserToken')
+                if self.session_token is not None:
+                    proc.bind(self.session_token, TheasDB.SQLVARCHAR, '@SessionToken')
+                proc.execute()
+
+                if self.pooled_conn is not None:
+                    self.pooled_conn.user_token = user_token
+                    self.pooled_conn.session_token = self.session_token
+        except Exception as e:
+            # Without the user context the session is no longer authenticated
+            self.log('SQL', 'Could not replay user context on pooled SQL connection', e)
+            self.logged_in = False
+            self.autologged_in = False
+
     def authenticate(self, username=None, password=None, user_token=None, retrieve_existing=False):
         """
         :param username: Username of user.  If provided, provide password as well
@@ -1602,17 +3479,17 @@ class ThSession:
         proc = ThStoredProc('theas.spdoAuthenticateUser', self)
         if proc.is_ok:
             if retrieve_existing:
-                proc.bind(retrieve_existing, _mssql.SQLVARCHAR, '@RetrieveExisting')
+                proc.bind(retrieve_existing, TheasDB.SQLVARCHAR, '@RetrieveExisting')
             else:
                 if username is not None:
-                    proc.bind(username, _mssql.SQLVARCHAR, '@UserName')
+                    proc.bind(username, TheasDB.SQLVARCHAR, '@UserName')
                 if password is not None:
-                    proc.bind(password, _mssql.SQLVARCHAR, '@Password')
+                    proc.bind(password, TheasDB.SQLVARCHAR, '@Password')
                 if user_token is not None:
-                    proc.bind(user_token, _mssql.SQLVARCHAR, '@UserToken')
+                    proc.bind(user_token, TheasDB.SQLVARCHAR, '@UserToken')
                 if self.session_token is not None:
                     # @SessionToken is informational only:  allows the web session to be logged in the database
-                    proc.bind(self.session_token, _mssql.SQLVARCHAR, '@SessionToken')
+                    proc.bind(self.session_token, TheasDB.SQLVARCHAR, '@SessionToken')
 
             try:
                 session_guid = None
@@ -1625,6 +3502,11 @@ class ThSession:
                     username = row['UserName']
 
                 if session_guid is not None:
+                    if self.pooled_conn is not None:
+                        # remember which user context this pooled connection now has
+                        self.pooled_conn.user_token = user_token
+                        self.pooled_conn.session_token = self.session_token if not retrieve_existing else None
+
                     if user_token == LOGIN_AUTO_USER_TOKEN:
                         self.logged_in = False
                         self.autologged_in = True
@@ -1694,13 +3576,17 @@ class ThSession:
             try:
                 proc = ThStoredProc('theas.spdoLogout', self)
                 if proc.is_ok:
-                    proc.bind(self.session_token, _mssql.SQLVARCHAR, '@SessionToken')
+                    proc.bind(self.session_token, TheasDB.SQLVARCHAR, '@SessionToken')
                     proc.execute()
             except Exception as e:
                 self.log('SQL', 'In ThSession.logout, exception calling theas.spdoLogout. {}'.format(e))
 
             try:
-                self.sql_conn.close()
+                if self.pooled_conn is not None:
+                    # Don't let a logged-out user context be handed to another session
+                    self.release_sql_conn(discard=True)
+                else:
+                    self.sql_conn.close()
                 self.sql_conn = None
             except Exception as e:
                 self.log('SQL', 'In ThSession.logout, exception calling sql_conn.close(). {}'.format(e))
@@ -1777,6 +3663,7 @@ class ThSession:
 
         self.date_last_sql_done = now
         self.date_sql_timeout = None
+        self.mark_sql_conn_ok()
 
         elapsed = (now - self.date_last_sql_start) * 1000 if self.date_last_sql_start is not None else 0
         self.log('Timing', 'SQL Done.  Duration: {:.2f}ms'.format(elapsed))
@@ -1835,7 +3722,7 @@ class ThSession:
             template_str = resource.data
             this_data = self.init_template_data()
 
-            buf = self.theas_page.render(template_str, data=this_data)
+            buf = self.theas_page.render(template_str, data=this_data, template_key=resource.template_key)
 
         return buf
 
@@ -1860,6 +3747,11 @@ class ThResponseInfo:
 class ThHandler(tornado.web.RequestHandler):
     executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
+    # Idle sessionless ThSessions (and their SQL connections) for requests that do not need a session of their
+    # own, such as HEAD requests for resources that are not cached.  See get_response_info.
+    _system_sessions = []
+    _system_sessions_mutex = Lock()
+
     def __init__(self, application, request, **kwargs):
         super().__init__(application, request, **kwargs)
         self.session = None
@@ -1913,6 +3805,218 @@ class ThHandler(tornado.web.RequestHandler):
             ThSession.cls_log('Cookies', 'Flag cookies_changed set to {}'.format(new_val))
             self.__cookies_changed = new_val
 
+    def get_accepted_encoding(self, encodings):
+        # Returns whichever of the content encodings (i.e. 'br', 'gzip') the browser accepts, per the
+        # Accept-Encoding request header, preferring the one with the highest q value, then the one listed
+        # first in encodings.  Returns None if the browser accepts none of them.
+        accepted = {}
+        for this_item in self.request.headers.get('Accept-Encoding', '').split(','):
+            this_parts = this_item.strip().split(';')
+            this_coding = this_parts[0].strip().lower()
+            this_q = 1.0
+            for this_param in this_parts[1:]:
+                this_name, _, this_value = this_param.strip().partition('=')
+                if this_name.strip().lower() == 'q':
+                    try:
+                        this_q = float(this_value)
+                    except ValueError:
+                        this_q = 0.0
+            if this_coding:
+                accepted[this_coding] = this_q
+
+        best_encoding = None
+        best_q = 0.0
+        for this_encoding in encodings:
+            this_q = accepted.get(this_encoding, accepted.get('*', 0.0))
+            if this_q > best_q:
+                best_encoding = this_encoding
+                best_q = this_q
+
+        return best_encoding
+
+    def is_not_modified(self, resource):
+        # Returns True if the browser's copy of the resource is current, per the If-None-Match or (if that is not
+        # present) If-Modified-Since request header.
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            if if_none_match.strip() == '*':
+                return True
+
+            this_etags = [resource.get_etag()] + [resource.get_etag(this_encoding)
+                                                  for this_encoding in resource.compressed]
+            for this_etag in if_none_match.split(','):
+                this_etag = this_etag.strip()
+                if this_etag.startswith('W/'):
+                    # If-None-Match uses weak comparison
+                    this_etag = this_etag[2:]
+                if this_etag in this_etags:
+                    return True
+            return False
+
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since is not None and resource.last_modified is not None:
+            this_date = self.parse_http_date(if_modified_since)
+            return this_date is not None and resource.last_modified <= this_date
+
+        return False
+
+    @staticmethod
+    def parse_http_date(value):
+        # Returns an HTTP date header value as a naive UTC datetime, or None if it cannot be parsed
+        try:
+            this_date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if this_date is not None and this_date.tzinfo is not None:
+            this_date = this_date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return this_date
+
+    def get_requested_range(self, length, etag=None, last_modified=None):
+        # Returns the (start, end) byte positions (end is exclusive) requested by a Range header, None to send all
+        # of the data, or False if the range cannot be satisfied.  Only a single range of bytes is supported:  a
+        # request for multiple ranges is answered with all of the data, which HTTP allows.
+        range_header = self.request.headers.get('Range')
+        if not range_header:
+            return None
+
+        if_range = self.request.headers.get('If-Range')
+        if if_range is not None:
+            # Only send part of the data if the browser's partial copy is of the current version
+            if_range = if_range.strip()
+            if if_range.startswith(('"', 'W/')):
+                if etag is None or if_range != etag:
+                    return None
+            elif last_modified is None or self.parse_http_date(if_range) != last_modified:
+                return None
+
+        this_unit, _, this_spec = range_header.partition('=')
+        if this_unit.strip().lower() != 'bytes' or ',' in this_spec:
+            return None
+
+        this_first, this_sep, this_last = this_spec.strip().partition('-')
+        if not this_sep:
+            return None
+
+        try:
+            if not this_first.strip():
+                # bytes=-500 is the last 500 bytes
+                this_suffix = int(this_last)
+                if this_suffix <= 0:
+                    return False
+                return max(0, length - this_suffix), length
+
+            this_start = int(this_first)
+            this_end = int(this_last) + 1 if this_last.strip() else length
+        except ValueError:
+            return None
+
+        if this_start < 0:
+            return None
+
+        # Checked first, as an open-ended range (bytes=1000-) that starts at or after the end has this_end == length
+        if this_start >= length:
+            return False
+
+        if this_end <= this_start:
+            return None
+
+        return this_start, min(this_end, length)
+
+    @tornado.gen.coroutine
+    def write_streamed(self, data, etag=None, last_modified=None):
+        # Write data (bytes), honoring a Range request (206 Partial Content).  Data larger than STREAM_CHUNK_SIZE
+        # is written in chunks, waiting for each chunk to be sent before writing the next, so that no more than
+        # one chunk is buffered for this connection.  Headers must be set before calling this.
+        this_length = len(data)
+        self.set_header('Accept-Ranges', 'bytes')
+
+        this_range = self.get_requested_range(this_length, etag=etag, last_modified=last_modified)
+
+        if this_range is False:
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */{}'.format(this_length))
+            return
+
+        if this_range is None:
+            this_start, this_end = 0, this_length
+        else:
+            this_start, this_end = this_range
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes {}-{}/{}'.format(this_start, this_end - 1, this_length))
+
+        self.set_header('Content-Length', this_end - this_start)
+
+        if this_end - this_start <= STREAM_CHUNK_SIZE:
+            self.write(data[this_start:this_end])
+            return
+
+        try:
+            for this_pos in range(this_start, this_end, STREAM_CHUNK_SIZE):
+                self.write(data[this_pos:min(this_pos + STREAM_CHUNK_SIZE, this_end)])
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            ThSession.cls_log('Response', 'Connection closed by client while streaming response')
+
+    @tornado.gen.coroutine
+    def write_render_stream(self, chunks):
+        # Write chunks (see do_render_response), waiting for each chunk to be sent before rendering the next.
+        # Headers must be set before calling this, as they are sent with the first chunk.  After that the status
+        # can no longer be changed, so an error while rendering is logged, and a message is added to the end of
+        # the partial page.
+        try:
+            for this_chunk in chunks:
+                self.write(this_chunk)
+                yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            ThSession.cls_log('Response', 'Connection closed by client while streaming rendered template')
+        except (Exception, TheasServerError) as e:
+            self.session.log('Render', 'Error rendering template after streaming began: {}'.format(e))
+            self.write(RENDER_STREAM_ERROR_HTML)
+
+    def set_resource_headers(self, resource):
+        # Choose the content encoding to send resource in (see ThCachedResources.compress_resource), and set the
+        # Vary, Content-Encoding, Etag and Last-Modified headers.  If the browser already has the current version
+        # of the resource, set the status to 304 Not Modified.
+        # Returns the chosen content encoding (None for resource.data as-is).
+        this_encoding = None
+
+        if resource.compressed:
+            self.set_header('Vary', 'Accept-Encoding')
+            this_encoding = self.get_accepted_encoding(
+                [this_encoding for this_encoding in ('br', 'gzip') if this_encoding in resource.compressed])
+            if this_encoding is not None:
+                self.set_header('Content-Encoding', this_encoding)
+
+        if resource.etag is not None:
+            self.set_header('Etag', resource.get_etag(this_encoding))
+            if resource.last_modified is not None:
+                self.set_header('Last-Modified', resource.last_modified)
+
+            if self.is_not_modified(resource):
+                ThSession.cls_log('CachedGET', 'Resource not modified', resource.resource_code)
+                self.clear_header('Content-Encoding')
+                self.set_status(304)
+
+        return this_encoding
+
+    @tornado.gen.coroutine
+    def write_resource_data(self, resource):
+        # Write resource.data, or the precompressed copy of it that the browser accepts.  If the resource is cached
+        # and the browser already has the current version, send 304 Not Modified instead.
+        # Binary data is streamed, and may be requested in part (see write_streamed).  Headers must be set before
+        # calling this.
+        this_encoding = self.set_resource_headers(resource)
+
+        if self.get_status() == 304:
+            return
+
+        if this_encoding is not None:
+            self.write(resource.compressed[this_encoding])
+        elif isinstance(resource.data, bytes):
+            yield self.write_streamed(resource.data, etag=resource.get_etag(), last_modified=resource.last_modified)
+        else:
+            self.write(resource.data)
+
     def get_response_info(self, resource_code, th_session, sessionless=False):
         '''
         Determine response length and content type.  Used for HEAD requests.
@@ -1933,13 +4037,40 @@ class ThHandler(tornado.web.RequestHandler):
             if not sessionless:
                 assert th_session is not None, 'ThHandler: get_response_info called without a valid session'
             else:
-                th_session = ThSession(None, sessionless=True)
+                # Use an idle system session, or a new one.  Requests are not made to wait for each other.
+                with ThHandler._system_sessions_mutex:
+                    this_session = ThHandler._system_sessions.pop() if ThHandler._system_sessions else None
+
+                if this_session is None:
+                    this_session = ThSession(None, sessionless=True)
+
+                try:
+                    response_info = self.get_response_info(resource_code, this_session)
+                except:
+                    this_session.close_sql_conn()
+                    raise
+
+                # Return a pooled connection to G_sql_pool, but keep the session (and a connection of its own) for
+                # the next request.  No more sessions are kept than there are executor threads to use them.
+                this_session.release_sql_conn()
+
+                with ThHandler._system_sessions_mutex:
+                    if len(ThHandler._system_sessions) < MAX_WORKERS:
+                        ThHandler._system_sessions.append(this_session)
+                        this_session = None
+
+                if this_session is not None:
+                    this_session.close_sql_conn()
+
+                return response_info
+
+        response_info = None
 
         # Get stored proc thes.spGetResponseInfo
         this_proc = ThStoredProc('theas.spgetResponseInfo', th_session)
 
         if this_proc.is_ok:
-            this_proc.bind(resource_code, _mssql.SQLCHAR, '@ResourceCode', null=(resource_code is None))
+            this_proc.bind(resource_code, TheasDB.SQLCHAR, '@ResourceCode', null=(resource_code is None))
 
             proc_result = this_proc.execute(fetch_rows=False)
             assert proc_result, 'ThHandler: get_response_info received error result from call to theas.spgetResponseInfo in the SQL database.'
@@ -1948,10 +4079,6 @@ class ThHandler(tornado.web.RequestHandler):
 
             row_count = 0
 
-            self.set_header('Server', 'theas')
-
-            th_session = None
-
             if this_proc.th_session.sql_conn is not None:
                 for row in this_proc.th_session.sql_conn:
                     # note:  should only be one row
@@ -2129,34 +4256,32 @@ class ThHandler(tornado.web.RequestHandler):
 
                         form_params_str = form_params_str + key + '=' + urlparse.quote(this_val) + '&'
 
-                # We also want to serialize all Theas controls
-                theas_params_str = self.session.theas_page.serialize()
-
                 proc.refresh_parameter_list()
 
                 if '@Command' in proc.parameter_list and cmd:
-                    proc.bind(cmd, _mssql.SQLCHAR, '@Command')
+                    proc.bind(cmd, TheasDB.SQLCHAR, '@Command')
 
                 if '@Document' in proc.parameter_list:
-                    proc.bind(self.request.path.rsplit('/', 1)[1], _mssql.SQLCHAR, '@Document')
+                    proc.bind(self.request.path.rsplit('/', 1)[1], TheasDB.SQLCHAR, '@Document')
 
                 if '@RawHTTPCommand' in proc.parameter_list:
-                    proc.bind(self.request.uri, _mssql.SQLCHAR, '@RawHTTPCommand')
+                    proc.bind(self.request.uri, TheasDB.SQLCHAR, '@RawHTTPCommand')
 
                 if '@PathFull' in proc.parameter_list:
-                    proc.bind(self.request.path, _mssql.SQLCHAR, '@PathFull')
+                    proc.bind(self.request.path, TheasDB.SQLCHAR, '@PathFull')
 
                 if '@PathParams' in proc.parameter_list and path_params:
-                    proc.bind(path_params, _mssql.SQLCHAR, '@PathParams')
+                    proc.bind(path_params, TheasDB.SQLCHAR, '@PathParams')
 
                 if '@HTTPParams' in proc.parameter_list:
-                    proc.bind(self.request.query, _mssql.SQLCHAR, '@HTTPParams')
+                    proc.bind(self.request.query, TheasDB.SQLCHAR, '@HTTPParams')
 
                 if '@FormParams' in proc.parameter_list:
-                    proc.bind(form_params_str, _mssql.SQLCHAR, '@FormParams')
+                    proc.bind(form_params_str, TheasDB.SQLCHAR, '@FormParams')
 
                 if '@TheasParams' in proc.parameter_list:
-                    proc.bind(theas_params_str, _mssql.SQLCHAR, '@TheasParams')
+                    # We also want to serialize all Theas controls
+                    self.bind_theas_params(proc)
 
                 if '@HTTPHeaders' in proc.parameter_list:
                     headers_str = ''
@@ -2174,16 +4299,33 @@ class ThHandler(tornado.web.RequestHandler):
 
                         headers_str = headers_str + '&' + key + '=' + urlparse.quote(this_val)
 
-                    proc.bind(headers_str, _mssql.SQLCHAR, '@HTTPHeaders')
+                    proc.bind(headers_str, TheasDB.SQLCHAR, '@HTTPHeaders')
 
                 if '@RemoteIP' in proc.parameter_list:
-                    proc.bind(self.request.remote_ip, _mssql.SQLCHAR, '@RemoteIP')
+                    proc.bind(self.request.remote_ip, TheasDB.SQLCHAR, '@RemoteIP')
 
                 if '@UserAgent' in proc.parameter_list:
-                    proc.bind(self.request, _mssql.SQLCHAR, '@UserAgent')
+                    proc.bind(self.request, TheasDB.SQLCHAR, '@UserAgent')
 
-                # Execute stored procedure
-                proc_result = proc.execute(fetch_rows=False)
+                result_cache_key = None
+                cached_resultsets = None
+                this_resource = self.session.current_resource
+
+                if this_resource.result_cache_seconds and G_cached_results is not None and \
+                        this_resource.api_async_stored_proc == stored_proc_name:
+                    result_cache_key = ThCachedResults.make_key(this_resource, proc, self.session.context_user_token)
+                    cached_resultsets = G_cached_results.get_results(result_cache_key)
+
+                if cached_resultsets is not None:
+                    self.session.log('SQL', 'Using cached results of', stored_proc_name)
+                else:
+                    # Execute stored procedure
+                    proc_result = proc.execute(fetch_rows=False)
+                    if '@TheasParams' in proc.parameter_list:
+                        self.session.theas_page.mark_params_sent()
+
+                reader = ThResultsetReader(proc.th_session.sql_conn, cached_resultsets=cached_resultsets,
+                                           record=result_cache_key is not None)
 
                 redirect_to = None
                 theas_params_str = ''
@@ -2203,10 +4345,11 @@ class ThHandler(tornado.web.RequestHandler):
                 # If the async stored proc does return multiple rows, these column values from each row are
                 # concatenated together.
 
-                if proc.th_session.sql_conn is not None:
+                if proc.th_session.sql_conn is not None or reader.from_cache:
 
-                    for row in proc.th_session.sql_conn:
+                    for row in reader:
                         row_count += 1
+                        reader.keep(row)
 
                         if row_count > 1:
                             buf = buf + '&'
@@ -2241,6 +4384,9 @@ class ThHandler(tornado.web.RequestHandler):
                 self.session.log('Handler', '{row_count} rows returned by handler stored proc'.format(
                     row_count=row_count))
 
+                if reader.recorded is not None:
+                    G_cached_results.add_results(result_cache_key, reader.recorded, this_resource.result_cache_seconds)
+
                 changed_controls = None
 
                 if theas_params_str:
@@ -2299,10 +4445,10 @@ class ThHandler(tornado.web.RequestHandler):
                 #        buf = '0x'.encode('ascii') + binascii.hexlify(file_obj['body']).decode('ascii')
                 #        filename = this_file['filename']
 
-                # fileProc.bind(fieldname, _mssql.SQLVARCHAR, '@FieldName')
-                # fileProc.bind(this_filename, _mssql.SQLVARCHAR, '@FileName')
-                # fileProc.bind(buf, _mssql.SQLVARCHAR, '@FileCharData')
-                # should work, but does not: #fileProc.bind(this_file['body'], _mssql.SQLVARBINARY, '@FileData')
+                # fileProc.bind(fieldname, TheasDB.SQLVARCHAR, '@FieldName')
+                # fileProc.bind(this_filename, TheasDB.SQLVARCHAR, '@FileName')
+                # fileProc.bind(buf, TheasDB.SQLVARCHAR, '@FileCharData')
+                # should work, but does not: #fileProc.bind(this_file['body'], TheasDB.SQLVARBINARY, '@FileData')
                 # fileResultValue = fileProc.execute()
 
                 # callproc() is broken as of 6/16/2015, in that it truncates long values:
@@ -2415,10 +4561,9 @@ class ThHandler(tornado.web.RequestHandler):
 
                 form_params_str = form_params_str + key + '=' + urlparse.unquote(this_val) + '&'
 
-        # serialize theas parameters to pass into the stored procedure
-        theas_params_str = self.session.theas_page.serialize()
-
         proc = None
+        result_cache_key = None
+        cached_resultsets = None
 
         if resource and resource.api_stored_proc:
             # get_data should probably be refactored to use exec_stored_proc (which is used for async calls)
@@ -2433,13 +4578,13 @@ class ThHandler(tornado.web.RequestHandler):
                         raise
 
                 # if '@QuestGUID' in proc.parameter_list and self.session.theas_page.get_value('questGUID') is not None:
-                #    proc.bind(self.session.theas_page.get_value('questGUID'), _mssql.SQLCHAR, '@QuestGUID')
+                #    proc.bind(self.session.theas_page.get_value('questGUID'), TheasDB.SQLCHAR, '@QuestGUID')
 
                 # if '@StepGUID' in proc.parameter_list and self.session.theas_page.get_value('stepGUID') is not None:
-                #    proc.bind(self.session.theas_page.get_value('stepGUID'), _mssql.SQLCHAR, '@StepGUID')
+                #    proc.bind(self.session.theas_page.get_value('stepGUID'), TheasDB.SQLCHAR, '@StepGUID')
 
                 # if '@StepDefID' in proc.parameter_list and self.session.theas_page.get_value('stepDefID') is not None:
-                #    proc.bind(self.session.theas_page.get_value('stepDefID'), _mssql.SQLCHAR, '@StepDefID')
+                #    proc.bind(self.session.theas_page.get_value('stepDefID'), TheasDB.SQLCHAR, '@StepDefID')
 
                 first_path_elem = self.request.path.split('/')[1]
 
@@ -2457,10 +4602,10 @@ class ThHandler(tornado.web.RequestHandler):
                     if this_document is not None:
                         if this_document[0] == '/':
                             this_document = this_document[1:]
-                        proc.bind(this_document, _mssql.SQLCHAR, '@Document')
+                        proc.bind(this_document, TheasDB.SQLCHAR, '@Document')
 
                 if '@PathFull' in proc.parameter_list:
-                    proc.bind(self.request.path, _mssql.SQLCHAR, '@PathFull')
+                    proc.bind(self.request.path, TheasDB.SQLCHAR, '@PathFull')
 
                 if '@PathParams' in proc.parameter_list:
                     this_path = None
@@ -2469,14 +4614,14 @@ class ThHandler(tornado.web.RequestHandler):
                         this_path = "/".join(self.request.path.split('/')[3:])
 
                     if this_path is not None:
-                        proc.bind(this_path, _mssql.SQLCHAR, '@PathParams')
+                        proc.bind(this_path, TheasDB.SQLCHAR, '@PathParams')
 
                 if '@HTTPParams' in proc.parameter_list:
-                    proc.bind(self.request.query, _mssql.SQLCHAR, '@HTTPParams')
+                    proc.bind(self.request.query, TheasDB.SQLCHAR, '@HTTPParams')
 
                 if '@FormParams' in proc.parameter_list:
-                    proc.bind(form_params_str, _mssql.SQLCHAR, '@FormParams')
-                    # proc.bind(urlparse.urlencode(self.request.body_arguments, doseq=True), _mssql.SQLCHAR, '@FormParams')
+                    proc.bind(form_params_str, TheasDB.SQLCHAR, '@FormParams')
+                    # proc.bind(urlparse.urlencode(self.request.body_arguments, doseq=True), TheasDB.SQLCHAR, '@FormParams')
 
                 if '@HTTPHeaders' in proc.parameter_list:
                     headers_str = ''
@@ -2494,29 +4639,38 @@ class ThHandler(tornado.web.RequestHandler):
 
                         headers_str = headers_str + '&' + key + '=' + urlparse.quote(this_val)
 
-                    proc.bind(headers_str, _mssql.SQLCHAR, '@HTTPHeaders')
+                    proc.bind(headers_str, TheasDB.SQLCHAR, '@HTTPHeaders')
 
                 if '@RemoteIP' in proc.parameter_list:
-                    proc.bind(self.request.remote_ip, _mssql.SQLCHAR, '@RemoteIP')
+                    proc.bind(self.request.remote_ip, TheasDB.SQLCHAR, '@RemoteIP')
 
                 if '@Cookies' in proc.parameter_list:
                     cookies_str = ''
                     for key in self.cookies.keys():
                         cookies_str += key + '=' + urlparse.quote(self.cookies.get(key).value) + '&'
 
-                    proc.bind(cookies_str, _mssql.SQLCHAR, '@Cookies')
+                    proc.bind(cookies_str, TheasDB.SQLCHAR, '@Cookies')
 
                 if '@TheasParams' in proc.parameter_list:
-                    # proc.bind(theas_params_str, _mssql.SQLCHAR, '@TheasParams', output=proc.parameter_list['@TheasParams']['is_output'])
+                    # proc.bind(theas_params_str, TheasDB.SQLCHAR, '@TheasParams', output=proc.parameter_list['@TheasParams']['is_output'])
                     # Would prefer to use output parameter, but this seems not to be supported by FreeTDS.  So
                     # we look to the resultest(s) returned by the stored proc instead.
-                    proc.bind(theas_params_str, _mssql.SQLCHAR, '@TheasParams')
+                    self.bind_theas_params(proc)
 
                 if '@SuppressResultsets' in proc.parameter_list:
-                    proc.bind(str(int(suppress_resultsets)), _mssql.SQLCHAR, '@SuppressResultsets')
+                    proc.bind(str(int(suppress_resultsets)), TheasDB.SQLCHAR, '@SuppressResultsets')
 
-                # Execute stored procedure
-                proc_result = proc.execute(fetch_rows=False)
+                if resource.result_cache_seconds and G_cached_results is not None:
+                    result_cache_key = ThCachedResults.make_key(resource, proc, self.session.context_user_token)
+                    cached_resultsets = G_cached_results.get_results(result_cache_key)
+
+                if cached_resultsets is not None:
+                    self.session.log('SQL', 'Using cached results of', resource.api_stored_proc)
+                else:
+                    # Execute stored procedure
+                    proc_result = proc.execute(fetch_rows=False)
+                    if '@TheasParams' in proc.parameter_list:
+                        self.session.theas_page.mark_params_sent()
 
             except Exception as e:
                 had_error = True
@@ -2569,7 +4723,7 @@ class ThHandler(tornado.web.RequestHandler):
 
             # {column1,column2} is optional.  If present, will be a comma-separated list of column names.  This list
             # will be used instead of the list of all columns returned in the resultset.  (i.e. will limit the
-            # columns stored in the data passed to the template)
+            # columns stored in the data passed to the template when COMPACT_ROWS is set)
 
             this_resultset_info = {}
 
@@ -2599,6 +4753,12 @@ class ThHandler(tornado.web.RequestHandler):
                 resultset_list.append(this_resultset_info)
 
             row = None
+            rows_size = 0  # approximate total number of bytes held by the rows kept in this_data
+            log_rows_size = LOGGING_LEVEL == 1 and self.session.log_current_request  # only measure if logged
+
+            reader = ThResultsetReader(self.session.sql_conn, cached_resultsets=cached_resultsets,
+                                       record=result_cache_key is not None)
+
             for this_resultset_info in resultset_list:
                 max_rows = this_resultset_info['max_rows']
                 if max_rows is None:
@@ -2609,24 +4769,43 @@ class ThHandler(tornado.web.RequestHandler):
                 else:
                     this_data[this_resultset_info['name']] = []
 
-                resultset = [row for row in self.session.sql_conn]
-
+                # Rows are fetched one at a time, and we stop fetching once max_rows (> 1) have been kept.  Any rows
+                # remaining in the resultset are skipped by nextresult() (or discarded when the connection executes
+                # its next query) without ever being turned into row dictionaries.  When max_rows is 1, the last
+                # row of the resultset is kept, as it always has been, so all rows are fetched.
                 row_count = 0
-                for row in resultset:
+                is_truncated = False
+                row_columns = None
+                for row in reader:
                     row_count += 1
-                    if (max_rows > 1) and (row_count > max_rows):
-                        break
+
+                    if COMPACT_ROWS and not reader.from_cache:
+                        # Convert to a ThRow right away, so that the _mssql row dictionary can be freed
+                        if row_columns is None:
+                            row_columns = ThRowColumns.from_row(row, this_resultset_info.get('columns'))
+                        row = row_columns.make_row(row)
+
+                    reader.keep(row)
+
+                    if this_resultset_info['max_rows'] == 1:
+                        this_data[this_resultset_info['name']] = row
                     else:
-                        if this_resultset_info['max_rows'] == 1:
-                            this_data[this_resultset_info['name']] = row
-                        else:
-                            this_data[this_resultset_info['name']].append(row)
+                        this_data[this_resultset_info['name']].append(row)
+
+                        if log_rows_size:
+                            rows_size += get_row_size(row)
+
+                    if max_rows > 1 and row_count >= max_rows:
+                        is_truncated = True
+                        break
 
-                self.session.log('SQL', 'Processed {} row(s) in resultest {}'.format(
-                    str(len(this_data[this_resultset_info['name']]))
-                    if this_data[this_resultset_info['name']] is list else 1,
+                if log_rows_size and max_rows == 1 and row_count:
+                    rows_size += get_row_size(this_data[this_resultset_info['name']])
 
-                    this_resultset_info['name'])
+                self.session.log('SQL', 'Processed {} row(s) in resultest {}{}'.format(
+                    row_count,
+                    this_resultset_info['name'],
+                    ' (stopped at max_rows)' if is_truncated else '')
                                  )
 
                 if this_resultset_info['name'] in ('General'):  # should we also include 'general' here??
@@ -2695,13 +4874,20 @@ class ThHandler(tornado.web.RequestHandler):
 
                                 self.session.log('Headers', 'Updating HTTP headers as per stored procedure E')
 
-                have_next_resultset = self.session.sql_conn.nextresult()
+                have_next_resultset = reader.nextresult()
                 if not have_next_resultset:
                     break
 
                     # stored proc may have updated Theas controls, so update the copy in data._Theas
                     # this_data['_Theas']['theasParams'] = self.session.theas_page.get_controls()
 
+            if log_rows_size:
+                self.session.log('Timing', 'SQL resultsets fetched.  Total row memory kept: approx. {:,} bytes'.format(
+                    rows_size))
+
+            if reader.recorded is not None:
+                G_cached_results.add_results(result_cache_key, reader.recorded, resource.result_cache_seconds)
+
             # One of our stored procedure resultsets indicated that authentication had been performed.
             # Have the session retrieve existing authentication from the database.
             if perform_authenticate_existing:
@@ -2741,9 +4927,20 @@ class ThHandler(tornado.web.RequestHandler):
             if this_resource.api_stored_proc or this_resource.render_jinja_template:
                 this_data, redirect_to, history_go_back = self.get_data(this_resource)
 
-            if this_resource.render_jinja_template:
+            if this_resource.render_jinja_template and (STREAM_RENDER or this_resource.stream_render) and \
+                    not self.session.theas_page.doOnAfterRender:
+                # resource indicates that we should render a Jinja template, and send it as it is rendered.
+                # buf is an iterator of chunks (see write_render_stream)
+                this_chunks = self.session.theas_page.render_chunks(this_resource.data, data=this_data,
+                                                                    template_key=this_resource.template_key,
+                                                                    chunk_size=STREAM_CHUNK_SIZE)
+                # Render the first chunk now, so that errors at the start of the template (before anything has been
+                # sent) are handled the same as when not streaming
+                buf = itertools.chain([next(this_chunks, '')], this_chunks)
+            elif this_resource.render_jinja_template:
                 # resource indicates that we should render a Jinja template
-                buf = self.session.theas_page.render(this_resource.data, data=this_data)
+                buf = self.session.theas_page.render(this_resource.data, data=this_data,
+                                                     template_key=this_resource.template_key)
             elif this_resource.api_stored_proc:
                 # resource does not indicate that we should render a Jinja template (but does specify an
                 # api stored proc) so just return the raw content retrieved by get_data
@@ -2754,6 +4951,49 @@ class ThHandler(tornado.web.RequestHandler):
 
         return buf, redirect_to, history_go_back
 
+    def release_session(self):
+        # Finish this request's use of the session (unlocking it), i.e. before a long response is sent.  Another
+        # request may then lock the session, so this request must not use (or finish) it again:  self.session is
+        # set to None.
+        if self.session is not None:
+            self.session.log('Request',
+                             'At end, Current Resource is {}'.format(
+                                 self.session.current_resource.resource_code
+                                 if self.session.current_resource
+                                 else 'Not Assigned!'
+                             ))
+            self.session.comments = None
+            self.session.finished()
+            self.session = None
+
+    def bind_theas_params(self, proc):
+        # Bind the serialized Theas controls to @TheasParams of proc.  If THEAS_PARAMS_DELTA is set and proc declares
+        # @TheasParamsDelta, only the controls that changed since the controls were last sent to a stored procedure
+        # are bound, and @TheasParamsDelta is set to 1.  Call theas_page.mark_params_sent once proc has executed.
+        this_delta = THEAS_PARAMS_DELTA and '@TheasParamsDelta' in proc.parameter_list
+
+        proc.bind(self.session.theas_page.serialize(changed_only=this_delta), TheasDB.SQLCHAR, '@TheasParams')
+
+        if '@TheasParamsDelta' in proc.parameter_list:
+            proc.bind('1' if this_delta else '0', TheasDB.SQLCHAR, '@TheasParamsDelta')
+
+    def use_render_pool(self, this_resource):
+        # True if the template of this_resource should be rendered in G_render_pool.  (Streamed renders are
+        # rendered here, as they are sent.)
+        return G_render_pool is not None and this_resource.render_jinja_template and \
+            not (STREAM_RENDER or this_resource.stream_render) and self.session.theas_page.can_render_in_worker() and \
+            '_session' not in this_resource.data
+
+    @tornado.gen.coroutine
+    def do_render_response_in_pool(self, this_resource):
+        # Same as do_render_response, but renders the template in G_render_pool
+        this_data, redirect_to, history_go_back = self.get_data(this_resource)
+
+        buf = yield G_render_pool.render(self.session.theas_page, this_resource.data, this_data,
+                                         template_key=this_resource.template_key)
+
+        return buf, redirect_to, history_go_back
+
     @run_on_executor
     def do_render_response_background(self, this_resource=None):
         return self.do_render_response(this_resource=this_resource)
@@ -2914,7 +5154,10 @@ class ThHandler(tornado.web.RequestHandler):
                                 if this_resource and this_resource.render_jinja_template and\
                                         redirect_to is None and not history_go_back:
                                     self.session.log('Render', 'Calling theas_page.render')
-                                    buf = self.session.theas_page.render(template_str, data=this_data)
+                                    buf = self.session.theas_page.render(
+                                        template_str, data=this_data,
+                                        template_key=this_resource.template_key
+                                        if template_str is this_resource.data else None)
                                     self.session.log('Render', 'Done with theas_page.render')
                                 else:
                                     # template_str does not need to be merged with data
@@ -2984,6 +5227,9 @@ class ThHandler(tornado.web.RequestHandler):
             this_sess.current_handler = self
             this_sess.current_xsrf_form_html = self.xsrf_form_html()
 
+            # Borrow a pooled SQL connection now, where we can wait for one
+            yield this_sess.borrow_sql_conn_async()
+
             if USE_SESSION_COOKIE and write_to_cookie:
                 # next_url = '/'
                 if orig_cookie_session_token != this_sess.session_token:
@@ -3050,11 +5296,42 @@ class ThHandler(tornado.web.RequestHandler):
 
         self.set_header('Server', 'Theas/01')
 
+        # A public resource that is sent as-is can be described from the cache, without SQL
+        if resource_code:
+            resource = G_cached_resources.get_resource(resource_code, None, none_if_not_found=True)
+
+        if resource is not None and resource.exists and resource.is_public and resource.content_length is not None and \
+                not resource.render_jinja_template and not resource.api_stored_proc and \
+                not resource.on_before and not resource.on_after:
+            ThSession.cls_log('CachedHEAD', 'Describing cached resource', resource_code)
+
+            this_encoding = self.set_resource_headers(resource)
+
+            # Same headers as ThHandler.get
+            self.set_header('Access-Control-Allow-Origin', '*')
+            self.set_header('Access-Control-Max-Age', '0')
+            self.set_header('Content-Type', resource.content_type)
+            self.set_header('Cache-Control', ' max-age=900')
+            if resource.filename:
+                self.set_header('Content-Disposition', 'inline; filename=' + resource.filename)
+            if this_encoding is None and resource.data_is_bytes:
+                # see write_streamed
+                self.set_header('Accept-Ranges', 'bytes')
+
+            if self.get_status() != 304:
+                if this_encoding is not None:
+                    self.set_header('Content-Length', len(resource.compressed[this_encoding]))
+                else:
+                    self.set_header('Content-Length', resource.content_length)
+            return
+
         th_session = None
 
         # Look up response info.
         # Will not return info for dynamic requests (only static requests for SysWebResource or attachment)
-        response_info = self.get_response_info(resource_code, th_session, sessionless=True)
+        # The SQL call is made on the executor, so that HEAD requests do not block the IOLoop.
+        response_info = yield ThHandler.executor.submit(self.get_response_info, resource_code, th_session,
+                                                        sessionless=True)
 
         if response_info is None:
             self.send_error(status_code=405)
@@ -3197,6 +5474,8 @@ class ThHandler(tornado.web.RequestHandler):
 
         handled = False
         buf = None
+        buf_is_resource_data = False
+        buf_is_render_stream = False
         redirect_to = None
         history_go_back = False
 
@@ -3245,7 +5524,8 @@ class ThHandler(tornado.web.RequestHandler):
         # We can serve up such requests without even checking the session.
         # If we do not check the session, multiple simultaneous requests can be processed,
         if resource_code or self.session:
-            resource = G_cached_resources.get_resource(resource_code, self.session, none_if_not_found=True)
+            resource = yield G_cached_resources.get_resource_async(resource_code, self.session,
+                                                                   none_if_not_found=True)
 
         # see if the resource is public (so that we can serve up without a session)
         if resource is not None and resource.exists and resource.is_public and \
@@ -3254,6 +5534,7 @@ class ThHandler(tornado.web.RequestHandler):
             # note:  resource.data will usually be str but might be bytes
             ThSession.cls_log('CachedGET', 'Serving up cached resource', resource_code)
             buf = resource.data
+            buf_is_resource_data = True
 
         else:
             # Retrieve or create a session.  We want everyone to have a session (even if they are not authenticated)
@@ -3286,7 +5567,8 @@ class ThHandler(tornado.web.RequestHandler):
 
                 if resource is None or not resource.exists:
                     # Call get_resources again, this time with a session
-                    resource = G_cached_resources.get_resource(resource_code, self.session, none_if_not_found=True)
+                    resource = yield G_cached_resources.get_resource_async(resource_code, self.session,
+                                                                           none_if_not_found=True)
 
                     if resource is None or not resource.exists:
                         # If the user is logged in, but resource_code is not specified, we explicitly set get_default_resource
@@ -3295,8 +5577,9 @@ class ThHandler(tornado.web.RequestHandler):
                         # up the default resource.
                         self.session.log('Get Resource', 'Logged in?', self.session.logged_in)
                         self.session.log('Get Resource', 'resource_code', resource_code if resource_code is not None else 'None')
-                        resource = G_cached_resources.get_resource(resource_code, self.session, none_if_not_found=True,
-                                                                   get_default_resource=self.session.logged_in)
+                        resource = yield G_cached_resources.get_resource_async(
+                            resource_code, self.session, none_if_not_found=True,
+                            get_default_resource=self.session.logged_in)
 
                 if resource is not None and resource.exists and\
                         resource.resource_code != LOGIN_RESOURCE_CODE and \
@@ -3329,10 +5612,15 @@ class ThHandler(tornado.web.RequestHandler):
 
                     if buf is None and (not resource.requires_authentication or self.session.logged_in):
                         if resource.api_stored_proc or resource.render_jinja_template:
-                            buf, redirect_to, history_go_back = self.do_render_response(this_resource=resource)
+                            if self.use_render_pool(resource):
+                                buf, redirect_to, history_go_back = yield self.do_render_response_in_pool(resource)
+                            else:
+                                buf, redirect_to, history_go_back = self.do_render_response(this_resource=resource)
+                                buf_is_render_stream = buf is not None and not isinstance(buf, (str, bytes))
                         else:
                             # note:  resource.data will usually be str but might be bytes
                             buf = resource.data
+                            buf_is_resource_data = True
 
                     if resource.on_after:
                         this_function = getattr(TheasCustom, resource.on_after)
@@ -3363,7 +5651,8 @@ class ThHandler(tornado.web.RequestHandler):
             if buf is not None:
                 write_log(self.session, 'Response', 'Sending response to HTTP GET request for {}'.format(resource_code))
 
-                self.write(buf)
+                if not buf_is_resource_data and not buf_is_render_stream:
+                    self.write(buf)
 
                 # CORS
                 self.set_header('Access-Control-Allow-Origin', '*')  # allow CORS from any domain
@@ -3390,18 +5679,19 @@ class ThHandler(tornado.web.RequestHandler):
                 else:
                     self.set_header('Content-Type', theas.Theas.mimetype_for_extension(resource.resource_code))
 
-                self.finish()
+                if buf_is_resource_data:
+                    # Don't keep the session locked while the data is sent
+                    self.release_session()
 
-            if self.session is not None:
-                self.session.comments = None
-                self.session.finished()
+                    yield self.write_resource_data(resource)
+
+                if buf_is_render_stream:
+                    # The session is needed until rendering is complete
+                    yield self.write_render_stream(buf)
 
-                self.session.log('Request',
-                                 'At end, Current Resource is {}'.format(
-                                     self.session.current_resource.resource_code
-                                     if self.session.current_resource
-                                     else 'Not Assigned!'
-                                 ))
+                self.finish()
+
+            self.release_session()
 
 
 
@@ -3462,7 +5752,7 @@ class ThHandler_Attach(ThHandler):
             # Get attachment data from database
             proc = ThStoredProc('theas.spgetAttachment', self.session)
             if proc.is_ok:
-                proc.bind(attachment_guid, _mssql.SQLCHAR, '@AttachmentGUID')
+                proc.bind(attachment_guid, TheasDB.SQLCHAR, '@AttachmentGUID')
 
                 proc_result = proc.execute(fetch_rows=False)
                 for row in proc.th_session.sql_conn:
@@ -3530,7 +5820,6 @@ class ThHandler_Attach(ThHandler):
                     resource = self.retrieve_webresource()
 
                 self.session.log('Attach', 'Sending SysWebResource')
-                self.write(resource.data)
 
                 if resource.filetype:
                     self.set_header('Content-Type', resource.filetype)
@@ -3539,6 +5828,11 @@ class ThHandler_Attach(ThHandler):
 
                 self.set_header('Content-Disposition', 'inline; filename=' + resource.filename)
 
+                # Don't keep the session locked while the data is sent
+                self.release_session()
+
+                yield self.write_resource_data(resource)
+
             else:
                 # if not self.session.logged_in:
                 #    self.send_error(status_code=404)
@@ -3551,7 +5845,6 @@ class ThHandler_Attach(ThHandler):
 
                 if attachment is not None:
                     self.session.log('Attach', 'Sending attachment response')
-                    self.write(attachment['data'])
                     self.set_header('Content-Type', theas.Theas.mimetype_for_extension(attachment['filename']))
 
                     if attachment['filetype']:
@@ -3560,12 +5853,19 @@ class ThHandler_Attach(ThHandler):
                         if attachment['filename']:
                             self.set_header('Content-Type', theas.Theas.mimetype_for_extension(attachment['filename']))
                             self.set_header('Content-Disposition', 'inline; filename=' + attachment['filename'])
+
+                    # Don't keep the session locked while the data is sent
+                    self.release_session()
+
+                    if isinstance(attachment['data'], (bytes, bytearray)):
+                        yield self.write_streamed(bytes(attachment['data']))
+                    else:
+                        self.write(attachment['data'])
                     self.finish()
                 else:
                     self.send_error(status_code=404)
 
-            self.session.finished()
-            self.session = None
+            self.release_session()
 
     def data_received(self, chunk):
         pass
@@ -3830,7 +6130,7 @@ class ThHandler_Async(ThHandler):
 
             if self.session.current_resource is None or resource_code != self.session.current_resource.resource_code:
                 # Note that an async request will NOT change the session's current_resource
-                this_resource = G_cached_resources.get_resource(resource_code, self.session)
+                this_resource = yield G_cached_resources.get_resource_async(resource_code, self.session)
             else:
                 this_resource = self.session.current_resource
 
@@ -3846,7 +6146,7 @@ class ThHandler_Async(ThHandler):
             # do_log=(not cmd == 'heartbeat'))
 
             if cmd == 'heartbeat':
-                if self.session is not None and self.session.sql_conn is not None:
+                if self.session is not None and self.session.sql_available:
                     buf = None
                     changed_controls = None
                     redirect_to = None
@@ -3867,7 +6167,7 @@ class ThHandler_Async(ThHandler):
                     self.session.finished()
 
             if cmd == 'clearError':
-                if self.session is not None and self.session.sql_conn is not None:
+                if self.session is not None and self.session.sql_available:
                     self.session.theas_page.set_value('th:ErrorMessage', '')
 
                 self.write('clearError')
@@ -4098,9 +6398,6 @@ class ThHandler_REST(ThHandler):
             for key in self.cookies.keys():
                 cookies_str += key + '=' + urlparse.quote(self.cookies.get(key).value) + '&'
 
-            # serialize theas parameters to pass into the stored procedure
-            theas_params_str = self.session.theas_page.serialize()
-
             # Execute spDoRestRequest in the database
             proc = ThStoredProc(rest_proc_name, self.session)
 
@@ -4115,20 +6412,21 @@ class ThHandler_REST(ThHandler):
                 proc.refresh_parameter_list()
 
                 if '@RequestTypeGUIDStr' in proc.parameter_list:
-                    proc.bind(requesttype_guid_str, _mssql.SQLCHAR, '@RequestTypeGUIDStr', null=(requesttype_guid_str is None))
+                    proc.bind(requesttype_guid_str, TheasDB.SQLCHAR, '@RequestTypeGUIDStr', null=(requesttype_guid_str is None))
 
                 if '@RequestTypeCode' in proc.parameter_list:
-                    proc.bind(requesttype_code, _mssql.SQLCHAR, '@RequestTypeCode', null=(requesttype_code is None))
+                    proc.bind(requesttype_code, TheasDB.SQLCHAR, '@RequestTypeCode', null=(requesttype_code is None))
 
                 if '@HTTPParams' in proc.parameter_list:
-                    proc.bind(self.request.query, _mssql.SQLCHAR, '@HTTPParams')
+                    proc.bind(self.request.query, TheasDB.SQLCHAR, '@HTTPParams')
 
                 if '@FormParams' in proc.parameter_list:
-                    proc.bind(form_params_str, _mssql.SQLCHAR, '@FormParams')
-                    # proc.bind(urlparse.urlencode(self.request.body_arguments, doseq=True), _mssql.SQLCHAR, '@FormParams')
+                    proc.bind(form_params_str, TheasDB.SQLCHAR, '@FormParams')
+                    # proc.bind(urlparse.urlencode(self.request.body_arguments, doseq=True), TheasDB.SQLCHAR, '@FormParams')
 
                 if '@TheasParams' in proc.parameter_list:
-                    proc.bind(theas_params_str, _mssql.SQLCHAR, '@TheasParams')
+                    # We also want to serialize all Theas controls
+                    self.bind_theas_params(proc)
 
                 if '@HTTPHeaders' in proc.parameter_list:
                     headers_str = ''
@@ -4146,18 +6444,20 @@ class ThHandler_REST(ThHandler):
 
                         headers_str = headers_str + '&' + key + '=' + urlparse.quote(this_val)
 
-                    proc.bind(headers_str, _mssql.SQLCHAR, '@HTTPHeaders')
+                    proc.bind(headers_str, TheasDB.SQLCHAR, '@HTTPHeaders')
 
                 if '@Cookies' in proc.parameter_list:
-                    proc.bind(cookies_str, _mssql.SQLCHAR, '@Cookies')
+                    proc.bind(cookies_str, TheasDB.SQLCHAR, '@Cookies')
 
                 if '@RemoteIP' in proc.parameter_list:
-                    proc.bind(self.request.remote_ip, _mssql.SQLCHAR, '@RemoteIP')
+                    proc.bind(self.request.remote_ip, TheasDB.SQLCHAR, '@RemoteIP')
 
                 if '@InhibitResultset' in proc.parameter_list:
-                    proc.bind('0', _mssql.SQLCHAR, '@InhibitResultset')
+                    proc.bind('0', TheasDB.SQLCHAR, '@InhibitResultset')
 
                 proc_result = proc.execute(fetch_rows=False)
+                if '@TheasParams' in proc.parameter_list:
+                    self.session.theas_page.mark_params_sent()
                 assert proc_result, 'ThHandler_REST.get_rest_requestype received error result from call to theas.spDoRestRequest in the SQL database.'
 
                 this_response_no = None
@@ -4290,8 +6590,13 @@ class ThHandler_REST(ThHandler):
 
                     self.finish()
 
-                proc.th_session.sql_conn.close()
-                proc.th_session.sql_conn = None
+                if proc.th_session.pooled_conn is not None:
+                    # Return the connection to the pool instead of closing it, and destroy the session ourselves
+                    proc.th_session.release_sql_conn()
+                    G_sessions.remove_session(self.session.session_token)
+                else:
+                    proc.th_session.sql_conn.close()
+                    proc.th_session.sql_conn = None
 
                 proc = None
 
@@ -4394,6 +6699,7 @@ class ThHandler_PurgeCache(ThHandler):
     @tornado.gen.coroutine
     def get(self, *args, **kwargs):
         global G_cached_resources
+        global G_init_session_sql
 
         message = 'No resource code specified.  Nothing to do.'
 
@@ -4406,13 +6712,45 @@ class ThHandler_PurgeCache(ThHandler):
                 else:
                     message = 'Nothing purged. Nothing in the cache.'
 
+                # A deploy that changes resources may well change stored procedures too
+                G_cached_params.delete_params(delete_all=True)
+                G_cached_results.delete_results(delete_all=True)
+                G_init_session_sql = None
+
             else:
+                G_cached_results.delete_results(resource_code=resource_code)
+
                 if G_cached_resources.delete_resource(resource_code=resource_code, delete_all=False):
                     message = 'Purged cached resource: ' + resource_code
                 else:
                     message = 'Nothing purged.  Resource code "' + resource_code + '" not found.'
 
+        if len(self.get_arguments('sp')) > 0:
+            # Purge cached stored procedure parameter lists, i.e. /purgecache?sp=_all or /purgecache?sp=dbo.spMyProc
+            stored_proc_name = self.get_argument('sp')
+
+            if stored_proc_name == '_all' or stored_proc_name.strip().lower() == 'theas.spgetinitsession':
+                # New connections will call theas.spgetInitSession again
+                G_init_session_sql = None
+
+            if stored_proc_name == '_all':
+                if G_cached_params.delete_params(delete_all=True):
+                    message = 'Purged all cached stored procedure parameters.'
+                else:
+                    message = 'Nothing purged. No stored procedure parameters in the cache.'
+            else:
+                if G_cached_params.delete_params(stored_proc_name=stored_proc_name):
+                    message = 'Purged cached stored procedure parameters: ' + stored_proc_name
+                else:
+                    message = 'Nothing purged.  Stored procedure "' + stored_proc_name + '" not found.'
+
         message = message + ' Items remaining in cache: ' + str(G_cached_resources.len())
+        message = message + ' ' + G_cached_resources.stats_str()
+        message = message + ' ' + theas.template_cache.stats_str()
+        if G_render_pool is not None:
+            message = message + ' ' + G_render_pool.stats_str()
+        message = message + ' ' + G_cached_params.stats_str()
+        message = message + ' ' + G_cached_results.stats_str()
 
         ThSession.cls_log('Cache', message)
 
@@ -4497,6 +6835,17 @@ def run(run_as_svc=False):
     global DEFAULT_RESOURCE_CODE
 
     global FULL_SQL_IS_OK_CHECK
+    global SQL_IDLE_CHECK_SECONDS
+    global SQL_VALIDATE_POLL_SECONDS
+    global REVISION_POLL_SECONDS
+    global CACHE_WARMUP
+    global CACHE_WARMUP_CONNECTIONS
+    global CACHE_SNAPSHOT_FILE
+    global STREAM_CHUNK_SIZE
+    global STREAM_RENDER
+    global RENDER_PROCESSES
+    global THEAS_PARAMS_DELTA
+    global G_render_pool
     global FORCE_REDIR_AFTER_POST
 
     global USE_SECURE_COOKIES
@@ -4509,6 +6858,23 @@ def run(run_as_svc=False):
 
     global MAX_CACHE_ITEM_SIZE
     global MAX_CACHE_SIZE
+    global COMPRESS_MIN_SIZE
+    global TEMPLATE_CACHE_SIZE
+    global TEMPLATE_BYTECODE_CACHE_DIR
+    global TEMPLATE_BYTECODE_CACHE_SIZE
+
+    global PARAM_CACHE_SECONDS
+    global G_cached_params
+
+    global RESULT_CACHE_MAX_SIZE
+    global G_cached_results
+
+    global SQL_POOL_SIZE
+    global G_sql_pool
+    global G_sql_driver
+
+    global CACHE_INIT_SESSION
+    global COMPACT_ROWS
 
     if LOGGING_LEVEL:
         msg = 'Theas app getting ready...'
@@ -4584,6 +6950,36 @@ def run(run_as_svc=False):
                              help="Maximum number of simultaneous SQL connections allowed.",
                              type=int)
 
+    G_program_options.define("sql_driver",
+                             default='mssql',
+                             help="SQL driver to use:  mssql, or fake to use canned responses from sql_fake_script (for load testing)",
+                             type=str)
+
+    G_program_options.define("sql_fake_script",
+                             default=None,
+                             help="When sql_driver is fake, the JSON file (in settings_path) with the canned SQL responses",
+                             type=str)
+
+    G_program_options.define("sql_fake_latency_ms",
+                             default=0,
+                             help="When sql_driver is fake, the default time (in milliseconds) each SQL call takes",
+                             type=int)
+
+    G_program_options.define("sql_pool_size",
+                             default=SQL_POOL_SIZE,
+                             help="Maximum number of pooled SQL connections shared by all sessions.  Zero to give each session its own connection.",
+                             type=int)
+
+    G_program_options.define("compact_rows",
+                             default=COMPACT_ROWS,
+                             help="Store resultset rows passed to templates in a compact form (limited to the columns listed in the resource's resultset string, if any)",
+                             type=bool)
+
+    G_program_options.define("cache_init_session",
+                             default=CACHE_INIT_SESSION,
+                             help="Call theas.spgetInitSession once, and replay the statements it returns on new SQL connections",
+                             type=bool)
+
     G_program_options.define("session_max_idle_minutes",
                              default=SESSION_MAX_IDLE,
                              help="Maximum idle time (in minutes) that user sessions will remain active", type=int)
@@ -4622,6 +7018,56 @@ def run(run_as_svc=False):
                              help="Explicitly test SQL connection before each call.",
                              type=bool)
 
+    G_program_options.define("sql_idle_check_seconds",
+                             default=SQL_IDLE_CHECK_SECONDS,
+                             help="With full_sql_is_ok_check, only test SQL connections that have been idle for longer than this (in seconds).  Zero to test before each call.",
+                             type=int)
+
+    G_program_options.define("sql_validate_poll_seconds",
+                             default=SQL_VALIDATE_POLL_SECONDS,
+                             help="Time (in seconds) between background checks of idle SQL connections.  Zero to disable.",
+                             type=int)
+
+    G_program_options.define("revision_poll_seconds",
+                             default=REVISION_POLL_SECONDS,
+                             help="Time (in seconds) between background checks for changed resource revisions.  Zero to disable.",
+                             type=int)
+
+    G_program_options.define("cache_warmup",
+                             default=CACHE_WARMUP,
+                             help="Load all public resources and templates into the cache at startup:  none, wait (finish before serving requests) or background.",
+                             type=str)
+
+    G_program_options.define("cache_warmup_connections",
+                             default=CACHE_WARMUP_CONNECTIONS,
+                             help="Number of SQL connections to use in parallel for cache_warmup.",
+                             type=int)
+
+    G_program_options.define("stream_chunk_size",
+                             default=STREAM_CHUNK_SIZE,
+                             help="Send resources and attachments larger than this many bytes in chunks of this size, waiting for each chunk to be sent.",
+                             type=int)
+
+    G_program_options.define("theas_params_delta",
+                             default=THEAS_PARAMS_DELTA,
+                             help="Pass only the Theas controls that have changed to @TheasParams of stored procedures that have a @TheasParamsDelta parameter.",
+                             type=bool)
+
+    G_program_options.define("render_processes",
+                             default=RENDER_PROCESSES,
+                             help="Number of worker processes to render templates in (to use more than one CPU core).  Zero to render in the server process.",
+                             type=int)
+
+    G_program_options.define("stream_render",
+                             default=STREAM_RENDER,
+                             help="Send rendered templates in chunks of stream_chunk_size as they are rendered, rather than rendering the whole page first.",
+                             type=bool)
+
+    G_program_options.define("cache_snapshot_file",
+                             default=CACHE_SNAPSHOT_FILE,
+                             help="File (in settings_path, unless a full path) to save cached resources to at shutdown and load them from at startup.  Blank to disable.",
+                             type=str)
+
     G_program_options.define("force_redir_after_post",
                              default=FORCE_REDIR_AFTER_POST,
                              help="After a POST, perform a redirect even if no update was requested.",
@@ -4667,6 +7113,36 @@ def run(run_as_svc=False):
                              help="Maximum total amount of bytes to use for cache storage.",
                              type=int)
 
+    G_program_options.define("template_cache_size",
+                             default=TEMPLATE_CACHE_SIZE,
+                             help="Maximum number of compiled jinja templates to keep in memory.  Zero to compile templates each time they are rendered.",
+                             type=int)
+
+    G_program_options.define("template_bytecode_cache_dir",
+                             default=TEMPLATE_BYTECODE_CACHE_DIR,
+                             help="Folder (in settings_path, unless a full path) to store compiled jinja templates in across restarts.  Blank to disable.",
+                             type=str)
+
+    G_program_options.define("template_bytecode_cache_size",
+                             default=TEMPLATE_BYTECODE_CACHE_SIZE,
+                             help="Maximum total size (in bytes) of the compiled templates in template_bytecode_cache_dir.  Zero for no limit.",
+                             type=int)
+
+    G_program_options.define("compress_min_size",
+                             default=COMPRESS_MIN_SIZE,
+                             help="Minimum size in bytes of a cached resource to store gzip (and brotli) compressed copies of.  Zero to disable.",
+                             type=int)
+
+    G_program_options.define("result_cache_max_size",
+                             default=RESULT_CACHE_MAX_SIZE,
+                             help="Maximum total amount of bytes to use for caching API stored procedure results.",
+                             type=int)
+
+    G_program_options.define("param_cache_seconds",
+                             default=PARAM_CACHE_SECONDS,
+                             help="Time (in seconds) to cache stored procedure parameter names.  Zero to disable.",
+                             type=int)
+
     G_program_options.parse_command_line()
 
     msg = 'Theas app: trying to use configuration from {}'.format(G_program_options.settings_path + 'settings.cfg')
@@ -4707,6 +7183,18 @@ def run(run_as_svc=False):
     REMEMBER_USER_TOKEN = G_program_options.remember_user_token
     DEFAULT_RESOURCE_CODE = G_program_options.default_resource_code
     FULL_SQL_IS_OK_CHECK = G_program_options.full_sql_is_ok_check
+    SQL_IDLE_CHECK_SECONDS = G_program_options.sql_idle_check_seconds
+    SQL_VALIDATE_POLL_SECONDS = G_program_options.sql_validate_poll_seconds
+    REVISION_POLL_SECONDS = G_program_options.revision_poll_seconds
+    CACHE_WARMUP = G_program_options.cache_warmup
+    CACHE_WARMUP_CONNECTIONS = G_program_options.cache_warmup_connections
+    CACHE_SNAPSHOT_FILE = G_program_options.cache_snapshot_file
+    STREAM_CHUNK_SIZE = G_program_options.stream_chunk_size
+    STREAM_RENDER = G_program_options.stream_render
+    RENDER_PROCESSES = G_program_options.render_processes
+    THEAS_PARAMS_DELTA = G_program_options.theas_params_delta
+    if CACHE_SNAPSHOT_FILE and not os.path.isabs(CACHE_SNAPSHOT_FILE):
+        CACHE_SNAPSHOT_FILE = G_program_options.settings_path + CACHE_SNAPSHOT_FILE
     FORCE_REDIR_AFTER_POST = G_program_options.force_redir_after_post
     USE_SECURE_COOKIES = G_program_options.use_secure_cookies
     SESSION_HEADER_NAME = G_program_options.session_header_name
@@ -4714,6 +7202,28 @@ def run(run_as_svc=False):
     USER_COOKIE_NAME = G_program_options.user_cookie_name
     USE_WORKER_THREADS = G_program_options.use_worker_threads
     MAX_WORKERS = G_program_options.max_worker_threads
+    SQL_POOL_SIZE = G_program_options.sql_pool_size
+    COMPACT_ROWS = G_program_options.compact_rows
+    CACHE_INIT_SESSION = G_program_options.cache_init_session
+    PARAM_CACHE_SECONDS = G_program_options.param_cache_seconds
+    MAX_CACHE_ITEM_SIZE = G_program_options.max_cache_item_size
+    MAX_CACHE_SIZE = G_program_options.max_cache_size
+    COMPRESS_MIN_SIZE = G_program_options.compress_min_size
+    TEMPLATE_CACHE_SIZE = G_program_options.template_cache_size
+    theas.template_cache.max_templates = TEMPLATE_CACHE_SIZE
+    TEMPLATE_BYTECODE_CACHE_DIR = G_program_options.template_bytecode_cache_dir
+    TEMPLATE_BYTECODE_CACHE_SIZE = G_program_options.template_bytecode_cache_size
+
+    if TEMPLATE_BYTECODE_CACHE_DIR and not os.path.isabs(TEMPLATE_BYTECODE_CACHE_DIR):
+        TEMPLATE_BYTECODE_CACHE_DIR = G_program_options.settings_path + TEMPLATE_BYTECODE_CACHE_DIR
+
+    if TEMPLATE_BYTECODE_CACHE_DIR:
+        try:
+            theas.set_template_bytecode_cache(TEMPLATE_BYTECODE_CACHE_DIR, max_size=TEMPLATE_BYTECODE_CACHE_SIZE)
+        except OSError as e:
+            ThSession.cls_log('Startup', 'Cannot use template bytecode cache folder {}: {}'.format(
+                TEMPLATE_BYTECODE_CACHE_DIR, e))
+    RESULT_CACHE_MAX_SIZE = G_program_options.result_cache_max_size
 
     msg = 'Starting Theas server {} (in {}) on port {}.'.format(
         program_filename, program_directory, G_program_options.port)
@@ -4725,6 +7235,29 @@ def run(run_as_svc=False):
 
     global G_cached_resources
 
+    if G_program_options.sql_driver == 'fake':
+        G_sql_driver = TheasDB.get_driver(
+            'fake',
+            script_filename=G_program_options.settings_path + G_program_options.sql_fake_script
+            if G_program_options.sql_fake_script else None,
+            latency_ms=G_program_options.sql_fake_latency_ms)  # Global SQL driver
+
+        msg = 'Theas app: using the fake SQL driver.  No SQL server will be used.'
+        print(msg)
+        write_winlog(msg)
+    else:
+        G_sql_driver = TheasDB.get_driver(G_program_options.sql_driver)  # Global SQL driver
+
+    if SQL_POOL_SIZE:
+        G_sql_pool = ThSQLPool(min(SQL_POOL_SIZE, G_program_options.sql_max_connections))  # Global SQL connection pool
+
+    G_cached_params = ThCachedParams()  # Global list of cached stored procedure parameters
+
+    G_cached_results = ThCachedResults()  # Global list of cached API stored procedure results
+
+    if RENDER_PROCESSES:
+        G_render_pool = ThRenderPool(RENDER_PROCESSES)  # Global pool of template rendering processes
+
     G_cached_resources = ThCachedResources()  # Global list of cached resources
 
     try:
@@ -4737,9 +7270,24 @@ def run(run_as_svc=False):
         write_winlog(msg)
         sys.exit()
 
+    if CACHE_SNAPSHOT_FILE:
+        try:
+            G_cached_resources.load_snapshot(CACHE_SNAPSHOT_FILE)
+        except Exception as e:
+            ThSession.cls_log('Snapshot', 'Error loading cache snapshot {}: {}'.format(CACHE_SNAPSHOT_FILE, e))
+
     G_sessions = ThSessions()  # Global list of sessions
 
-    _mssql.set_max_connections(G_program_options.sql_max_connections)
+    G_sql_driver.set_max_connections(G_program_options.sql_max_connections)
+
+    # Warm up only after the sessions and the SQL driver are set up, since the loader sessions need both
+    if CACHE_WARMUP == 'wait':
+        # Requests are not served until the IOLoop is started
+        print('Theas app:  Warming up resource cache')
+        G_cached_resources.warm_up(CACHE_WARMUP_CONNECTIONS)
+    elif CACHE_WARMUP == 'background':
+        threading.Thread(target=G_cached_resources.warm_up, args=(CACHE_WARMUP_CONNECTIONS,),
+                         name='ThCachedResources Warm Up').start()
 
     if run_as_svc:
         # make sure there is an ioloop in this thread (needed for Windows service)
@@ -4787,6 +7335,8 @@ def run(run_as_svc=False):
     logging.getLogger('tornado.access').disabled = True
 
     G_sessions.start_cleanup_thread()
+    G_sessions.start_validator_thread()
+    G_cached_resources.start_revision_thread()
 
     tornado.ioloop.PeriodicCallback(do_periodic_callback, 2000).start()
 
@@ -4819,9 +7369,24 @@ def run(run_as_svc=False):
     http_server = None
     del http_server
 
+    if CACHE_SNAPSHOT_FILE:
+        try:
+            saved_count = G_cached_resources.save_snapshot(CACHE_SNAPSHOT_FILE)
+            ThSession.cls_log('Shutdown', 'Saved {} cached resources to {}'.format(saved_count, CACHE_SNAPSHOT_FILE))
+        except Exception as e:
+            ThSession.cls_log('Shutdown', 'Error saving cache snapshot {}: {}'.format(CACHE_SNAPSHOT_FILE, e))
+
     G_cached_resources = None
     ThSession.cls_log('Shutdown', 'Winding down #4')
 
+    if G_sql_pool is not None:
+        G_sql_pool.close_all()
+        G_sql_pool = None
+
+    if G_render_pool is not None:
+        G_render_pool.shutdown()
+        G_render_pool = None
+
     G_sessions.stop()
     # ThSessions.remove_all_sessions()
     G_sessions = None
@@ -4839,6 +7404,8 @@ def run(run_as_svc=False):
 
 
 if __name__ == "__main__":
+    # Render pool workers (see ThRenderPool) are spawned processes:  when frozen, run the worker rather than the server
+    multiprocessing.freeze_support()
 
     try:
         # all_objects = muppy.get_objects()
@@ -4858,5 +7425,6 @@ if __name__ == "__main__":
     finally:
         pass
 
-        # Clean up _mssql resources
-        # _mssql.exit_mssql()
+        # Clean up SQL driver resources
+        if G_sql_driver is not None:
+            G_sql_driver.shutdown()
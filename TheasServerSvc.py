@@ -6,6 +6,7 @@ import win32service
 import win32serviceutil
 import win32evtlogutil
 import os
+import multiprocessing
 
 # import winreg
 
@@ -210,6 +211,10 @@ class TheasServerSvc(win32serviceutil.ServiceFramework):
 
 
 if __name__ == '__main__':
+    # In the frozen .exe, render pool workers (see TheasServer.ThRenderPool) are started by running the .exe again.
+    # freeze_support runs the worker (and exits) when that is why we were started.
+    multiprocessing.freeze_support()
+
     # Note:  we assume that the class declaration of TheasServerSvc
     # will populate the global variables (G_program_filename, etc.)
     # Those must be populated before anything else happens (i.e. we
@@ -108,6 +108,12 @@ HTTP POST of the actual Theas form.
 Theas is set to support both server-side rendering, and client-side rendering.  Which you use is up to you.
 '''
 import types
+import threading
+import hashlib
+import os
+import fnmatch
+import tempfile
+import pickle
 #import string
 from collections import OrderedDict
 import ast
@@ -122,8 +128,9 @@ from time import strptime, strftime
 import datetime
 
 #from jinja2 import Template, Undefined, environmentfilter  # , Markup, escape
-from jinja2 import Undefined, pass_environment #environmentfilter  # , Markup, escape, Template,
+from jinja2 import Undefined, pass_environment, pass_context #environmentfilter  # , Markup, escape, Template,
 from jinja2.environment import Environment
+from jinja2.bccache import FileSystemBytecodeCache
 
 ALLOW_UNSAFE_FUNCTIONS = False
 
@@ -181,8 +188,12 @@ class TheasControlNV:
         self.__datavalue = ''
         # For internal use (to aid in setting the value of this name-value pair when the value must
         # correspond to a child control, such as radio, checkbox, or select
-        self.value = ''
+        self.__value = ''
         # The current value, i.e. what jquery .val() would return for this name
+        self.changed = True
+        # Set when value changes, until the page's controls are next sent to SQL (see Theas.mark_params_sent)
+        self.__serialized = None
+        # Cached name=value& for Theas.serialize (see get_serialized), cleared when value changes
         self.__default_value = default_value
         # For checkbox, radio, and select, the default value to use if __datavalue is not set
         self.control_type = control_type
@@ -199,6 +210,26 @@ class TheasControlNV:
         self.controls = None
         del self.controls
 
+    @property
+    def value(self):
+        return self.__value
+
+    @value.setter
+    def value(self, value):
+        if value is not self.__value and (type(value) is not type(self.__value) or value != self.__value):
+            self.changed = True
+            self.__serialized = None
+        self.__value = value
+
+    def get_serialized(self):
+        # Returns name=value& (with value URL-quoted), as in TheasParams.  Cached until value changes.
+        if self.__serialized is None:
+            if self.__value is not None and not isinstance(self.__value, SilentUndefined):
+                self.__serialized = self.name + '=' + urlparse.quote(str(self.__value)) + '&'
+            else:
+                self.__serialized = self.name + '=&'
+        return self.__serialized
+
     @property
     def datavalue(self):
         return self.__datavalue
@@ -224,82 +255,300 @@ class TheasControlNV:
             self.value = self.datavalue
 
 
-class Theas:
-    def __init__(self, theas_session=None, jinja_environment=None):
+THEAS_PAGE_VAR = '_theas_page'  # name of the render context variable that holds the Theas page being rendered
+
+_jinja_env = None
+_jinja_env_lock = threading.Lock()
+
+
+def _page_filter(method_name):
+    # Returns a filter that calls method_name of the Theas page being rendered (see Theas.render).  This lets
+    # all pages share one jinja environment.
+    @pass_context
+    def page_filter(context, *args, **kwargs):
+        return getattr(context[THEAS_PAGE_VAR], method_name)(context.environment, *args, **kwargs)
+
+    page_filter.__name__ = method_name
+    return page_filter
+
+
+def create_jinja_environment():
+    # Create a jinja environment with the Theas filters
+    this_env = Environment()
+
+    this_env.undefined = SilentUndefined
+
+    this_env.filters['theasSessionToken'] = _page_filter('theas_sessiontoken')
+    # Ouputs the current session token as a hidden form field.  This is required for normal
+    # operation of Theas.  Also outputs other commonly-used Theas hidden form fields:
+    # th:ErrorMessage and th:PerformUpdate
+
+    this_env.filters['theasXSRF'] = _page_filter('theas_xsrf')
+    # Outputs the current XSRF token (used for security purposes).  This is required for
+    # normal operation of Theas.  (Form posts to Theas that do not have a valid XSRF
+    # token will be rejected.)
+
+    # The following output an HTML form field for the specified control.
+    # This is useful when producing HTML pages using server-side rendering (SSR).
+    # Note that when using Vue.js these may not be needed, as theas data is communicated
+    # via JSON instead. (See theasValuesjSON)
+    this_env.filters['theasHidden'] = _page_filter('theas_hidden')
+    this_env.filters['theasInput'] = _page_filter('theas_input')
+    this_env.filters['theasRadio'] = _page_filter('theas_radio')
+    this_env.filters['theasSelect'] = _page_filter('theas_select')
+    this_env.filters['theasTextarea'] = _page_filter('theas_textarea')
+    this_env.filters['theasCheckbox'] = _page_filter('theas_checkbox')
+
+    this_env.filters['theasValuesJSON'] = _page_filter('theas_values_json')
+    # Output a JSON string that includes all Theas controls that have the flag include_in_json set.
+    # The : character that is used as a delimiter in control names will be replaced with a $
+    # so that the resulting JSON contains legal javascript variable names.
+
+    this_env.filters['theasBase64'] = _page_filter('theas_base64')
+
+    this_env.filters['theasInclude'] = _page_filter('theas_include')
+    # Set the internal include_in_json flag for the specified control so that it will be
+    # included in the output of the filter |theasValueJSON
+
+    # By default this filter will not output anything (but instead merely affects the output of
+    # theasValueJSON)
+
+    # Optionally, you can pass in (output=True) to have this filter output the javascript-friendly
+    # version of the control name as a string as well, in which embedded : characters are translated
+    # to $ characters, such as:
+    # {{ "theas:Ping:AudioRecording"|theasInclude(output=True) }} would result in
+    # the string theas$Ping$AudioRecording being outputted.
+
+    this_env.filters['theasResource'] = _page_filter('theas_resource')
+    # Lets you specify {{ SomeResource|theasResource }} instead of "SomeResource", and
+    # thereby modifies the actual resource URL that is rendered to bust the browser
+    # cache if needed.
+
+    this_env.filters['theasEcho'] = _page_filter('theas_echo')
+    # Conditionally echos the specified string.  For example:
+    # {{'active' | theasEcho(if_curpage='mypage')}} would output the string 'active' if
+    # the value of the Theas control named curpage was equal to 'mypage'
+
+    this_env.filters['ifNone'] = _page_filter('theas_if_none')
+    # Specifies a value to emit if the input value is None
+
+    this_env.filters['friendlydate'] = _page_filter('format_friendlydate')
+    # General date formatting routine.
+
+    # this_env.filters['button'] = _page_filter('theas_button')
 
-        # if not isinstance(jinja_environment, Environment):
-        if True:
-            # set up new jinja environment
-            self.jinja_env = Environment()
+    this_env.filters['theasDefineFunctions'] = _page_filter('theas_define_functions')
+    this_env.filters['theasDefineFilter'] = _page_filter('theas_define_filter')
 
-            self.jinja_env.theas_page = self
+    return this_env
 
-            self.jinja_env.undefined = SilentUndefined
 
-            self.jinja_env.filters['theasSessionToken'] = self.theas_sessiontoken
-            # Ouputs the current session token as a hidden form field.  This is required for normal
-            # operation of Theas.  Also outputs other commonly-used Theas hidden form fields:
-            # th:ErrorMessage and th:PerformUpdate
+def get_jinja_environment():
+    # Returns the jinja environment shared by all Theas pages
+    global _jinja_env
 
-            self.jinja_env.filters['theasXSRF'] = self.theas_xsrf
-            # Outputs the current XSRF token (used for security purposes).  This is required for
-            # normal operation of Theas.  (Form posts to Theas that do not have a valid XSRF
-            # token will be rejected.)
+    if _jinja_env is None:
+        with _jinja_env_lock:
+            if _jinja_env is None:
+                _jinja_env = create_jinja_environment()
 
-            # The following output an HTML form field for the specified control.
-            # This is useful when producing HTML pages using server-side rendering (SSR).
-            # Note that when using Vue.js these may not be needed, as theas data is communicated
-            # via JSON instead. (See theasValuesjSON)
-            self.jinja_env.filters['theasHidden'] = self.theas_hidden
-            self.jinja_env.filters['theasInput'] = self.theas_input
-            self.jinja_env.filters['theasRadio'] = self.theas_radio
-            self.jinja_env.filters['theasSelect'] = self.theas_select
-            self.jinja_env.filters['theasTextarea'] = self.theas_textarea
-            self.jinja_env.filters['theasCheckbox'] = self.theas_checkbox
+    return _jinja_env
 
-            self.jinja_env.filters['theasValuesJSON'] = self.theas_values_json
-            # Output a JSON string that includes all Theas controls that have the flag include_in_json set.
-            # The : character that is used as a delimiter in control names will be replaced with a $
-            # so that the resulting JSON contains legal javascript variable names.
 
-            self.jinja_env.filters['theasBase64'] = self.theas_base64
+class TheasBytecodeCache(FileSystemBytecodeCache):
+    """Class TheasBytecodeCache is a jinja bytecode cache in a folder, so that templates compiled before a restart
+    need not be compiled again.
 
-            self.jinja_env.filters['theasInclude'] = self.theas_include
-            # Set the internal include_in_json flag for the specified control so that it will be
-            # included in the output of the filter |theasValueJSON
+    Templates are stored by a hash of their source (see TemplateCache.get_template), so the cache needs no
+    invalidation:  a changed template has a new file.  Several processes may share the folder.  Files are written to a
+    temporary file and renamed into place, so a process never reads a partly-written file, and a file that is
+    unreadable or from a different Python or jinja version is simply compiled again.
 
-            # By default this filter will not output anything (but instead merely affects the output of
-            # theasValueJSON)
+    If max_size (in bytes) is set, the least recently used files are deleted when the files in the folder total more.
+    """
 
-            # Optionally, you can pass in (output=True) to have this filter output the javascript-friendly
-            # version of the control name as a string as well, in which embedded : characters are translated
-            # to $ characters, such as:
-            # {{ "theas:Ping:AudioRecording"|theasInclude(output=True) }} would result in
-            # the string theas$Ping$AudioRecording being outputted.
+    def __init__(self, directory, max_size=0):
+        super().__init__(directory, pattern='__theas_jinja_%s.cache')
+        self.max_size = max_size
+        self.loads = 0
+        self.stores = 0
+
+    def load_bytecode(self, bucket):
+        this_filename = self._get_cache_filename(bucket)
+        try:
+            with open(this_filename, 'rb') as f:
+                bucket.load_bytecode(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            # Missing (or deleted by another process while we read it), or corrupt:  compile again
+            bucket.reset()
+            return
 
-            self.jinja_env.filters['theasResource'] = self.theas_resource
-            # Lets you specify {{ SomeResource|theasResource }} instead of "SomeResource", and
-            # thereby modifies the actual resource URL that is rendered to bust the browser
-            # cache if needed.
+        if bucket.code is not None:
+            self.loads += 1
+            try:
+                # Update the modification time, so that prune deletes the least recently used files first
+                os.utime(this_filename)
+            except OSError:
+                pass
+
+    def dump_bytecode(self, bucket):
+        this_filename = self._get_cache_filename(bucket)
+        this_fd, this_temp_filename = tempfile.mkstemp(prefix='__theas_jinja_', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(this_fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(this_temp_filename, this_filename)
+        except OSError:
+            # The cache is only an optimization
+            try:
+                os.remove(this_temp_filename)
+            except OSError:
+                pass
+            return
 
-            self.jinja_env.filters['theasEcho'] = self.theas_echo
-            # Conditionally echos the specified string.  For example:
-            # {{'active' | theasEcho(if_curpage='mypage')}} would output the string 'active' if
-            # the value of the Theas control named curpage was equal to 'mypage'
+        self.stores += 1
 
-            self.jinja_env.filters['ifNone'] = self.theas_if_none
-            # Specifies a value to emit if the input value is None
+        if self.max_size:
+            self.prune()
 
-            self.jinja_env.filters['friendlydate'] = self.format_friendlydate
-            # General date formatting routine.
+    def prune(self):
+        # Delete the least recently used files until the cache is no larger than max_size
+        this_files = []
+        this_size = 0
 
-            # self.jinja_env.filters['button'] = self.theas_button
+        for this_name in fnmatch.filter(os.listdir(self.directory), self.pattern % ('*',)):
+            try:
+                this_stat = os.stat(os.path.join(self.directory, this_name))
+            except OSError:
+                continue
+            this_files.append((this_stat.st_mtime, this_stat.st_size, this_name))
+            this_size += this_stat.st_size
 
-            self.jinja_env.filters['theasDefineFunctions'] = self.theas_define_functions
-            self.jinja_env.filters['theasDefineFilter'] = self.theas_define_filter
+        this_files.sort()
 
+        for this_mtime, this_file_size, this_name in this_files:
+            if this_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, this_name))
+            except OSError:
+                # Another process may have deleted it already
+                pass
+            this_size -= this_file_size
+
+    def stats_str(self):
+        return 'Bytecode loads: {}  Stores: {}'.format(self.loads, self.stores)
+
+
+def set_template_bytecode_cache(directory, max_size=0):
+    # Store compiled templates of the shared jinja environment in directory (None to disable)
+    this_cache = None
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        this_cache = TheasBytecodeCache(directory, max_size=max_size)
+        if max_size:
+            this_cache.prune()
+
+    get_jinja_environment().bytecode_cache = this_cache
+    return this_cache
+
+
+class TemplateCache:
+    """Class TemplateCache is a thread-safe cache of compiled jinja templates, shared by all Theas pages.
+
+    Compiling a template (lexing, parsing, generating and compiling Python source) costs much more than rendering
+    it, so each template is compiled once.  Templates are keyed by the key provided by the caller, such as
+    (resource_code, revision, etag), or else by a hash of the template source.  The key must change whenever the
+    source does:  a render that started before invalidate may put the template it compiled back in the cache.
+
+    If the jinja environment has a bytecode_cache (see set_template_bytecode_cache), templates that are not in memory
+    are loaded from it rather than compiled.
+
+    At most max_templates are cached.  When there are more, the least recently used are dropped.
+    """
+
+    def __init__(self, max_templates=500):
+        self.max_templates = max_templates
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()  # in least recently used order
+        self._lock = threading.Lock()
+        self.generation = 0  # incremented each time all templates are invalidated (see render_in_worker)
+
+    def get_template(self, jinja_env, template_str, template_key=None):
+        if template_key is None:
+            template_key = hashlib.sha1(template_str.encode('utf-8')).hexdigest()
+
+        with self._lock:
+            this_template = self._templates.get(template_key)
+            if this_template is not None:
+                self._templates.move_to_end(template_key)
+                self.hits += 1
+                return this_template
+            self.misses += 1
+
+        this_template = TemplateCache.compile_template(jinja_env, template_str)
+
+        if self.max_templates:
+            with self._lock:
+                self._templates[template_key] = this_template
+                while len(self._templates) > self.max_templates:
+                    self._templates.popitem(last=False)
+
+        return this_template
+
+    @staticmethod
+    def compile_template(jinja_env, template_str):
+        this_bytecode_cache = jinja_env.bytecode_cache
+        if this_bytecode_cache is None:
+            return jinja_env.from_string(template_str)
+
+        # jinja only uses bytecode_cache for templates from a loader, so do as jinja's loader would, with the
+        # hash of the source as the template name.  (The bucket also checks the source, and the jinja version.)
+        this_bucket = this_bytecode_cache.get_bucket(
+            jinja_env, hashlib.sha1(template_str.encode('utf-8')).hexdigest(), None, template_str)
+        this_code = this_bucket.code
+
+        if this_code is None:
+            this_code = jinja_env.compile(template_str)
+            this_bucket.code = this_code
+            this_bytecode_cache.set_bucket(this_bucket)
+
+        return jinja_env.template_class.from_code(jinja_env, this_code, jinja_env.make_globals(None))
+
+    def has_template(self, template_key):
+        with self._lock:
+            return template_key in self._templates
+
+    def invalidate(self, resource_code=None, invalidate_all=False):
+        # Drop the compiled templates of a resource (keyed by (resource_code, ...)), or all compiled templates
+        with self._lock:
+            if invalidate_all:
+                self._templates.clear()
+                self.generation += 1
+            elif resource_code is not None:
+                for this_key in [this_key for this_key in self._templates
+                                 if isinstance(this_key, tuple) and this_key[0] == resource_code]:
+                    del self._templates[this_key]
+
+    def stats_str(self):
+        this_str = 'Compiled templates: {}  Hits: {}  Misses: {}'.format(len(self._templates), self.hits, self.misses)
+        if isinstance(get_jinja_environment().bytecode_cache, TheasBytecodeCache):
+            this_str = this_str + '  ' + get_jinja_environment().bytecode_cache.stats_str()
+        return this_str
+
+
+template_cache = TemplateCache()  # compiled templates for the shared jinja environment
+
+
+class Theas:
+    def __init__(self, theas_session=None, jinja_environment=None):
+
+        if jinja_environment is None:
+            # All pages share one jinja environment.  The page being rendered is passed to the filters in the
+            # render context.  (See render)
+            self.jinja_env = get_jinja_environment()
         else:
-            # reuses existing jinja environment
             self.jinja_env = jinja_environment
 
         self.th_session = theas_session
@@ -333,8 +582,6 @@ class Theas:
         self.control_names = None
         del self.control_names
 
-        self.jinja_env.theas_page = None
-
         self.jinja_env = None
         del self.jinja_env
 
@@ -870,8 +1117,8 @@ class Theas:
         # Can pass in an optional parameter quotes=True which will cause leading and trailing double
         # quotes to be added to the result.  (The default is no quotes will be added to the result.
 
-        if this_value in this_env.theas_page.th_session.resource_versions:
-            this_version = str(this_env.theas_page.th_session.resource_versions[this_value]['Revision'])
+        if this_value in self.th_session.resource_versions:
+            this_version = str(self.th_session.resource_versions[this_value]['Revision'])
 
             segments = this_value.split('.')
             busted_filename = '.'.join(segments[:-1]) + '.ver.' + this_version + '.' + '.'.join(segments[-1:])
@@ -914,7 +1161,7 @@ class Theas:
         # {{ data._Theas.xsrf_formHTML }} instead.
 
         # buf = this_env.theas_page.th_session.current_data['_Theas']['xsrf_formHTML']
-        buf = this_env.theas_page.th_session.current_xsrf_form_html
+        buf = self.th_session.current_xsrf_form_html
 
         return buf
 
@@ -931,7 +1178,7 @@ class Theas:
             buf = '<input name="{}" type="hidden" {}value="{}"/>'.format(
                 'theas:th:ST',
                 ':' if vuejs else '',  # bound attribute in vuejs
-                'theasParams.th$ST' if vuejs else str(this_env.theas_page.th_session.session_token)
+                'theasParams.th$ST' if vuejs else str(self.th_session.session_token)
             )
 
         # sneak in hidden field to pass ErrorMessage
@@ -967,7 +1214,7 @@ class Theas:
         # passed as the second argument (this_value).  Additional arguments inside the parenthesis are
         # passed in args[] or kwargs[]
 
-        this_page = this_env.theas_page
+        this_page = self
 
         ctrl_name = None
         if 'name' in kwargs:
@@ -1008,7 +1255,7 @@ class Theas:
         # This filter is called like:
         #   {{data.EmployerJob.Company | theasInput(id="company", name="ejCompany", placeholder="", class ="form control input-md", required="")}}
 
-        this_page = this_env.theas_page
+        this_page = self
 
         ctrl_name = None
         if 'name' in kwargs:
@@ -1070,7 +1317,7 @@ class Theas:
         # This filter is called like:
         #   {{data.EmployerJob.JobApplicationsVia_code | theasRadio(id="email-app", name="ejReceiveAppsBy", class ="trigger", required="", data_rel="emailapp" checked_value="email", value="email")}}
 
-        this_page = this_env.theas_page
+        this_page = self
         ctrl_name = None
         if 'name' in kwargs:
             ctrl_name = kwargs['name']
@@ -1124,7 +1371,7 @@ class Theas:
         first.  Then, any rows in data.MyLookupRecordset will be added (using the field
         qquid as the value and the field SeriesTitle as the caption)
         '''
-        this_page = this_env.theas_page
+        this_page = self
         ctrl_name = None
         if 'name' in kwargs:
             ctrl_name = kwargs['name']
@@ -1185,7 +1432,7 @@ class Theas:
         # This filter is called like:
         #   {{data.EmployerJob.BasicQualifications | theasTextarea(id="basicQualifications", name="ejBasicQualifications", class ="form-control")}}
 
-        this_page = this_env.theas_page
+        this_page = self
 
         ctrl_name = None
         if 'name' in kwargs:
@@ -1231,7 +1478,7 @@ class Theas:
         # This filter is called like:
         #   {{data.EmployerJob.AgreeTerms | theasCheckbox(id="agreeTermsOfUse", name="ejAgreeTermsOfUse", checked_value="1", value="1")}}
 
-        this_page = this_env.theas_page
+        this_page = self
         ctrl_name = None
         if 'name' in kwargs:
             ctrl_name = kwargs['name']
@@ -1275,7 +1522,7 @@ class Theas:
     @pass_environment
     def theas_define_functions(self, ctrl_name, this_env, *args, **kwargs):
 
-        this_page = this_env.theas_page
+        this_page = self
 
         python_source = args[0]
         this_page.create_functions(python_source)
@@ -1286,9 +1533,14 @@ class Theas:
     @pass_environment
     def theas_define_filter(self, ctrl_name, this_env, *args, **kwargs):
 
-        this_page = this_env.theas_page
+        this_page = self
         python_source = args[0]
 
+        if this_page.jinja_env is get_jinja_environment():
+            # Filters defined by a page are only available to that page
+            this_page.jinja_env = this_page.jinja_env.overlay()
+            this_page.jinja_env.filters = dict(this_page.jinja_env.filters)
+
         for n, f in this_page.create_functions(python_source).items():
             this_page.jinja_env.filters[n] = f
 
@@ -1334,7 +1586,7 @@ class Theas:
 
         buf = ''
 
-        this_page = this_env.theas_page
+        this_page = self
         target_curpage = None
         control_name = None
         target_value = None
@@ -1382,13 +1634,19 @@ class Theas:
 
         return buf
 
-    def render(self, template_str, data={}):
+    def prepare_render(self, template_str, data={}, template_key=None):
+        # Does what render does before rendering:  returns the template to render, and the (possibly changed)
+        # template_str and data.
+        # template_key identifies template_str in template_cache, i.e. (resource_code, revision, etag).  If not
+        # provided, a hash of template_str is used.
+
         # Call doOnBeforeRender function(s) if provided
         if len(self.doOnBeforeRender):
             for this_func in self.doOnBeforeRender:
                 result_template_str, result_data = this_func(self, template_str=template_str, data=data)
                 if result_template_str:
                     template_str = result_template_str
+                    template_key = None
                 if result_data:
                     data = result_data
 
@@ -1404,8 +1662,18 @@ class Theas:
             self.get_control('th:CurrentPage', datavalue=self.th_session.current_resource.resource_code)
 
         # render output using template and data
-        this_template = self.jinja_env.from_string(template_str)
-        buf = this_template.render(data=data)
+        if self.jinja_env is get_jinja_environment():
+            this_template = template_cache.get_template(self.jinja_env, template_str, template_key)
+        else:
+            # This page has its own filters (see theas_define_filter)
+            this_template = self.jinja_env.from_string(template_str)
+
+        return this_template, template_str, data
+
+    def render(self, template_str, data={}, template_key=None):
+        this_template, template_str, data = self.prepare_render(template_str, data=data, template_key=template_key)
+
+        buf = this_template.render({'data': data, THEAS_PAGE_VAR: self})
 
         # Call doOnAfterRender function(s) if provided
         if len(self.doOnAfterRender):
@@ -1421,6 +1689,28 @@ class Theas:
 
         return buf
 
+    def render_chunks(self, template_str, data={}, template_key=None, chunk_size=65536):
+        # Like render, but a generator that yields the output in pieces of at least chunk_size characters (except
+        # the last) as the template is rendered, so that the start of a large page can be sent before the rest is
+        # rendered.  doOnAfterRender functions need the whole output, so they are not called:  use render if
+        # there are any.
+        this_template, template_str, data = self.prepare_render(template_str, data=data, template_key=template_key)
+
+        this_pieces = []
+        this_size = 0
+
+        for this_piece in this_template.generate({'data': data, THEAS_PAGE_VAR: self}):
+            this_pieces.append(this_piece)
+            this_size += len(this_piece)
+
+            if this_size >= chunk_size:
+                yield ''.join(this_pieces)
+                this_pieces = []
+                this_size = 0
+
+        if this_pieces:
+            yield ''.join(this_pieces)
+
     def theas_exec(self, function_name):
         this_function = None
         this_result = None
@@ -1504,27 +1794,110 @@ class Theas:
 
         return functions_created
 
-    def serialize(self, control_list=None):
-        buf = ''
-        this_key = None
-        this_control_nv = None
-
+    def serialize(self, control_list=None, changed_only=False):
+        # Returns name=value&name=value&... for all controls, or only the controls specified in control_list.
+        # Each control caches its serialized form until its value changes, so only changed values are quoted again.
+        # If changed_only, only controls that have changed since mark_params_sent are included.
         if control_list is None:
             # serialize all controls
-            for this_key, this_control_nv in self.control_names.items():
-                buf += this_control_nv.name + '='
-                if this_control_nv.value is not None and not isinstance(this_control_nv.value, SilentUndefined):
-                    buf += urlparse.quote(str(this_control_nv.value))
-                buf += '&'
-        else:
-            # serialize only the controls specified in control_list
-            for this_control_nv in control_list:
-                buf += this_control_nv.name + '='
-                if this_control_nv.value is not None and not isinstance(this_control_nv.value, SilentUndefined):
-                    buf += urlparse.quote(str(this_control_nv.value))
-                buf += '&'
-
-        return buf
+            control_list = self.control_names.values()
+
+        return ''.join(this_control_nv.get_serialized() for this_control_nv in control_list
+                       if this_control_nv.changed or not changed_only)
+
+    def mark_params_sent(self):
+        # Called when the serialized controls have been passed to a stored procedure (as @TheasParams), so that
+        # serialize(changed_only=True) includes only controls that change after this
+        for this_control_nv in self.control_names.values():
+            this_control_nv.changed = False
+
+    def can_render_in_worker(self):
+        # True if this page can be rendered by render_in_worker:  it must use the shared jinja environment, and not
+        # have Python functions or render hooks (which cannot be sent to another process)
+        return self.jinja_env is get_jinja_environment() and not self.functions and \
+            not self.doOnBeforeRender and not self.doOnAfterRender
+
+    def get_render_state(self):
+        # The state of this page and its session that the Theas filters use, to send to render_in_worker
+        return {
+            'session_token': str(self.th_session.session_token),
+            'current_resource_code': self.th_session.current_resource.resource_code
+            if self.th_session.current_resource is not None else None,
+            'current_xsrf_form_html': self.th_session.current_xsrf_form_html,
+            'control_names': self.control_names
+        }
+
+
+class RenderWorkerSession:
+    """Class RenderWorkerSession stands in for the TheasServer session of a page rendered by render_in_worker.
+
+    It has only what Theas pages and filters use.
+    """
+
+    def __init__(self, render_state, resource_versions):
+        self.session_token = render_state['session_token']
+        self.current_xsrf_form_html = render_state['current_xsrf_form_html']
+        self.resource_versions = resource_versions
+        self.current_resource = None
+        if render_state['current_resource_code']:
+            self.current_resource = types.SimpleNamespace(resource_code=render_state['current_resource_code'])
+
+    def log(self, category, *args):
+        pass
+
+
+_worker_resource_versions = {}
+_worker_resource_versions_stamp = None
+_worker_template_generation = 0
+
+
+def init_render_worker(max_templates, bytecode_cache_dir=None, bytecode_cache_size=0):
+    # Initializes a render pool worker process (see TheasServer.ThRenderPool)
+    template_cache.max_templates = max_templates
+    if bytecode_cache_dir:
+        set_template_bytecode_cache(bytecode_cache_dir, max_size=bytecode_cache_size)
+
+
+def render_in_worker(template_key, template_str, payload, resource_versions_stamp, resource_versions=None,
+                     template_generation=0):
+    # Renders a template in a render pool worker process.  payload is the pickled (data, render_state) of the page
+    # (see Theas.get_render_state).  Returns the output, and the page's controls (which filters may have added to).
+    #
+    # So that little needs to be sent to the worker, template_str and resource_versions may be omitted if the
+    # worker already has them:  returns None if the worker does not have template_key in template_cache, or
+    # does not have the resource_versions of resource_versions_stamp.  The caller should then send them.
+    #
+    # template_generation is the server's template_cache.generation.  When it changes (i.e. the server purged all
+    # of its templates), the worker drops its compiled templates too.
+    global _worker_resource_versions
+    global _worker_resource_versions_stamp
+    global _worker_template_generation
+
+    if template_generation != _worker_template_generation:
+        template_cache.invalidate(invalidate_all=True)
+        _worker_template_generation = template_generation
+
+    if resource_versions is not None:
+        _worker_resource_versions = resource_versions
+        _worker_resource_versions_stamp = resource_versions_stamp
+    elif resource_versions_stamp != _worker_resource_versions_stamp:
+        return None
+
+    if template_str is None and not template_cache.has_template(template_key):
+        return None
+
+    data, render_state = pickle.loads(payload)
+
+    this_page = Theas(theas_session=RenderWorkerSession(render_state, _worker_resource_versions))
+    this_page.control_names = render_state['control_names']
+
+    buf = this_page.render(template_str, data=data, template_key=template_key)
+
+    # Take the controls from the page, as Theas.__del__ clears them
+    this_control_names = this_page.control_names
+    this_page.control_names = {}
+
+    return buf, this_control_names
 
 
 # Official list is at: http://www.iana.org/assignments/media-types/media-types.xhtml